@@ -0,0 +1,130 @@
+import os
+import argparse
+import numpy as np
+
+from utils import read_yaml, save_yaml, get_subject_name, get_output_name, fetch_masker, fetch_data, possible_subjects_id
+from utils import get_splitter_information, get_compression_information, get_data_transformation_information, get_encoding_model_information
+from utils import get_code_version, stack_subjects, split_subjects
+from checkpoint import Checkpointer, SharedOutputs
+from profiler import Profiler
+from rendering import Renderer
+from results_store import ResultsStore
+from executors import get_executor
+from logger import Logger, install_exit_handlers
+from regression_pipeline import Pipeline
+from encoding_models import EncodingModel
+from splitter import Splitter
+from data_transformation import Transformer
+from data_compression import Compressor
+from main import define_tasks, save_maps
+
+
+# tasks whose outputs only depend on the stimuli representations (shared by all subjects)
+SHARED_TASKS = ['compressor_internal', 'transform_data_internal', 'compressor_external', 'transform_data_external']
+
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description="""Batch script that compute the R2 maps for several subjects and models,
+                                                    loading the masker, the stimuli representations and the design-matrices once.""")
+    parser.add_argument("--yaml_files", type=str, nargs='+', required=True,
+                            help="Paths to the yaml files containing the parameters of each model.")
+    parser.add_argument("--subjects", type=int, nargs='*', default=None,
+                            help="Ids of the subjects (all the subjects of the language if not specified).")
+    parser.add_argument("--joint_size", type=int, default=1,
+                            help="""Number of subjects fitted jointly: their voxels are stacked so that the design-matrix 
+                                    of each fold is factorized once for all of them (memory grows with the number of subjects).""")
+
+    args = parser.parse_args()
+    install_exit_handlers() # flush the logs when the job ends or is killed
+    maskers = {}
+    renderers = {}
+    for yaml_file in args.yaml_files:
+        parameters = read_yaml(yaml_file)
+        input_path = parameters['input']
+        output_path_ = parameters['output']
+        language = parameters['language']
+        subjects = [get_subject_name(id) for id in (args.subjects if args.subjects else possible_subjects_id(language))]
+        # logs regarding the shared steps are written in the folder of the first subject
+        logs = Logger(get_output_name(output_path_, language, subjects[0], parameters['model_name'], 'logs.txt'))
+
+        logs.info("Fetching maskers...", end='\n')
+        if (parameters['masker_path'], language) not in maskers:
+            maskers[(parameters['masker_path'], language)] = fetch_masker(parameters['masker_path'], language, parameters['path_to_fmridata'], input_path, logger=logs)
+        masker = maskers[(parameters['masker_path'], language)]
+        logs.validate()
+
+        logs.info("Retrieve arguments for each model...")
+        kwargs_splitter = get_splitter_information(parameters)
+        kwargs_compression = get_compression_information(parameters)
+        kwargs_transformation = get_data_transformation_information(parameters)
+        kwargs_encoding_model = get_encoding_model_information(parameters)
+        logs.validate()
+
+        logs.info("Instanciations of the classes...")
+        splitter = Splitter(**kwargs_splitter)
+        compressor = Compressor(**kwargs_compression)
+        transformer = Transformer(**kwargs_transformation)
+        encoding_model = EncodingModel(**kwargs_encoding_model)
+        executor = get_executor(parameters['parallel'], parameters.get('n_jobs'))
+        rendering = (parameters.get('rendering', 'sync'), parameters.get('rendering_jobs', 1), parameters.get('maps_compression', True))
+        if rendering not in renderers:
+            renderers[rendering] = Renderer(*rendering) # maps rendered in background while the next subjects are computed
+        renderer = renderers[rendering]
+        logs.validate()
+
+        logs.info("Defining Pipeline flow...")
+        tasks = define_tasks(splitter, compressor, transformer, encoding_model, executor,
+                                kwargs_splitter, kwargs_compression, kwargs_transformation, kwargs_encoding_model)
+        shared_outputs = SharedOutputs([tasks[name] for name in SHARED_TASKS])
+        logs.validate()
+
+        logs.info("Fetching and preprocessing stimuli representations...")
+        stimuli_representations_paths, _ = fetch_data(parameters['path_to_fmridata'], input_path,
+                                                        subjects[0], language, parameters['models'])
+        stimuli_representations = transformer.process_representations(stimuli_representations_paths, parameters['models'])
+        logs.validate()
+
+        for start in range(0, len(subjects), args.joint_size):
+            group = subjects[start:start + args.joint_size]
+            output_paths = [get_output_name(output_path_, language, subject, parameters['model_name']) for subject in group]
+            loggers = [Logger(get_output_name(output_path_, language, subject, parameters['model_name'], 'logs.txt')) for subject in group]
+            logs = loggers[0] # the computations of the group are logged with its first subject
+            for subject, output_path in zip(group, output_paths):
+                save_yaml(dict(parameters, subject=int(subject.split('-')[-1])), output_path + 'config.yml')
+            try:
+                logs.info("Fetching and preprocessing fMRI data of {}...".format(', '.join(group)))
+                fMRI_data = [transformer.process_fmri_data(fetch_data(parameters['path_to_fmridata'], input_path, subject, language)[1], masker) for subject in group]
+                fMRI_data, sizes = stack_subjects(fMRI_data)
+                logs.validate()
+
+                logs.info("Executing pipeline...", end='\n')
+                checkpointer = Checkpointer(os.path.join(os.path.dirname(output_paths[0]), 'checkpoints'), code_version=get_code_version()) if parameters.get('checkpoint', False) else None
+                profiler = Profiler(get_output_name(output_path_, language, group[0], parameters['model_name'], 'trace.jsonl'), 
+                                        profile_task=parameters.get('profile_task')) if parameters.get('profile', False) else None
+                bounds = np.cumsum([0] + sizes)
+                results_stores = [ResultsStore(get_output_name(output_path_, language, subject, parameters['model_name'], 'results.hdf5'), subject, parameters['model_name'], 
+                                                voxels=slice(bounds[index], bounds[index + 1]), compression=parameters.get('results_compression', 'gzip'), 
+                                                chunk_size=parameters.get('results_chunk_size', 4096)) for index, subject in enumerate(group)] if parameters.get('results_store', False) else None
+                pipeline = Pipeline(scheduler=parameters.get('scheduler', 'dataflow'), checkpointer=checkpointer, shared_outputs=shared_outputs, profiler=profiler, results_stores=results_stores)
+                pipeline.fit(tasks['splitter_cv_external'], logs) # retrieve the flow from children and input_dependencies
+                maps = pipeline.compute(stimuli_representations, fMRI_data, output_paths[0], logger=logs)
+                del fMRI_data
+                if results_stores is not None:
+                    maps = [results_store.get_means() for results_store in results_stores] # averaged while the folds were written
+                    pipeline.clear_outputs()
+                else:
+                    maps = split_subjects(maps, sizes)
+
+                for subject, subject_maps, subject_logs in zip(group, maps, loggers):
+                    save_maps(subject_maps, masker, output_path_, language, subject, parameters['model_name'], subject_logs, 
+                                renderer=renderer, mask_path=parameters['masker_path'] + '.nii.gz')
+            except Exception as err:
+                logs.exception(err) # the other subjects are still computed
+
+            for subject in group:
+                print("Model: {} for subject: {} --> Done".format(parameters['model_name'], subject))
+
+    for renderer in renderers.values():
+        renderer.close() # wait for the maps rendered in background
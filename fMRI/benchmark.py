@@ -0,0 +1,244 @@
+"""
+Benchmark of the pipeline stages on synthetic data.
+===================================================
+The synthetic data reproduces the layout of the real data (see template.yml), in a
+given folder:
+    - 'onsets-offsets/<offset_type>_run<index>.csv': word onsets/offsets of each run, whose
+    duration follows the run lengths of get_nscans,
+    - 'durations/<duration_type>_run<index>.csv': word durations,
+    - 'stimuli-representations/<language>/<model_name>/activations_run<index>.csv':
+    representations of configurable width (one row per word), optionally converted to the
+    binary store (see feature_store.py),
+    - 'fMRI/<language>/sub-001/func/fMRI_masked_run<index>.npy': masked fMRI data
+    (time x voxels),
+    - 'benchmark.yml': the parameters of the pipeline, read as a yaml file by the
+    get_*_information functions of utils.py.
+
+Each stage is run on the first fold of the outer cross-validation: Splitter.split,
+Compressor.compress, Transformer.make_regressor / standardize, EncodingModel.grid_search /
+evaluate, and then a full Pipeline.compute. Times are the minimum over the repetitions,
+peak memories (tracemalloc, including numpy allocations) come from an additional traced run.
+The results (and the code version) are written to a json file, and compared to a
+previous result file if given.
+
+Usage:
+    python benchmark.py --folder <path_to_synthetic_data> --output <path_to_json> [--baseline <path_to_json>]
+"""
+
+
+
+import os
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+import sklearn
+
+from utils import check_folder, read_yaml, save_yaml, get_nscans, get_subject_name, fetch_data, get_code_version
+from utils import get_splitter_information, get_compression_information, get_data_transformation_information, get_encoding_model_information
+from feature_store import convert_csv
+from executors import get_executor
+from logger import Logger, install_exit_handlers
+from regression_pipeline import Pipeline
+from encoding_models import EncodingModel
+from splitter import Splitter
+from data_transformation import Transformer
+from data_compression import Compressor
+from main import define_tasks
+
+
+
+def generate_data(folder, widths, nb_voxels=10000, language='english', tr=2., words_per_second=3., data_compression=None, ncomponents=None, store=False, seed=1111, dtype='float64'):
+    """ Write a synthetic dataset and the parameters to analyze it.
+    Arguments:
+        - folder: str
+        - widths: list (of int), number of features of each model
+        - nb_voxels: int
+        - language: str
+        - tr: float
+        - words_per_second: float
+        - data_compression: str (applied to the models wider than ncomponents)
+        - ncomponents: int
+        - store: bool (convert the representations to the binary store)
+        - seed: int
+        - dtype: str
+    Returns:
+        - parameters: dict
+    """
+    rng = np.random.RandomState(seed)
+    nscans = get_nscans(language)
+    offset_path = os.path.join(folder, 'onsets-offsets')
+    input_path = os.path.join(folder, 'stimuli-representations')
+    fmri_path = os.path.join(folder, 'fMRI', language, get_subject_name(1), 'func')
+    for path in [offset_path, os.path.join(folder, 'durations'), fmri_path]:
+        check_folder(path)
+    models = [{'model_name': 'synthetic_{}'.format(index),
+                'columns_to_retrieve': "['feature-{{}}'.format(i) for i in range({})]".format(width),
+                'input_template': 'activations',
+                'surname': 'synthetic_{}'.format(index),
+                'data_compression': data_compression if (data_compression and ncomponents and width > ncomponents) else None,
+                'ncomponents': ncomponents if (data_compression and ncomponents and width > ncomponents) else None,
+                'offset_type': 'word',
+                'duration_type': 'word',
+                'shift_surprisal': False} for index, width in enumerate(widths)]
+    for run_index, run in enumerate(sorted(nscans, key=lambda run: int(run.replace('run', ''))), start=1):
+        run_duration = nscans[run] * tr
+        nb_words = int(run_duration * words_per_second)
+        onsets = np.sort(rng.uniform(0, run_duration - 10 * tr, nb_words)) # the hrf of the last words is within the run
+        durations = rng.uniform(0.1, 0.5, nb_words)
+        pd.DataFrame({'onsets': onsets, 'offsets': onsets + durations}).to_csv(os.path.join(offset_path, 'word_run{}.csv'.format(run_index)), index=False)
+        pd.DataFrame({'durations': durations}).to_csv(os.path.join(folder, 'durations', 'word_run{}.csv'.format(run_index)), index=False)
+        for model, width in zip(models, widths):
+            check_folder(os.path.join(input_path, language, model['model_name']))
+            path = os.path.join(input_path, language, model['model_name'], 'activations_run{}.csv'.format(run_index))
+            pd.DataFrame(rng.randn(nb_words, width), columns=['feature-{}'.format(i) for i in range(width)]).to_csv(path, index=False)
+            if store:
+                convert_csv(path)
+        np.save(os.path.join(fmri_path, 'fMRI_masked_run{}.npy'.format(run_index)), rng.randn(nscans[run], nb_voxels).astype(dtype))
+    parameters = {'tr': tr, 'nb_runs': len(nscans), 'nb_runs_test': 1, 'language': language, 'hrf': 'spm',
+                    'parallel': False, 'n_jobs': 1, 'scheduler': 'dataflow', 'seed': seed, 'dtype': dtype,
+                    'alpha': None, 'alpha_min_log_scale': 2, 'alpha_max_log_scale': 5, 'nb_alphas': 10,
+                    'optimizing_criteria': 'R2', 'encoding_model': 'Ridge()', 'solver': 'svd',
+                    'offset_path': offset_path, 'duration_path': folder,
+                    'path_to_fmridata': os.path.join(folder, 'fMRI'), 'input': input_path,
+                    'output': os.path.join(folder, 'maps'), 'models': models, 'model_name': 'synthetic'}
+    save_yaml(parameters, os.path.join(folder, 'benchmark.yml'))
+    return parameters
+
+def measure(function, *args, repeat=1):
+    """ Time a function and trace its peak memory.
+    Arguments:
+        - function: function
+        - args: arguments of the function
+        - repeat: int (number of timed runs)
+    Returns:
+        - result: output of the function
+        - dict (time: seconds, peak_memory: MB)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {'time': min(times), 'peak_memory': peak / 1024 ** 2}
+
+def run_benchmark(parameters, repeat=1, mmap=False):
+    """ Benchmark each stage of the pipeline on the first outer fold,
+    and the whole pipeline.
+    Arguments:
+        - parameters: dict
+        - repeat: int
+        - mmap: bool (memory-map the masked fMRI data)
+    Returns:
+        - results: dict (of dict)
+        - data: dict (size of the data)
+    """
+    results = {}
+    kwargs_splitter = get_splitter_information(parameters)
+    kwargs_compression = get_compression_information(parameters)
+    kwargs_transformation = get_data_transformation_information(parameters)
+    kwargs_encoding_model = get_encoding_model_information(parameters)
+    splitter = Splitter(**kwargs_splitter)
+    compressor = Compressor(**kwargs_compression)
+    transformer = Transformer(**kwargs_transformation)
+    encoding_model = EncodingModel(**kwargs_encoding_model)
+
+    representations_paths, fMRI_paths = fetch_data(parameters['path_to_fmridata'], parameters['input'], get_subject_name(1),
+                                                    parameters['language'], parameters['models'])
+    X, results['process_representations'] = measure(transformer.process_representations, representations_paths, parameters['models'], repeat=repeat)
+    Y = [np.load(path, mmap_mode='r' if mmap else None) for path in fMRI_paths]
+    data = {'nb_runs': len(Y), 'nb_scans': sum(run.shape[0] for run in Y), 'nb_features': X[0].shape[1], 'nb_voxels': Y[0].shape[1]}
+
+    folds, results['split'] = measure(splitter.split, X, Y, repeat=repeat)
+    fold = folds[0]
+    compressed, results['compress'] = measure(compressor.compress, fold['X_train'], fold['X_test'], repeat=repeat)
+    regressors, results['make_regressor'] = measure(transformer.make_regressor, compressed['X_train'], compressed['X_test'], fold['run_train'], fold['run_test'], repeat=repeat)
+    regressors, results['standardize'] = measure(transformer.standardize, regressors['X_train'], regressors['X_test'], repeat=repeat)
+    grid, results['grid_search'] = measure(encoding_model.grid_search, regressors['X_train'], fold['Y_train'], regressors['X_test'], fold['Y_test'], repeat=repeat)
+    _, results['evaluate'] = measure(encoding_model.evaluate, regressors['X_train'], regressors['X_test'], fold['Y_train'], fold['Y_test'],
+                                        grid['R2'][np.newaxis], grid['Pearson_coeff'][np.newaxis], np.asarray(grid['alpha'])[np.newaxis], repeat=repeat)
+
+    output_path = os.path.join(parameters['output'], 'synthetic_')
+    check_folder(parameters['output'])
+    logs = Logger(os.path.join(parameters['output'], 'logs.txt'))
+    tasks = define_tasks(splitter, compressor, transformer, encoding_model, get_executor(parameters['parallel'], parameters.get('n_jobs')),
+                            kwargs_splitter, kwargs_compression, kwargs_transformation, kwargs_encoding_model)
+    pipeline = Pipeline(scheduler=parameters.get('scheduler', 'dataflow'))
+    pipeline.fit(tasks['splitter_cv_external'], logs)
+    _, results['pipeline'] = measure(pipeline.compute, X, Y, output_path, logs, repeat=repeat)
+    return results, data
+
+def compare(results, baseline):
+    """ Print the ratios between the results and a baseline.
+    Arguments:
+        - results: dict
+        - baseline: dict
+    """
+    print('{:<25} {:>12} {:>12} {:>12} {:>12}'.format('stage', 'time (s)', 'ratio', 'memory (MB)', 'ratio'))
+    for stage, values in results['results'].items():
+        reference = baseline['results'].get(stage)
+        ratios = [values[key] / reference[key] if (reference and reference[key]) else float('nan') for key in ['time', 'peak_memory']]
+        print('{:<25} {:>12.3f} {:>12.2f} {:>12.1f} {:>12.2f}'.format(stage, values['time'], ratios[0], values['peak_memory'], ratios[1]))
+
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description="""Benchmark the time and peak memory of each stage of the pipeline on synthetic data.""")
+    parser.add_argument("--folder", type=str, required=True,
+                            help="Folder of the synthetic data (generated if it does not contain a benchmark.yml file).")
+    parser.add_argument("--output", type=str, default='benchmark.json',
+                            help="Path to the json file of the results.")
+    parser.add_argument("--baseline", type=str, default=None,
+                            help="Path to a previous json file of results to compare with.")
+    parser.add_argument("--widths", type=int, nargs='+', default=[768, 1],
+                            help="Number of features of each synthetic model.")
+    parser.add_argument("--nb_voxels", type=int, default=10000,
+                            help="Number of voxels of the masked fMRI data.")
+    parser.add_argument("--language", type=str, default='english',
+                            help="Language whose run lengths are used.")
+    parser.add_argument("--data_compression", type=str, default=None,
+                            help="Compression of the models wider than ncomponents (pca / randomized_pca / incremental_pca).")
+    parser.add_argument("--ncomponents", type=int, default=None,
+                            help="Number of components kept by the compression.")
+    parser.add_argument("--store", action='store_true',
+                            help="Convert the representations to the binary store.")
+    parser.add_argument("--dtype", type=str, default='float64',
+                            help="Floating point precision of the data.")
+    parser.add_argument("--mmap", action='store_true',
+                            help="Memory-map the masked fMRI data.")
+    parser.add_argument("--repeat", type=int, default=1,
+                            help="Number of timed runs of each stage.")
+
+    args = parser.parse_args()
+    install_exit_handlers() # flush the logs when the job ends or is killed
+    if os.path.exists(os.path.join(args.folder, 'benchmark.yml')):
+        parameters = read_yaml(os.path.join(args.folder, 'benchmark.yml'))
+    else:
+        print('Generating synthetic data in {}...'.format(args.folder))
+        parameters = generate_data(args.folder, args.widths, nb_voxels=args.nb_voxels, language=args.language,
+                                    data_compression=args.data_compression, ncomponents=args.ncomponents, store=args.store, dtype=args.dtype)
+    stages, data = run_benchmark(parameters, repeat=args.repeat, mmap=args.mmap)
+    results = {'code_version': get_code_version(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'sklearn': sklearn.__version__,
+                                'machine': platform.machine(), 'cpu_count': os.cpu_count()},
+                'config': {'repeat': args.repeat, 'mmap': args.mmap, 'parameters': parameters},
+                'data': data,
+                'results': stages}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            compare(results, json.load(f))
+    else:
+        compare(results, {'results': {}})
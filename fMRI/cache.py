@@ -0,0 +1,206 @@
+"""
+Content-addressed cache of numpy arrays, kept in memory with an optional on-disk store.
+===================================================
+An ArrayCache instanciation requires:
+    - max_memory: float, maximum size (in MB) of the arrays kept in memory,
+    - path: string (or None), folder where the arrays are also saved as .npy files so
+    that later jobs can reuse them,
+    - max_disk: float (or None), maximum size (in MB) of the on-disk store,
+    - mmap_mode: string (or None), if specified the on-disk arrays are opened memory-mapped
+    with this mode (e.g. 'r') instead of being read in memory.
+
+Keys are computed with hash_key from the content of the objects the arrays depend on
+(numpy arrays are hashed through their bytes), so that two identical computations
+share the same entry.
+When a store exceeds its size, the least recently used entries are evicted.
+"""
+
+
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+
+
+def hash_key(*items):
+    """ Compute a content hash from a list of objects.
+    Arguments:
+        - items: np.array / list / tuple / dict / str / int / float / None
+    Returns:
+        - str
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            array = np.ascontiguousarray(item)
+            sha.update(str((array.dtype.str, array.shape)).encode())
+            sha.update(array.view(np.uint8) if array.size else b'')
+        elif isinstance(item, (list, tuple)):
+            sha.update('{}:{}'.format(type(item).__name__, len(item)).encode())
+            sha.update(hash_key(*item).encode())
+        elif isinstance(item, dict):
+            sha.update(hash_key(*[(str(key), item[key]) for key in sorted(item, key=str)]).encode())
+        else:
+            sha.update(json.dumps(item, default=str).encode())
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+
+class ArrayCache(object):
+    """ Least recently used cache of numpy arrays, in memory
+    and optionally on disk.
+    """
+
+    def __init__(self, max_memory=1024, path=None, max_disk=None, mmap_mode=None):
+        """ Instanciation of ArrayCache class.
+        Arguments:
+            - max_memory: float (MB)
+            - path: str
+            - max_disk: float (MB)
+            - mmap_mode: str
+        """
+        self.max_memory = max_memory * 1024 ** 2 if max_memory else 0
+        self.max_disk = max_disk * 1024 ** 2 if max_disk else None
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def __getstate__(self):
+        """ Locks cannot be pickled (process executors): only the
+        configuration of the cache is sent to other processes.
+        """
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        state['memory_size'] = 0
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def get_path(self, key):
+        """ Path of the on-disk entry of a key.
+        Arguments:
+            - key: str
+        Returns:
+            - str
+        """
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """ Retrieve the array stored under a key.
+        Arguments:
+            - key: str
+        Returns:
+            - np.array (or None if the key is not cached)
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        if self.path is not None and os.path.exists(self.get_path(key)):
+            try:
+                array = np.load(self.get_path(key), mmap_mode=self.mmap_mode)
+                os.utime(self.get_path(key)) # mark as recently used for disk eviction
+            except (IOError, OSError, ValueError):
+                array = None
+            if array is not None:
+                self.add_to_memory(key, array)
+                with self.lock:
+                    self.hits += 1
+                return array
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, array):
+        """ Store an array under a key.
+        Arguments:
+            - key: str
+            - array: np.array
+        """
+        self.add_to_memory(key, array)
+        if self.path is not None and not os.path.exists(self.get_path(key)):
+            tmp_path = self.get_path(key) + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, self.get_path(key)) # atomic: concurrent jobs never read partial files
+            self.evict_disk()
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """ Retrieve the array stored under a key, computing and
+        storing it if needed.
+        Arguments:
+            - key: str
+            - func: function returning a np.array
+        Returns:
+            - np.array
+        """
+        array = self.get(key)
+        if array is None:
+            array = func(*args, **kwargs)
+            self.set(key, array)
+        return array
+
+    def add_to_memory(self, key, array):
+        """ Add an array to the in-memory store and evict the least
+        recently used arrays if the store is too big.
+        Arguments:
+            - key: str
+            - array: np.array
+        """
+        if array.nbytes > self.max_memory:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.memory[key] = array
+            self.memory_size += array.nbytes
+            while self.memory_size > self.max_memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= evicted.nbytes
+
+    def evict_disk(self):
+        """ Remove the least recently used files of the on-disk store
+        until it fits in self.max_disk.
+        """
+        if self.max_disk is None:
+            return
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    pass
+        total = sum(item[1] for item in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """ Empty the in-memory store."""
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memory_size = 0
@@ -0,0 +1,311 @@
+"""
+Checkpointing of the outputs of the tasks of a pipeline, item (fold) by item.
+===================================================
+A Checkpointer instanciation requires:
+    - path: string, folder where the checkpoints are saved,
+    - code_version: string identifying the version of the code (see utils.get_code_version).
+
+Each task is identified by a content hash of:
+    - its name and its configuration (Task.config: the arguments of the class
+    instanciations it relies on),
+    - the identifiers of its parent tasks (recursively), down to the pipeline input
+    whose identity is a hash of the input data,
+    - the code version.
+The output of each item of a task is saved as soon as it is computed, and a task is
+marked as complete when all its items are saved. The run stores of the pipeline input
+(see splitter.RunStore and self.set_stores) are saved by name only: the fold views of the
+splitter tasks are saved as their run indexes, and reattached to the live input stores
+when they are loaded. When a pipeline is run again with the
+same configuration, data and code, completed items and tasks are loaded instead of
+being recomputed.
+"""
+
+
+
+import os
+import pickle
+
+from cache import hash_key
+from splitter import RunStore
+
+
+
+class StorePickler(pickle.Pickler):
+    """ Pickler saving the named run stores by reference."""
+
+    def __init__(self, file, stores):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.stores = stores
+
+    def persistent_id(self, obj):
+        if isinstance(obj, RunStore) and (obj.key is not None) and (self.stores.get(obj.key) is obj):
+            return obj.key
+        return None
+
+
+class StoreUnpickler(pickle.Unpickler):
+    """ Unpickler reattaching the references to the named run stores."""
+
+    def __init__(self, file, stores):
+        super().__init__(file)
+        self.stores = stores
+
+    def persistent_load(self, key):
+        if key not in self.stores:
+            raise pickle.UnpicklingError('Run store {} not available.'.format(key))
+        return self.stores[key]
+
+
+
+class Checkpointer(object):
+    """ Save and reload the item outputs of the tasks.
+    """
+
+    def __init__(self, path, code_version=None):
+        """ Instanciation of Checkpointer class.
+        Arguments:
+            - path: str
+            - code_version: str
+        """
+        self.path = path
+        self.code_version = code_version
+        self.input_key = None
+        self.keys = {}
+        self.stores = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def set_input(self, data_key):
+        """ Set the identity of the input data of the pipeline.
+        Arguments:
+            - data_key: str
+        """
+        self.input_key = data_key
+        self.keys = {}
+
+    def set_stores(self, stores):
+        """ Set the run stores holding the input of the pipeline.
+        Arguments:
+            - stores: list (of RunStore)
+        """
+        self.stores = {store.key: store for store in stores}
+
+    def get_key(self, task):
+        """ Compute the identifier of a task.
+        Arguments:
+            - task: Task
+        Returns:
+            - str
+        """
+        if task not in self.keys:
+            if task.is_static():
+                self.keys[task] = hash_key('input', self.input_key)
+            else:
+                self.keys[task] = hash_key(task.name, task.config, task.flatten, task.unflatten, self.code_version,
+                                            [self.get_key(parent) for parent in task.get_input_dependencies()])
+        return self.keys[task]
+
+    def get_folder(self, task):
+        """ Folder of the checkpoints of a task.
+        Arguments:
+            - task: Task
+        Returns:
+            - str
+        """
+        folder = os.path.join(self.path, '{}_{}'.format(task.name, self.get_key(task)[:16]))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def dump(self, data, path):
+        """ Write an object atomically.
+        Arguments:
+            - data: object
+            - path: str
+        """
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            StorePickler(f, self.stores).dump(data)
+        os.replace(tmp_path, path)
+
+    def has_item(self, task, index):
+        """ Check if the output of an item was saved.
+        Arguments:
+            - task: Task
+            - index: int
+        Returns:
+            - bool
+        """
+        return os.path.exists(os.path.join(self.get_folder(task), 'item_{}.pkl'.format(index)))
+
+    def save_item(self, task, index, output):
+        """ Save the output of an item.
+        Arguments:
+            - task: Task
+            - index: int
+            - output: dict / list
+        """
+        self.dump(output, os.path.join(self.get_folder(task), 'item_{}.pkl'.format(index)))
+
+    def load_item(self, task, index):
+        """ Load the output of an item.
+        Arguments:
+            - task: Task
+            - index: int
+        Returns:
+            - dict / list
+        """
+        with open(os.path.join(self.get_folder(task), 'item_{}.pkl'.format(index)), 'rb') as f:
+            return StoreUnpickler(f, self.stores).load()
+
+    def is_complete(self, task):
+        """ Check if all the items of a task were saved.
+        Arguments:
+            - task: Task
+        Returns:
+            - bool
+        """
+        return os.path.exists(os.path.join(self.get_folder(task), 'complete.pkl'))
+
+    def mark_complete(self, task, nb_items, unflatten_factor=None):
+        """ Mark a task as complete.
+        Arguments:
+            - task: Task
+            - nb_items: int
+            - unflatten_factor: int
+        """
+        self.dump({'nb_items': nb_items, 'unflatten_factor': unflatten_factor}, os.path.join(self.get_folder(task), 'complete.pkl'))
+
+    def load_complete(self, task):
+        """ Load the information of a complete task.
+        Arguments:
+            - task: Task
+        Returns:
+            - dict
+        """
+        with open(os.path.join(self.get_folder(task), 'complete.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+
+
+class SharedOutputs(object):
+    """ Keep in memory the item outputs of the tasks that do not depend 
+    on the fMRI data (e.g. compression and design-matrices), so that they 
+    are computed once for all the subjects sharing the same stimuli.
+    It exposes the interface of a Checkpointer, to which the other tasks 
+    (and the saving of the shared tasks) are delegated.
+    """
+
+    def __init__(self, tasks, checkpointer=None):
+        """ Instanciation of SharedOutputs class.
+        Arguments:
+            - tasks: list (of Task)
+            - checkpointer: Checkpointer
+        """
+        self.tasks = tasks
+        self.checkpointer = checkpointer
+        self.shared_key = None
+        self.items = {task: {} for task in tasks}
+        self.complete = {}
+
+    def set_checkpointer(self, checkpointer):
+        """ Set self.checkpointer value."""
+        self.checkpointer = checkpointer
+
+    def set_shared_input(self, data_key):
+        """ Set the identity of the part of the input the shared tasks depend
+        on: the outputs kept in memory are dropped when it changes.
+        Arguments:
+            - data_key: str
+        """
+        if data_key != self.shared_key:
+            self.shared_key = data_key
+            self.items = {task: {} for task in self.tasks}
+            self.complete = {}
+
+    def set_input(self, data_key):
+        """ Set the identity of the input data of the pipeline.
+        Arguments:
+            - data_key: str
+        """
+        if self.checkpointer is not None:
+            self.checkpointer.set_input(data_key)
+
+    def set_stores(self, stores):
+        """ Set the run stores holding the input of the pipeline.
+        Arguments:
+            - stores: list (of RunStore)
+        """
+        if self.checkpointer is not None:
+            self.checkpointer.set_stores(stores)
+
+    def has_item(self, task, index):
+        """ Check if the output of an item is available.
+        Arguments:
+            - task: Task
+            - index: int
+        Returns:
+            - bool
+        """
+        if task in self.items and index in self.items[task]:
+            return True
+        return (self.checkpointer is not None) and self.checkpointer.has_item(task, index)
+
+    def save_item(self, task, index, output):
+        """ Save the output of an item.
+        Arguments:
+            - task: Task
+            - index: int
+            - output: dict / list
+        """
+        if task in self.items:
+            self.items[task][index] = output
+        if self.checkpointer is not None:
+            self.checkpointer.save_item(task, index, output)
+
+    def load_item(self, task, index):
+        """ Load the output of an item.
+        Arguments:
+            - task: Task
+            - index: int
+        Returns:
+            - dict / list
+        """
+        if task in self.items and index in self.items[task]:
+            return self.items[task][index]
+        output = self.checkpointer.load_item(task, index)
+        if task in self.items:
+            self.items[task][index] = output
+        return output
+
+    def is_complete(self, task):
+        """ Check if all the items of a task are available.
+        Arguments:
+            - task: Task
+        Returns:
+            - bool
+        """
+        if task in self.complete:
+            return True
+        return (self.checkpointer is not None) and self.checkpointer.is_complete(task)
+
+    def mark_complete(self, task, nb_items, unflatten_factor=None):
+        """ Mark a task as complete.
+        Arguments:
+            - task: Task
+            - nb_items: int
+            - unflatten_factor: int
+        """
+        if task in self.items:
+            self.complete[task] = {'nb_items': nb_items, 'unflatten_factor': unflatten_factor}
+        if self.checkpointer is not None:
+            self.checkpointer.mark_complete(task, nb_items, unflatten_factor)
+
+    def load_complete(self, task):
+        """ Load the information of a complete task.
+        Arguments:
+            - task: Task
+        Returns:
+            - dict
+        """
+        if task in self.complete:
+            return self.complete[task]
+        return self.checkpointer.load_complete(task)
@@ -0,0 +1,163 @@
+"""
+Batched convolution of stimuli-representations with an hrf kernel.
+===================================================
+A ConvolutionEngine instanciation requires:
+    - tr: float, repetition time of the fMRI image acquisition,
+    - hrf: string specifying the hemodynamic response function (any nistats hrf model
+    except 'fir'),
+    - oversampling: int, oversampling of the signal before convolution,
+    - min_onset: float, events starting before min_onset (in seconds) are not considered,
+    - operators_memory: float, maximum size (in MB) of the operators kept in memory.
+
+All the columns of a run share the same onsets and durations: the nistats pipeline
+(event sampling on an oversampled grid, convolution with the hrf, linear interpolation
+at frame times) is therefore a linear operator of shape (nscans x nevents), applied to
+the (nevents x features) block of representations.
+This operator is built once for each timing (onsets, durations, nscans), kept in a
+least recently used cache (see cache.ArrayCache), and the
+regressors of all the columns are obtained with one matrix product per hrf kernel.
+The output matches nistats compute_regressor column by column: for each feature, the
+main regressor followed by its (orthogonalized) derivatives.
+"""
+
+
+
+import numpy as np
+
+from nistats.hemodynamic_models import _hrf_kernel
+
+from cache import ArrayCache, hash_key
+
+
+
+class ConvolutionEngine(object):
+    """ Convolve whole blocks of features with an hrf kernel
+    through a precomputed sampling operator.
+    """
+
+    def __init__(self, tr, hrf='spm', oversampling=10, min_onset=-24, operators_memory=256):
+        """ Instanciation of ConvolutionEngine class.
+        Arguments:
+            - tr: float
+            - hrf: str
+            - oversampling: int
+            - min_onset: float
+            - operators_memory: float (MB)
+        """
+        if hrf=='fir':
+            raise Exception('FIR models are not supported by the ConvolutionEngine.')
+        self.tr = tr
+        self.hrf = hrf
+        self.oversampling = int(oversampling)
+        self.min_onset = float(min_onset)
+        self.operators = ArrayCache(operators_memory)
+
+    def get_frame_times(self, nscans):
+        """ Compute the acquisition times of a run.
+        Arguments:
+            - nscans: int
+        Returns:
+            - np.array
+        """
+        return np.arange(0.0, nscans * self.tr, self.tr)
+
+    def get_operator(self, onsets, durations, nscans, frame_times=None):
+        """ Retrieve (or build) the operator mapping the amplitudes of the
+        events to the regressors sampled at frame times.
+        Arguments:
+            - onsets: np.array
+            - durations: np.array
+            - nscans: int
+            - frame_times: np.array
+        Returns:
+            - np.array (3D: kernels x nscans x nevents)
+        """
+        key = hash_key(onsets, durations, nscans, self.tr, self.hrf, self.oversampling, self.min_onset)
+        frame_times = self.get_frame_times(nscans) if frame_times is None else frame_times
+        return self.operators.get_or_compute(key, self.build_operator, onsets, durations, frame_times)
+
+    def build_operator(self, onsets, durations, frame_times):
+        """ Build the sampling operator, following the steps of
+        nistats compute_regressor.
+        Arguments:
+            - onsets: np.array
+            - durations: np.array
+            - frame_times: np.array
+        Returns:
+            - operator: np.array (3D: kernels x nscans x nevents)
+        """
+        onsets = np.asarray(onsets, dtype=float).ravel()
+        durations = np.asarray(durations, dtype=float).ravel()
+        nevents = onsets.size
+        # high resolution frame times (as in nistats _sample_condition)
+        n = frame_times.size
+        n_hr = ((n - 1) * 1. / (frame_times.max() - frame_times.min())
+                * (frame_times.max() * (1 + 1. / (n - 1)) - frame_times.min()
+                   - self.min_onset) * self.oversampling) + 1
+        hr_frame_times = np.linspace(frame_times.min() + self.min_onset,
+                                     frame_times.max() * (1 + 1. / (n - 1)),
+                                     int(np.rint(n_hr)))
+        tmax = len(hr_frame_times)
+        t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), tmax - 1)
+        t_offset = np.minimum(np.searchsorted(hr_frame_times, onsets + durations), tmax - 1)
+        t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
+        # with fancy indexing, only the last event of a given time sample is kept
+        onset_times, onset_events = self.last_occurrences(t_onset)
+        offset_times, offset_events = self.last_occurrences(t_offset)
+        # linear interpolation weights at frame times (as in scipy interp1d)
+        upper = np.clip(np.searchsorted(hr_frame_times, frame_times), 1, tmax - 1)
+        lower = upper - 1
+        weights = (frame_times - hr_frame_times[lower]) / (hr_frame_times[upper] - hr_frame_times[lower])
+        # the convolution of the cumulated events equals the events convolved with the cumulated kernel
+        tr = float(frame_times.max()) / (np.size(frame_times) - 1)
+        kernels = _hrf_kernel(self.hrf, tr, self.oversampling)
+        operator = np.zeros((len(kernels), n, nevents))
+        for index, kernel in enumerate(kernels):
+            cumulated = np.concatenate(([0.], np.cumsum(kernel)))
+            for times, events, sign in [(onset_times, onset_events, 1.), (offset_times, offset_events, -1.)]:
+                lower_response = cumulated[np.clip(lower[:, None] - times[None, :] + 1, 0, len(cumulated) - 1)]
+                upper_response = cumulated[np.clip(upper[:, None] - times[None, :] + 1, 0, len(cumulated) - 1)]
+                operator[index][:, events] += sign * ((1 - weights)[:, None] * lower_response + weights[:, None] * upper_response)
+        return operator
+
+    def last_occurrences(self, times):
+        """ Retrieve the distinct time samples and, for each of them,
+        the index of the last event falling on it.
+        Arguments:
+            - times: np.array (of int)
+        Returns:
+            - unique_times: np.array
+            - events: np.array
+        """
+        unique_times, reversed_indexes = np.unique(times[::-1], return_index=True)
+        events = times.size - 1 - reversed_indexes
+        return unique_times, events
+
+    def convolve(self, values, onsets, durations, nscans, frame_times=None):
+        """ Compute the regressors of all the columns of a block of features.
+        Arguments:
+            - values: np.array (2D: nevents x features)
+            - onsets: np.array
+            - durations: np.array
+            - nscans: int
+            - frame_times: np.array
+        Returns:
+            - out: np.array (2D: nscans x (features * kernels))
+        """
+        values = np.asarray(values, dtype=float)
+        operator = self.get_operator(onsets, durations, nscans, frame_times=frame_times)
+        nb_kernels = operator.shape[0]
+        if nb_kernels==1:
+            return np.dot(operator[0], values)
+        regressors = [np.dot(kernel_operator, values) for kernel_operator in operator]
+        # orthogonalize each derivative with respect to the preceding regressors (as in nistats)
+        for i in range(1, nb_kernels):
+            for j in range(i):
+                norm = np.sum(regressors[j] ** 2, axis=0)
+                projection = np.zeros(norm.shape)
+                np.divide(np.sum(regressors[i] * regressors[j], axis=0), norm, out=projection, where=norm!=0)
+                regressors[i] -= projection * regressors[j]
+        out = np.empty((operator.shape[1], values.shape[1], nb_kernels))
+        for i in range(nb_kernels):
+            out[:, :, i] = regressors[i]
+        return out.reshape((operator.shape[1], values.shape[1] * nb_kernels))
@@ -7,18 +7,29 @@ A Compressor instanciation requires:
     - indexes: list of numpy arrays listing the columns indexes for each model to retrieve the right
     columns when compressing specific model representations,
     - compression_types: list of string regrouping the specific data reduction methods to apply to 
-    each model representations.
+    each model representations ('identity', 'pca', 'randomized_pca', 'incremental_pca'),
+    - cache_size: float, size (in MB) of the in-memory cache of fitted projections,
+    - cache_path: string (or None), folder of the on-disk cache of fitted projections,
+    - random_state: int (or None), seed of the randomized methods,
+    - dtype: string, floating point precision of the compressed data (the projections are
+    fitted in float64).
 This class allows to compress differently specific parts of a list of matrices.
+The PCA methods fit a projection (mean and components) on the training runs, which is
+cached under a hash of the training data, the method and the number of components: folds
+sharing the same training runs (e.g. the inner folds of different outer folds) fit it once.
+The 'randomized_pca' and 'incremental_pca' methods process the runs one by one, without
+concatenating them.
 """
 
 
 
 import numpy as np
-import pandas as pd
 
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils.extmath import svd_flip
 
-from utils import clean_nan_rows
+from utils import clean_nan_rows, hstack_padded
+from cache import ArrayCache, hash_key
 
 
 
@@ -26,22 +37,23 @@ class Compressor(object):
     """ Perform data compression over lists of numpy arrays.
     """
     
-    def __init__(self, n_components_list, indexes, compression_types):
+    def __init__(self, n_components_list, indexes, compression_types, cache_size=0, cache_path=None, random_state=None, dtype='float64'):
         """ Instanciation of the class Compressor.
         Arguments:
             - n_components_list: list (of list)
             - indexes: list (of list)
             - compression_types: list (of str)
+            - cache_size: float
+            - cache_path: str
+            - random_state: int
+            - dtype: str
         """
         self.ncomponents_list = n_components_list
         self.indexes = indexes
         self.compression_types = compression_types
-        self.bucket = []
-        pass
-        
-    def clean_bucket(self):
-        """ Clean instance bucket."""
-        self.bucket = []
+        self.random_state = random_state
+        self.dtype = np.dtype(dtype)
+        self.cache = ArrayCache(cache_size, cache_path) if (cache_size or cache_path) else None
     
     def identity(self, X_train, X_test, n_components=None):
         """ Identity function.
@@ -52,6 +64,25 @@ class Compressor(object):
         """
         return {'X_train': X_train, 'X_test': X_test}
 
+    def project(self, method, X_train, X_test, n_components):
+        """ Fit a projection on the training runs (or retrieve it from
+        self.cache) and apply it to all runs.
+        Arguments:
+            - method: function returning a projection (mean and components stacked)
+            - X_train: list
+            - X_test: list
+            - n_components: int
+        """
+        if self.cache is None:
+            projection = method(X_train, n_components)
+        else:
+            key = hash_key(method.__name__, n_components, self.random_state, X_train)
+            projection = self.cache.get_or_compute(key, method, X_train, n_components)
+        mean, components = projection[0].astype(self.dtype), projection[1:].astype(self.dtype)
+        X_train_ = [np.dot(matrix.astype(self.dtype, copy=False) - mean, components.T) for matrix in X_train]
+        X_test_ = [np.dot(matrix.astype(self.dtype, copy=False) - mean, components.T) for matrix in X_test]
+        return {'X_train': X_train_, 'X_test': X_test_}
+
     def pca(self, X_train, X_test, n_components):
         """ Classical PCA train on the concatenated set
         of matrices given in X_train.
@@ -60,19 +91,101 @@ class Compressor(object):
             - X_test: list
             - n_components: int
         """
-        X_lengths = [m.shape[0] for m in X_train]
-        X_all = np.vstack(X_train)
+        return self.project(self.fit_pca, X_train, X_test, n_components)
+
+    def randomized_pca(self, X_train, X_test, n_components):
+        """ Randomized PCA train on the set of matrices given 
+        in X_train, processed one by one.
+        Arguments:
+            - X_train: list
+            - X_test: list
+            - n_components: int
+        """
+        return self.project(self.fit_randomized_pca, X_train, X_test, n_components)
+
+    def incremental_pca(self, X_train, X_test, n_components):
+        """ Incremental PCA train on the set of matrices given 
+        in X_train, processed one by one.
+        Arguments:
+            - X_train: list
+            - X_test: list
+            - n_components: int
+        """
+        return self.project(self.fit_incremental_pca, X_train, X_test, n_components)
+
+    def fit_pca(self, X_train, n_components):
+        """ Fit a PCA on the concatenated matrices.
+        Arguments:
+            - X_train: list
+            - n_components: int
+        Returns:
+            - np.array (mean and components stacked)
+        """
         pca = PCA(n_components=n_components)
-        pca.fit(X_all)
-        index = 0
-        X_train_ = []
-        X_test_ = []
-        for i in X_lengths:
-            X_train_.append(pca.transform(X_all[index:index+i,:]))
-            index += i
-        for matrix in X_test:
-            X_test_.append(pca.transform(matrix))
-        return {'X_train': X_train_, 'X_test': X_test_}
+        pca.fit(np.vstack(X_train).astype(np.float64, copy=False))
+        return np.vstack([pca.mean_, pca.components_])
+
+    def fit_randomized_pca(self, X_train, n_components, n_oversamples=10, n_iter=4):
+        """ Fit a PCA with the randomized range finder of Halko et al. (as sklearn 
+        randomized_svd), on the implicit concatenation of the (centered) matrices:
+        each product with the concatenated matrix is computed run by run.
+        Arguments:
+            - X_train: list
+            - n_components: int
+            - n_oversamples: int
+            - n_iter: int
+        Returns:
+            - np.array (mean and components stacked)
+        """
+        nb_rows = sum(matrix.shape[0] for matrix in X_train)
+        mean = sum(np.sum(matrix, axis=0, dtype=np.float64) for matrix in X_train) / nb_rows
+        rng = np.random.RandomState(self.random_state)
+        Q = rng.normal(size=(X_train[0].shape[1], n_components + n_oversamples))
+        for _ in range(n_iter):
+            Q, _ = np.linalg.qr(np.vstack([np.dot(matrix - mean, Q) for matrix in X_train])) # (rows x k)
+            Q, _ = np.linalg.qr(self.dot_transposed(X_train, mean, Q)) # (features x k)
+        Q, _ = np.linalg.qr(np.vstack([np.dot(matrix - mean, Q) for matrix in X_train]))
+        B = self.dot_transposed(X_train, mean, Q).T # Q.T (X - mean)
+        Uhat, _, Vt = np.linalg.svd(B, full_matrices=False)
+        U, Vt = svd_flip(np.dot(Q, Uhat), Vt)
+        return np.vstack([mean, Vt[:n_components]])
+
+    def fit_incremental_pca(self, X_train, n_components):
+        """ Fit an incremental PCA, run by run (runs are grouped
+        when they have less rows than n_components).
+        Arguments:
+            - X_train: list
+            - n_components: int
+        Returns:
+            - np.array (mean and components stacked)
+        """
+        pca = IncrementalPCA(n_components=n_components)
+        batch = []
+        for index, matrix in enumerate(X_train):
+            batch.append(matrix)
+            remaining = sum(item.shape[0] for item in X_train[index + 1:])
+            if sum(item.shape[0] for item in batch) >= n_components and (remaining >= n_components or remaining==0):
+                pca.partial_fit(np.vstack(batch).astype(np.float64, copy=False))
+                batch = []
+        return np.vstack([pca.mean_, pca.components_])
+
+    def dot_transposed(self, X_train, mean, Q):
+        """ Compute (X - mean).T Q where X is the concatenation of the matrices
+        in X_train, and Q is split accordingly.
+        Arguments:
+            - X_train: list
+            - mean: np.array
+            - Q: np.array
+        Returns:
+            - np.array
+        """
+        result = np.zeros((X_train[0].shape[1], Q.shape[1]))
+        start = 0
+        for matrix in X_train:
+            stop = start + matrix.shape[0]
+            result += np.dot(matrix.T, Q[start:stop]) - np.outer(mean, np.sum(Q[start:stop], axis=0))
+            start = stop
+        return result
 
     def compress(self, X_train, X_test):
         """ Compress the data with different compression methods
@@ -81,13 +194,13 @@ class Compressor(object):
             - X_train: list
             - X_test: list
         """
+        bucket = [] # local bucket: compress can be called concurrently on several folds
         for index, indexes in enumerate(self.indexes):
             func = getattr(self, self.compression_types[index])
-            X_train_ = [clean_nan_rows(X[:,indexes]) for X in X_train]
-            X_test_ = [clean_nan_rows(X[:,indexes]) for X in X_test]
-            self.bucket.append(func(X_train_, X_test_, self.ncomponents_list[index]))
+            X_train_ = [clean_nan_rows(X, indexes) for X in X_train]
+            X_test_ = [clean_nan_rows(X, indexes) for X in X_test]
+            bucket.append(func(X_train_, X_test_, self.ncomponents_list[index]))
         
-        X_train = [pd.concat([pd.DataFrame(data['X_train'][run_index]) for data in self.bucket], axis=1).values for run_index in range(len(self.bucket[0]['X_train']))]
-        X_test = [pd.concat([pd.DataFrame(data['X_test'][run_index]) for data in self.bucket], axis=1).values for run_index in range(len(self.bucket[0]['X_test']))]
-        self.clean_bucket()
+        X_train = [hstack_padded([data['X_train'][run_index] for data in bucket]).astype(self.dtype, copy=False) for run_index in range(len(bucket[0]['X_train']))]
+        X_test = [hstack_padded([data['X_test'][run_index] for data in bucket]).astype(self.dtype, copy=False) for run_index in range(len(bucket[0]['X_test']))]
         return {'X_train': X_train, 'X_test': X_test}
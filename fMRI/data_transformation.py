@@ -14,7 +14,14 @@ A Transformer instanciation requires:
     be fitted to fMRI data,
     - oversampling: int, oversampling of the signal before convolution,
     - with_mean: bool specifying if we remove the mean from the data,
-    - with_std: bool specifying if we divide by the standard deviation the data.
+    - with_std: bool specifying if we divide by the standard deviation the data,
+    - cache_size: float, size (in MB) of the in-memory cache of convolved regressors,
+    - cache_path: string (or None), folder of the on-disk cache of convolved regressors,
+    - cache_disk_size: float (or None), maximum size (in MB) of the on-disk cache,
+    - fmri_cache_path: string (or None), folder of the on-disk store of masked fMRI data, opened
+    memory-mapped by later jobs (the masked data only depends on the run and on the masker),
+    - fmri_slab_size: int, number of volumes read at once when masking the fMRI data,
+    - dtype: string, floating point precision of the representations, regressors and fMRI data.
 
 This class enables to perform a lots of transformations on a given dataset:
     - from loading and preprocessing with the process_* functions
@@ -32,7 +39,12 @@ import pandas as pd
 from sklearn.preprocessing import StandardScaler
 from nistats.hemodynamic_models import compute_regressor
 
-from utils import fetch_offsets, fetch_duration
+from timing import TimingStore
+from cache import ArrayCache, hash_key
+from convolution import ConvolutionEngine
+from masking import SlabMasker
+from feature_store import read_columns
+from utils import hstack_padded, clean_nan_rows
 
 
 
@@ -42,7 +54,7 @@ class Transformer(object):
     """
     
     
-    def __init__(self, tr, nscans, indexes, offset_type_dict, duration_type_dict, offset_path, duration_path, language, hrf='spm', oversampling=10, with_mean=True, with_std=True):
+    def __init__(self, tr, nscans, indexes, offset_type_dict, duration_type_dict, offset_path, duration_path, language, hrf='spm', oversampling=10, with_mean=True, with_std=True, cache_size=0, cache_path=None, cache_disk_size=None, fmri_cache_path=None, fmri_slab_size=50, dtype='float64'):
         """ Instanciation of Transformer class.
         Arguments:
             - tr: int
@@ -57,6 +69,12 @@ class Transformer(object):
             - oversampling: int
             - with_mean: bool
             - with_std: bool
+            - cache_size: float
+            - cache_path: str
+            - cache_disk_size: float
+            - fmri_cache_path: str
+            - fmri_slab_size: int
+            - dtype: str
         """
         self.tr = tr
         self.nscans = nscans
@@ -70,6 +88,14 @@ class Transformer(object):
         self.offset_path = offset_path
         self.duration_path = duration_path
         self.language = language
+        self.timing = TimingStore(offset_path, duration_path, tr, nscans, 
+                                    offset_types=set(item for value in offset_type_dict.values() for item in value), 
+                                    duration_types=set(item for value in duration_type_dict.values() for item in value))
+        self.engine = ConvolutionEngine(tr, hrf=hrf, oversampling=oversampling) if hrf!='fir' else None
+        self.cache = ArrayCache(cache_size, cache_path, cache_disk_size) if (cache_size or cache_path) else None
+        self.fmri_cache = ArrayCache(0, fmri_cache_path, mmap_mode='r') if fmri_cache_path else None
+        self.fmri_slab_size = fmri_slab_size
+        self.dtype = np.dtype(dtype)
     
     def standardize(self, X_train, X_test):
         """Standardize a train and test sets.
@@ -83,7 +109,7 @@ class Transformer(object):
         for index in range(len(matrices)):
             scaler = StandardScaler(with_mean=self.with_mean, with_std=self.with_std)
             scaler.fit(matrices[index])
-            matrices[index] = scaler.transform(matrices[index])
+            matrices[index] = scaler.transform(matrices[index]).astype(self.dtype, copy=False)
         result = {'X_train': matrices[:-len(X_test)], 'X_test': matrices[-len(X_test):]}
         return result
     
@@ -99,43 +125,75 @@ class Transformer(object):
         """
         matrices_ = [*X_train, *X_test]
         runs = [*run_train, *run_test]
-        matrices = [self.compute_regressor(pd.DataFrame(array[:,index]), 
+        matrices = [self.compute_regressor(clean_nan_rows(array, index), 
                                             self.offset_type_dict['run{}'.format(runs[array_index] + 1)][i], 
                                             self.duration_type_dict['run{}'.format(runs[array_index] + 1)][i], 
                                             'run{}'.format(runs[array_index] + 1)) for array_index, array in enumerate(matrices_) for i, index in enumerate(self.indexes)]
         step = len(self.indexes)
-        matrices = [np.hstack(matrices[x : x + step]) for x in range(0, len(matrices), step)]
+        matrices = [self.stack_regressors(matrices[x : x + step]) for x in range(0, len(matrices), step)]
         return {'X_train': matrices[:-len(X_test)], 'X_test': matrices[-len(X_test):], 'run_train': run_train, 'run_test': run_test}
     
-    def compute_regressor(self, dataframe, offset_type, duration_type, run_index):
-        """ Compute the convolution with an hrf for each column of the dataframe.
+    def stack_regressors(self, regressors):
+        """ Concatenate horizontally the regressors of the models of a run,
+        copying each of them once in the design-matrix (in self.dtype).
         Arguments:
-            - dataframes: pd.DataFrame
+            - regressors: list (of np.array)
+        Returns:
+            - np.array
+        """
+        design_matrix = np.empty((regressors[0].shape[0], sum(matrix.shape[1] for matrix in regressors)), dtype=self.dtype)
+        column = 0
+        for matrix in regressors:
+            design_matrix[:, column:column + matrix.shape[1]] = matrix
+            column += matrix.shape[1]
+        return design_matrix
+    
+    def compute_regressor(self, matrix, offset_type, duration_type, run_index):
+        """ Compute the convolution with an hrf for each column of the matrix.
+        The result only depends on the matrix values and on the stimuli timing,
+        so it is retrieved from self.cache when it was already computed.
+        Arguments:
+            - matrix: np.array (without NaN rows, see utils.clean_nan_rows)
             - offset_type: str
             - duration_type: str
             - run_index: str
         Returns:
             - matrix: np.array
         """
+        offsets = self.timing.get_offsets(offset_type, run_index)
+        duration = self.timing.get_duration(duration_type, run_index, default_size=len(matrix))
+        if self.cache is None:
+            return self.convolve(matrix, offsets, duration, run_index)
+        key = hash_key(matrix, offsets, duration, self.nscans[run_index], self.tr, self.hrf, self.oversampling)
+        return self.cache.get_or_compute(key, self.convolve, matrix, offsets, duration, run_index)
+
+    def convolve(self, matrix, offsets, duration, run_index):
+        """ Convolve each column of the matrix with an hrf.
+        All columns share the same onsets and durations, so the convolution 
+        engine computes them at once with a single sampling operator.
+        Arguments:
+            - matrix: np.array
+            - offsets: np.array
+            - duration: np.array
+            - run_index: str
+        Returns:
+            - matrix: np.array
+        """
+        if self.engine is not None:
+            return self.engine.convolve(matrix, offsets, duration, self.nscans[run_index], frame_times=self.timing.get_frame_times(run_index))
         regressors = []
-        dataframe = dataframe.dropna(axis=0)
-        representations = [col for col in dataframe.columns]
-        offsets = fetch_offsets(offset_type, run_index, self.offset_path)
-        duration = fetch_duration(duration_type, run_index, self.duration_path, default_size=len(dataframe))
-        for col in representations:
-            conditions = np.vstack((offsets, duration, dataframe[col]))
+        for col in range(matrix.shape[1]):
+            conditions = np.vstack((offsets, duration, matrix[:, col]))
             signal, name = compute_regressor(exp_condition=conditions,
                                     hrf_model=self.hrf,
-                                    frame_times=np.arange(0.0, self.nscans[run_index] * self.tr, self.tr),
+                                    frame_times=self.timing.get_frame_times(run_index),
                                     oversampling=self.oversampling)
-            col = str(col)
-            regressors.append(pd.DataFrame(signal, columns=[col] + [col + '_' + item for item in name[1:]] ))
-        matrix = pd.concat(regressors, axis=1).values
-        return matrix
+            regressors.append(signal)
+        return np.hstack(regressors)
     
     def process_representations(self, representation_paths, models):
-        """ Load representation dataframes and create the design matrix
-        for each run.
+        """ Load representation dataframes (csv files or binary stores)
+        and create the design matrix for each run.
         Arguments:
             - representation_paths: list (of list of paths)
             - models: list (of dict)
@@ -148,26 +206,66 @@ class Transformer(object):
 
         # Computing design-matrices
         for i in range(len(runs)):
-            # to modify in case the path leads to .npy file
-            merge = pd.concat([pd.read_csv(path2features)[eval(models[index]['columns_to_retrieve'])] for index, path2features in enumerate(runs[i])], axis=1) # concatenate horizontaly the read csv files of a run
-            arrays.append(merge.values)
+            # converted representations (.npy, see feature_store.py) only read the retrieved columns
+            matrices = [read_columns(path2features, eval(models[index]['columns_to_retrieve'])) if path2features.endswith('.npy') 
+                            else pd.read_csv(path2features)[eval(models[index]['columns_to_retrieve'])].values for index, path2features in enumerate(runs[i])]
+            arrays.append(hstack_padded(matrices).astype(self.dtype, copy=False)) # concatenate horizontaly the representations of a run
         return arrays
     
     def process_fmri_data(self, fmri_paths, masker):
         """ Load fMRI data and mask it with a given masker.
         Preprocess it to avoid NaN value when using Pearson
         Correlation coefficients in the following analysis.
+        The masked runs are retrieved (memory-mapped) from self.fmri_cache 
+        when they were already computed with the same masker.
         Arguments:
             - fmri_paths: list (of string)
             - masker: NiftiMasker object
         Returns:
             - data: list (of np.array)
         """
-        data = [masker.transform(f) for f in fmri_paths]
+        slab_masker = SlabMasker(masker, slab_size=self.fmri_slab_size, dtype=self.dtype)
+        if self.fmri_cache is None:
+            return [self.mask_fmri_data(path, slab_masker) for path in fmri_paths]
+        masker_key = self.get_masker_key(masker)
+        return [self.fmri_cache.get_or_compute(self.get_fmri_key(path, masker_key), self.mask_fmri_data, path, slab_masker) for path in fmri_paths]
+    
+    def mask_fmri_data(self, fmri_path, masker):
+        """ Mask the fMRI data of a run, adding a small variation to
+        voxels with constant zero activation.
+        Arguments:
+            - fmri_path: str
+            - masker: SlabMasker / NiftiMasker object
+        Returns:
+            - data: np.array
+        """
+        data = masker.transform(fmri_path)
         # voxels with activation at zero at each time step generate a nan-value pearson correlation => we add a small variation to the first element
-        for run in range(len(data)):
-            zero = np.zeros(data[run].shape[0])
-            new = zero.copy()
-            new[0] += np.random.random()/1000
-            data[run] = np.apply_along_axis(lambda x: x if not np.array_equal(x, zero) else new, 0, data[run])
+        zero = ~np.any(data, axis=0)
+        data[0, zero] += np.random.random()/1000
         return data
+    
+    def get_masker_key(self, masker):
+        """ Compute a content hash of a fitted masker (mask image and
+        parameters having an impact on the masked data).
+        Arguments:
+            - masker: NiftiMasker object
+        Returns:
+            - str
+        """
+        params = masker.get_params()
+        params = {key: params[key] for key in ['detrend', 'dtype', 'high_pass', 'low_pass', 'mask_strategy', 
+                                                'smoothing_fwhm', 'standardize', 't_r'] if key in params}
+        return hash_key(np.asarray(masker.mask_img_.dataobj), masker.mask_img_.affine, params)
+    
+    def get_fmri_key(self, fmri_path, masker_key):
+        """ Compute the key of the masked data of a run (the size and
+        modification time of the file invalidate outdated entries).
+        Arguments:
+            - fmri_path: str
+            - masker_key: str
+        Returns:
+            - str
+        """
+        stat = os.stat(fmri_path)
+        return hash_key('fmri', masker_key, os.path.abspath(fmri_path), stat.st_size, stat.st_mtime_ns, self.dtype.str)
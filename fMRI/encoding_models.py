@@ -9,7 +9,30 @@ A EncodingModel instanciation requires:
     - alpha_max_log_scale: int maximum of the log scale alpha values that we are testing ,
     - nb_alphas: int, number of alphas to test in our log scale,
     - optimizing_criteria': string specifying the measure to use for optimization (by default
-    we use the R2 value).
+    we use the R2 value),
+    - solver: string specifying how the grid search is computed: 'sklearn' refits the model
+    for each alpha, 'svd' derives all the Ridge solutions from a single decomposition of
+    the design-matrix (only available for sklearn Ridge models),
+    - scoring_chunk_size: int (or None), number of voxels scored at once,
+    - voxel_block_size: int (or None), number of voxels fitted at once,
+    - voxel_block_memory: float (or None), memory budget (in MB) of the fMRI data and 
+    predictions of a block of voxels fitted at once,
+    - dtype: string, floating point precision of the fMRI data and predictions 
+    (factorizations are computed in float64 and scores are accumulated in float64),
+    - alpha_search: string specifying how the alphas are searched: 'grid' scores every voxel
+    for each alpha of the log scale, 'adaptive' (only available for the 'svd' solver) uses the
+    log scale as a coarse grid and then refines the alpha of each voxel,
+    - nb_alpha_extensions: int, maximum number of log scale steps by which the search range of
+    a voxel whose best alpha is at the edge of the grid is extended ('adaptive' search),
+    - nb_alpha_refinements: int, number of golden-section iterations refining the best alpha
+    of each voxel between its two neighbours of the grid ('adaptive' search).
+
+With the 'adaptive' search, each step evaluates a single alpha per voxel (a single matrix
+product from the decomposition of the design-matrix, as a grid alpha), and the interval
+bracketing the best alpha of each voxel shrinks by about 0.618 at each refinement, for at
+most nb_alphas + nb_alpha_extensions + nb_alpha_refinements evaluations. The grid search then
+returns, for each inner fold, the selected alpha of each voxel and its scores (alpha axis
+of size 1), and optimize_alpha takes the geometric mean of the alphas of the inner folds.
 
 The mains methods implemented in this class are:
     - self.fit: train the encoding model from {X_train, Y_train, alpha}
@@ -18,7 +41,8 @@ The mains methods implemented in this class are:
     - self.optimize_alpha: retrieve the best hyperparameter per voxel from the output
     of the grid_search.
     - self.evaluate: use optimize_alpha to fit a model for each set of voxels having the same 
-    hyperparameters and compute the R2/Pearson maps.
+    hyperparameters (or a single decomposition with per-voxel shrinkage for the 'svd' solver)
+    and compute the R2/Pearson maps.
 """
 
 
@@ -26,10 +50,12 @@ The mains methods implemented in this class are:
 import os
 import numpy as np
 
-from scipy.stats import pearsonr
-from sklearn.metrics import r2_score
+from sklearn.base import clone
 from sklearn.linear_model import Ridge
 
+from ridge import RidgeFactorization
+from splitter import stacked
+from scoring import Scorer, r2_score, pearson_coeff
 
 
 class EncodingModel(object):
@@ -37,7 +63,7 @@ class EncodingModel(object):
     of regressors to fMRI data.
     """
 
-    def __init__(self, model=Ridge(), alpha=None, alpha_min_log_scale=2, alpha_max_log_scale=4, nb_alphas=25, optimizing_criteria='R2'):
+    def __init__(self, model=Ridge(), alpha=None, alpha_min_log_scale=2, alpha_max_log_scale=4, nb_alphas=25, optimizing_criteria='R2', solver='sklearn', scoring_chunk_size=None, voxel_block_size=None, voxel_block_memory=None, dtype='float64', alpha_search='grid', nb_alpha_extensions=3, nb_alpha_refinements=5):
         """ Instanciation of EncodingModel class.
         Arguments:
             - model: sklearn.linear_model
@@ -46,39 +72,95 @@ class EncodingModel(object):
             - alpha_max_log_scale: int
             - nb_alphas: int
             - optimizing_criteria, str
+            - solver: str
+            - scoring_chunk_size: int
+            - voxel_block_size: int
+            - voxel_block_memory: float
+            - dtype: str
+            - alpha_search: str
+            - nb_alpha_extensions: int
+            - nb_alpha_refinements: int
         """
+        if solver not in ['sklearn', 'svd']:
+            raise Exception('Solver {} not known.'.format(solver))
+        if solver=='svd' and not isinstance(model, Ridge):
+            raise Exception('The svd solver is only available for Ridge models.')
+        if alpha_search not in ['grid', 'adaptive']:
+            raise Exception('Alpha search {} not known.'.format(alpha_search))
+        if alpha_search=='adaptive' and solver!='svd':
+            raise Exception('The adaptive alpha search is only available for the svd solver.')
         self.alpha = alpha # regularization parameter
+        self.dtype = np.dtype(dtype)
+        self.voxel_block_size = voxel_block_size
+        self.voxel_block_memory = voxel_block_memory
+        self.solver = solver
+        self.scorer = Scorer(metrics=['R2', 'Pearson_coeff'], chunk_size=scoring_chunk_size)
         self.model = model
         self.optimizing_criteria = optimizing_criteria
         self.alpha_list = [round(tmp, 5) for tmp in np.logspace(alpha_min_log_scale, alpha_max_log_scale, nb_alphas)]
+        self.alpha_search = alpha_search
+        self.nb_alpha_extensions = nb_alpha_extensions
+        self.nb_alpha_refinements = nb_alpha_refinements
     
-    def fit(self, X_train, Y_train, alpha):
-        """ Fit the model for a given set of runs.
+    def fit(self, X_train, Y_train, alpha, model=None):
+        """ Fit the model for a given set of runs (or their already
+        concatenated matrices).
         Arguments:
-            - X_train: list (of np.array)
-            - Y_train: list (of np.array)
+            - X_train: list (of np.array) / np.array
+            - Y_train: list (of np.array) / np.array
             - alpha: float
+            - model: sklearn.linear_model (self.model if None)
+        Returns:
+            - model: sklearn.linear_model
         """
-        self.model.set_params(alpha=alpha)
-        dm = np.vstack(X_train)
-        fmri = np.vstack(Y_train)
-        self.model.fit(dm,fmri)
+        model = self.model if model is None else model
+        model.set_params(alpha=alpha)
+        if isinstance(X_train, np.ndarray) and isinstance(Y_train, np.ndarray):
+            model.fit(X_train, Y_train)
+            return model
+        with stacked(X_train) as dm, stacked(Y_train) as fmri:
+            model.fit(dm,fmri)
+        return model
     
-    def predict(self, X_test):
+    def predict(self, X_test, model=None):
         """ Compute the predictions of the model for a given
         input X_test.
         Arguments:
             - X_test: np.array
+            - model: sklearn.linear_model (self.model if None)
         Returns:
             - predictions: np.array
         """
-        predictions = self.model.predict(X_test)
+        model = self.model if model is None else model
+        predictions = model.predict(X_test)
+        if predictions.ndim==1:
+            predictions = predictions[:, np.newaxis] # single voxel (e.g. the last voxel block)
         return predictions
     
+    def get_voxel_blocks(self, Y_train, Y_test):
+        """ Split the voxels into blocks whose training data, test data and
+        predictions (for all alphas) fit in self.voxel_block_memory, or of 
+        self.voxel_block_size voxels.
+        Arguments:
+            - Y_train: list (of np.array)
+            - Y_test: list (of np.array)
+        Returns:
+            - list (of slice)
+        """
+        nb_voxels = Y_train[0].shape[1]
+        block_size = self.voxel_block_size if self.voxel_block_size else nb_voxels
+        if self.voxel_block_memory:
+            nb_rows = sum(run.shape[0] for run in Y_train) + sum(run.shape[0] for run in Y_test) * (len(self.alpha_list) + 1)
+            block_size = min(block_size, int(self.voxel_block_memory * 1024 ** 2 // (nb_rows * self.dtype.itemsize)))
+        block_size = max(block_size, 1)
+        return [slice(start, min(start + block_size, nb_voxels)) for start in range(0, nb_voxels, block_size)]
+    
     def grid_search(self, X_train, Y_train, X_test, Y_test):
         """ Fit a model on the whole brain for a list of hyperparameters, 
         and return R2 coefficients, Pearson coefficients and regularization 
         parameters.
+        The voxels are processed block by block (see self.get_voxel_blocks), 
+        sharing the decomposition of the design-matrix.
         Arguments:
             - X_train: list (of np.array)
             - Y_train: list (of np.array)
@@ -87,41 +169,123 @@ class EncodingModel(object):
         Returns:
             - result: dict
         """
-        result = {'R2': [],
-                    'Pearson_coeff': [],
-                    'alpha': self.alpha_list
-                    }
-        for alpha in self.alpha_list:
-            self.fit(X_train, Y_train, alpha)
-            X_test = np.vstack(X_test)
-            Y_test = np.vstack(Y_test)
-            predictions = self.predict(X_test)
-            result['R2'].append(self.get_R2_coeff(predictions, Y_test))
-            result['Pearson_coeff'].append(self.get_Pearson_coeff(predictions, Y_test))
-        result['R2'] = np.stack(result['R2'], axis=0)
-        result['Pearson_coeff'] = np.stack(result['Pearson_coeff'], axis=0)
+        X_test = np.vstack(X_test).astype(self.dtype, copy=False)
+        nb_voxels = Y_train[0].shape[1]
+        nb_alphas = 1 if self.alpha_search=='adaptive' else len(self.alpha_list)
+        result = {key: np.zeros((nb_alphas, nb_voxels)) for key in self.scorer.metrics}
+        if self.alpha_search=='adaptive':
+            result['alpha'] = np.zeros((1, nb_voxels))
+        with stacked(X_train) as X_train:
+            X_train = X_train.astype(self.dtype, copy=False) # no copy if the data follows the dtype policy
+            if self.solver=='svd':
+                factorization = RidgeFactorization(X_train, fit_intercept=self.model.fit_intercept, dtype=self.dtype)
+                X_test_projected = factorization.transform(X_test)
+            else:
+                model = clone(self.model) # folds may be computed concurrently
+            for block in self.get_voxel_blocks(Y_train, Y_test):
+                y_test = np.vstack([run[:, block] for run in Y_test]).astype(self.dtype, copy=False)
+                with stacked(Y_train, block) as y_train:
+                    y_train = y_train.astype(self.dtype, copy=False)
+                    if self.alpha_search=='adaptive':
+                        UtY, Y_mean = factorization.project(y_train)
+                        scores, result['alpha'][:, block] = self.adaptive_search(factorization, X_test_projected, UtY, Y_mean, y_test)
+                    elif self.solver=='svd':
+                        UtY, Y_mean = factorization.project(y_train)
+                        scores = self.scorer.score_by_chunk(lambda chunk: factorization.predict_path(X_test_projected, UtY[:, chunk], Y_mean[chunk], self.alpha_list), y_test)
+                    else:
+                        scores = []
+                        for alpha in self.alpha_list:
+                            self.fit(X_train, y_train, alpha, model=model)
+                            scores.append(self.scorer.score(self.predict(X_test, model=model), y_test))
+                        scores = {key: np.stack([item[key] for item in scores], axis=0) for key in self.scorer.metrics}
+                for key in self.scorer.metrics:
+                    result[key][:, block] = scores[key]
+        if self.alpha_search=='grid':
+            result['alpha'] = self.alpha_list
         return result
+    
+    def adaptive_search(self, factorization, X_test_projected, UtY, Y_mean, y_test):
+        """ Search the best alpha of each voxel: the voxels are scored on the
+        log scale grid, the range of the voxels whose best alpha is at its edge
+        is extended step by step, and the best alpha is then refined by a 
+        golden-section search between its two neighbours (in log scale).
+        Arguments:
+            - factorization: RidgeFactorization
+            - X_test_projected: np.array (2D)
+            - UtY: np.array (2D)
+            - Y_mean: np.array (1D)
+            - y_test: np.array (2D)
+        Returns:
+            - scores: dict (of np.array (2D: 1 x voxels))
+            - alphas: np.array (2D: 1 x voxels)
+        """
+        def score(log_alphas, voxels=slice(None)):
+            # scores of each voxel for its own alpha
+            Y_test = y_test[:, voxels]
+            UtY_, Y_mean_ = UtY[:, voxels], Y_mean[voxels]
+            return self.scorer.score_by_chunk(lambda chunk: factorization.predict(X_test_projected, UtY_[:, chunk], Y_mean_[chunk], 10 ** log_alphas[chunk]), Y_test)
+        
+        log_grid = np.log10(self.alpha_list)
+        step = np.mean(np.diff(log_grid)) if len(log_grid) > 1 else 1.
+        path = self.scorer.score_by_chunk(lambda chunk: factorization.predict_path(X_test_projected, UtY[:, chunk], Y_mean[chunk], self.alpha_list), y_test)
+        indexes = np.argmax(path[self.optimizing_criteria], axis=0)
+        voxels = np.arange(y_test.shape[1])
+        scores = {key: path[key][indexes, voxels] for key in self.scorer.metrics}
+        best = log_grid[indexes]
+        low, high = np.full(len(best), log_grid[0]), np.full(len(best), log_grid[-1]) # explored range
+        
+        for _ in range(self.nb_alpha_extensions):
+            edge = np.where((best==low) | (best==high))[0]
+            if len(edge)==0:
+                break
+            candidates = np.where(best[edge]==low[edge], best[edge] - step, best[edge] + step)
+            new_scores = score(candidates, edge)
+            better = new_scores[self.optimizing_criteria] > scores[self.optimizing_criteria][edge]
+            low[edge], high[edge] = np.minimum(low[edge], candidates), np.maximum(high[edge], candidates)
+            best[edge[better]] = candidates[better]
+            for key in self.scorer.metrics:
+                scores[key][edge[better]] = new_scores[key][better]
+        
+        # golden-section search on the bracket (a, best, b), one evaluation per iteration
+        a, b = best - step, best + step
+        for _ in range(self.nb_alpha_refinements):
+            right = (b - best) > (best - a)
+            candidates = np.where(right, best + 0.381966 * (b - best), best - 0.381966 * (best - a))
+            new_scores = score(candidates)
+            better = new_scores[self.optimizing_criteria] > scores[self.optimizing_criteria]
+            a, b = np.where(better, np.where(right, best, a), np.where(right, a, candidates)), np.where(better, np.where(right, b, best), np.where(right, candidates, b))
+            best = np.where(better, candidates, best)
+            for key in self.scorer.metrics:
+                scores[key] = np.where(better, new_scores[key], scores[key])
+        return {key: value[np.newaxis] for key, value in scores.items()}, 10 ** best[np.newaxis]
         
     def optimize_alpha(self, data, hyperparameter):
         """ Optimize the hyperparameter of a model given a
         list of measures.
         Arguments:
             - data: np.array (3D)
-            - hyperparameter: np.array (2D)
+            - hyperparameter: np.array (2D, or 3D for the alphas of each voxel
+            of the adaptive search)
         Returns:
-            - voxel2alpha: list (of int)
-            - alpha2voxel: dict (of list)
+            - voxel2alpha: np.array (1D)
+            - alpha2voxel: dict (of np.array)
         """
+        if np.ndim(hyperparameter)==3:
+            # geometric mean of the alphas of the inner folds
+            voxel2alpha = 10 ** np.mean(np.log10(hyperparameter[:, 0, :]), axis=0)
+            values, inverse = np.unique(voxel2alpha, return_inverse=True)
+            alpha2voxel = dict(zip(values, np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])))
+            return voxel2alpha, alpha2voxel
         hyperparameter = np.mean(hyperparameter, axis=0)
         best_alphas_indexes = np.argmax(np.mean(data, axis=0), axis=0)
-        voxel2alpha = np.array([hyperparameter[i] for i in best_alphas_indexes])
-        alpha2voxel = {key:[] for key in hyperparameter}
-        for index in range(len(voxel2alpha)):
-            alpha2voxel[voxel2alpha[index]].append(index)
+        voxel2alpha = hyperparameter[best_alphas_indexes]
+        alpha2voxel = {key: np.where(best_alphas_indexes==index)[0] for index, key in enumerate(hyperparameter)}
         return voxel2alpha, alpha2voxel
     
     def evaluate(self, X_train, X_test, Y_train, Y_test, R2, Pearson_coeff, alpha):
         """ Fit a model for each voxel given the parameter optimizing a measure.
+        The voxels are processed block by block (see self.get_voxel_blocks), 
+        sharing the decomposition of the design-matrix.
         Arguments:
             - X_train: list (of np.array)
             - Y_train: list (of np.array)
@@ -133,24 +297,38 @@ class EncodingModel(object):
         Returns:
             - result: dict
         """
-        R2_ = np.zeros((Y_test[0].shape[1]))
-        Pearson_coeff_ = np.zeros((Y_test[0].shape[1]))
-        x_test = np.vstack(X_test)
+        x_test = np.vstack(X_test).astype(self.dtype, copy=False)
         data = R2 if self.optimizing_criteria=='R2' else Pearson_coeff
         voxel2alpha, alpha2voxel = self.optimize_alpha(data, alpha)
-        for alpha_, voxels in alpha2voxel.items():
-            if voxels:
-                y_test = np.vstack(Y_test)[:, voxels]
-                y_train = np.vstack(Y_train)[:, voxels]
-                x_train = np.vstack(X_train)
-                self.fit(x_train, y_train, alpha_)
-                predictions = self.predict(x_test)
-                R2_[voxels] = self.get_R2_coeff(predictions, y_test)
-                Pearson_coeff_[voxels] = self.get_Pearson_coeff(predictions, y_test)
-        result = {'R2': R2_,
-                    'Pearson_coeff': Pearson_coeff_,
-                    'alpha': voxel2alpha
-                    }
+        nb_voxels = Y_train[0].shape[1]
+        result = {key: np.zeros(nb_voxels) for key in self.scorer.metrics}
+        with stacked(X_train) as x_train:
+            x_train = x_train.astype(self.dtype, copy=False) # no copy if the data follows the dtype policy
+            if self.solver=='svd':
+                # each voxel gets its own shrinkage from a single decomposition of the design-matrix
+                factorization = RidgeFactorization(x_train, fit_intercept=self.model.fit_intercept, dtype=self.dtype)
+                x_test_projected = factorization.transform(x_test)
+            else:
+                model = clone(self.model) # folds may be computed concurrently
+            for block in self.get_voxel_blocks(Y_train, Y_test):
+                y_test = np.vstack([run[:, block] for run in Y_test]).astype(self.dtype, copy=False)
+                block_alphas = voxel2alpha[block]
+                with stacked(Y_train, block) as y_train:
+                    y_train = y_train.astype(self.dtype, copy=False)
+                    if self.solver=='svd':
+                        UtY, Y_mean = factorization.project(y_train)
+                        scores = self.scorer.score_by_chunk(lambda chunk: factorization.predict(x_test_projected, UtY[:, chunk], Y_mean[chunk], block_alphas[chunk]), y_test)
+                        for key in self.scorer.metrics:
+                            result[key][block] = scores[key]
+                    else:
+                        for alpha_ in alpha2voxel:
+                            voxels = np.where(block_alphas==alpha_)[0]
+                            if len(voxels) > 0:
+                                self.fit(x_train, y_train[:, voxels], alpha_, model=model)
+                                scores = self.scorer.score(self.predict(x_test, model=model), y_test[:, voxels])
+                                for key in self.scorer.metrics:
+                                    result[key][block.start + voxels] = scores[key]
+        result['alpha'] = voxel2alpha
         return result
 
     def get_R2_coeff(self, predictions, Y_test):
@@ -159,7 +337,7 @@ class EncodingModel(object):
             - predictions: np.array
             - Y_test: np.array
         """
-        r2 = r2_score(Y_test, predictions, multioutput='raw_values')
+        r2 = r2_score(predictions, Y_test)
         return r2
     
     def get_Pearson_coeff(self, predictions, Y_test):
@@ -169,5 +347,5 @@ class EncodingModel(object):
             - predictions: np.array
             - Y_test: np.array
         """
-        pearson_corr = np.array([pearsonr(Y_test[:,i], predictions[:,i])[0] for i in range(Y_test.shape[1])])
+        pearson_corr = pearson_coeff(predictions, Y_test)
         return pearson_corr
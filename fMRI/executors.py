@@ -0,0 +1,154 @@
+"""
+Executors used by the tasks to run their functions over the folds.
+===================================================
+An executor implements a map(func, items) method returning the results in
+the same order as the items, so that the fold structure of the task outputs is
+preserved whatever the executor, and a submit(func, *args) method returning a
+future (used by the dataflow scheduler of the Pipeline):
+    - SerialExecutor: runs the items one after another,
+    - ThreadExecutor: runs the items in a pool of threads (numpy/BLAS release the GIL),
+    - ProcessExecutor: runs the items in a pool of processes (functions and inputs
+    must be picklable).
+The executor is chosen from the yaml file with get_executor(parallel, n_jobs).
+"""
+
+
+
+import os
+
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+
+
+class SerialExecutor(object):
+    """ Run items one after another."""
+
+    def __init__(self, n_jobs=1):
+        self.n_jobs = 1
+
+    def map(self, func, items):
+        """ Apply a function to each item.
+        Arguments:
+            - func: function
+            - items: list
+        Returns:
+            - generator
+        """
+        for item in items:
+            yield func(item)
+
+    def submit(self, func, *args):
+        """ Run a function immediately.
+        Arguments:
+            - func: function
+        Returns:
+            - future: Future (already done)
+        """
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    def shutdown(self):
+        """ Nothing to release."""
+        pass
+
+
+
+class ThreadExecutor(object):
+    """ Run items in a pool of threads."""
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs if n_jobs else os.cpu_count()
+        self.pool = None
+
+    def map(self, func, items):
+        """ Apply a function to each item, keeping the items order.
+        Arguments:
+            - func: function
+            - items: list
+        Returns:
+            - generator
+        """
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            for result in pool.map(func, items):
+                yield result
+
+    def submit(self, func, *args):
+        """ Run a function in the (persistent) pool.
+        Arguments:
+            - func: function
+        Returns:
+            - future: Future
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+        return self.pool.submit(func, *args)
+
+    def shutdown(self):
+        """ Release the workers of the persistent pool."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+
+class ProcessExecutor(object):
+    """ Run items in a pool of processes."""
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs if n_jobs else os.cpu_count()
+        self.pool = None
+
+    def map(self, func, items):
+        """ Apply a function to each item, keeping the items order.
+        Arguments:
+            - func: function (picklable)
+            - items: list (picklable)
+        Returns:
+            - generator
+        """
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+            for result in pool.map(func, items):
+                yield result
+
+    def submit(self, func, *args):
+        """ Run a function in the (persistent) pool.
+        Arguments:
+            - func: function (picklable)
+        Returns:
+            - future: Future
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+        return self.pool.submit(func, *args)
+
+    def shutdown(self):
+        """ Release the workers of the persistent pool."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+EXECUTORS = {'serial': SerialExecutor,
+                'thread': ThreadExecutor,
+                'process': ProcessExecutor
+                }
+
+def get_executor(parallel=None, n_jobs=None):
+    """ Instanciate the executor specified in the yaml file.
+    Arguments:
+        - parallel: bool / str ('serial', 'thread', 'process')
+        - n_jobs: int
+    Returns:
+        - executor
+    """
+    if not parallel:
+        parallel = 'serial'
+    elif parallel is True:
+        parallel = 'process'
+    if parallel not in EXECUTORS:
+        raise Exception('Executor {} not known.'.format(parallel))
+    return EXECUTORS[parallel](n_jobs)
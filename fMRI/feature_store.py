@@ -0,0 +1,122 @@
+"""
+Binary columnar store of the stimuli representations.
+===================================================
+A representation '<name>.csv' is converted to:
+    - '<name>.npy': the values, saved in column-major (Fortran) order so that each
+    column is contiguous on disk,
+    - '<name>.columns.json': the list of the column names (the column index).
+Only the numeric columns are stored (e.g. a column of words is left out), unless the
+columns to store are given explicitly.
+The .npy file is opened memory-mapped and only the requested columns are read,
+without parsing any text.
+fetch_data (utils.py) uses the store instead of the csv file when it exists, and
+process_representations (data_transformation.py) reads both formats.
+
+Usage (convert all the representations of a folder):
+    python feature_store.py --input_folder <path_to_representations_folder>
+"""
+
+
+
+import os
+import glob
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+
+
+def get_store_paths(path):
+    """ Paths of the store of a representation file.
+    Arguments:
+        - path: str ('.csv' or '.npy')
+    Returns:
+        - data_path: str
+        - columns_path: str
+    """
+    base = os.path.splitext(path)[0]
+    return base + '.npy', base + '.columns.json'
+
+def has_store(path):
+    """ Check if a representation file was converted.
+    Arguments:
+        - path: str
+    Returns:
+        - bool
+    """
+    return all(os.path.exists(item) for item in get_store_paths(path))
+
+def convert_csv(csv_path, columns=None, dtype=np.float64):
+    """ Convert a representation csv file to the columnar store.
+    Arguments:
+        - csv_path: str
+        - columns: list (of str), columns to store (all the numeric columns if None)
+        - dtype: np.dtype
+    Returns:
+        - data_path: str
+    """
+    data_path, columns_path = get_store_paths(csv_path)
+    dataframe = pd.read_csv(csv_path)
+    if columns is None:
+        dataframe = dataframe.select_dtypes(include=['number', 'bool'])
+        if dataframe.shape[1]==0:
+            raise Exception('No numeric column to convert in {}.'.format(csv_path))
+    else:
+        missing = [column for column in columns if column not in dataframe.columns]
+        if missing:
+            raise Exception('Columns {} not found in {}.'.format(missing, csv_path))
+        dataframe = dataframe[columns]
+        non_numeric = [column for column in columns if not (pd.api.types.is_numeric_dtype(dataframe[column]) or pd.api.types.is_bool_dtype(dataframe[column]))]
+        if non_numeric:
+            raise Exception('Columns {} of {} are not numeric.'.format(non_numeric, csv_path))
+    tmp_suffix = '.{}.tmp'.format(os.getpid())
+    with open(data_path + tmp_suffix, 'wb') as f:
+        np.save(f, np.asfortranarray(dataframe.values, dtype=dtype))
+    with open(columns_path + tmp_suffix, 'w') as f:
+        json.dump([str(column) for column in dataframe.columns], f)
+    os.replace(data_path + tmp_suffix, data_path) # atomic: concurrent jobs never read partial files
+    os.replace(columns_path + tmp_suffix, columns_path)
+    return data_path
+
+def read_columns(path, columns=None):
+    """ Read some columns of a converted representation.
+    Columns are retrieved by name, integers that are not column names
+    being used as positions (among the stored columns).
+    Arguments:
+        - path: str
+        - columns: list (of str / int), all the columns if None
+    Returns:
+        - np.array
+    """
+    data_path, columns_path = get_store_paths(path)
+    data = np.load(data_path, mmap_mode='r')
+    if columns is None:
+        return np.array(data)
+    with open(columns_path, 'r') as f:
+        index = {name: position for position, name in enumerate(json.load(f))}
+    positions = []
+    for column in columns:
+        if str(column) in index:
+            positions.append(index[str(column)])
+        elif isinstance(column, int):
+            positions.append(column)
+        else:
+            raise Exception('Column {} not found in {}.'.format(column, data_path))
+    return data[:, positions] # only the requested columns are read
+
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description="""Convert the representation csv files of a folder to the binary columnar store.""")
+    parser.add_argument("--input_folder", type=str, required=True,
+                            help="Folder containing the representation csv files (searched recursively).")
+    parser.add_argument("--overwrite", action='store_true',
+                            help="Convert files that already have a store.")
+
+    args = parser.parse_args()
+    for csv_path in sorted(glob.glob(os.path.join(args.input_folder, '**', '*.csv'), recursive=True)):
+        if args.overwrite or not has_store(csv_path):
+            print('Converting {}...'.format(csv_path))
+            convert_csv(csv_path)
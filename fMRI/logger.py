@@ -1,34 +1,189 @@
+"""
+Logging of the encoding analysis progression.
+===================================================
+A Logger instanciation requires:
+    - path: string, path of the text log file (logs.txt),
+    - writer: LogWriter (or None for the writer shared by all loggers of the process).
+
+Each message is written to the text log file, in the usual 'LEVEL: message --> Done' form,
+and as a structured record (time, elapsed time since the creation of the logger, level,
+task, fold, message, duration of the step for validated messages) to a JSON lines file
+next to it ('logs.jsonl' for 'logs.txt').
+The lines are not written directly: they are appended to the in-memory buffer of a
+LogWriter, flushed in batches (one opening of each file per flush) by a background thread,
+when the buffer is full, when an error is reported, and when the process exits (normally,
+on an exception, or on SIGTERM) once the scripts have called install_exit_handlers.
+The progression of the folds of each task is reported with self.progress: one record per
+fold (with the computation time of the fold), and a compact summary line (refreshed on stderr, and written in the text log at the
+end of the pipeline) instead of per-fold progress bars.
+"""
+
+
+
 import os
-from utils import write
+import sys
+import json
+import time
+import atexit
+import signal
+import threading
+import traceback
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')
 
 
 
+class LogWriter(object):
+    """ Buffer of the lines to append to files, flushed by a background
+    thread.
+    """
+
+    def __init__(self, flush_interval=5., buffer_size=1000):
+        """ Instanciation of LogWriter class.
+        Arguments:
+            - flush_interval: float (seconds)
+            - buffer_size: int (number of lines triggering a flush)
+        """
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.buffers = {} # lines to append by path
+        self.size = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock() # flushes are sequential, to keep the order of the lines
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ Start the background flusher."""
+        self.thread = threading.Thread(target=self.run, name='LogWriter', daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        """ Empty the buffer and forget the flusher (in forked processes)."""
+        self.buffers = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def write(self, path, text):
+        """ Add text to the buffer of a file.
+        Arguments:
+            - path: str
+            - text: str
+        """
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            self.buffers.setdefault(path, []).append(text)
+            self.size += 1
+            full = self.size >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ Append the buffered lines to their files."""
+        with self.flush_lock:
+            with self.lock:
+                buffers, self.buffers, self.size = self.buffers, {}, 0
+            for path, texts in buffers.items():
+                with open(path, 'a+') as f:
+                    f.write(''.join(texts))
+
+    def run(self):
+        """ Flush the buffer periodically."""
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """ Stop the flusher and flush the buffer."""
+        self.stopped.set()
+        self.flush()
+
+
+WRITER = LogWriter()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=WRITER.reset) # lines of the parent are flushed by the parent
+
+
+def install_exit_handlers(writer=None):
+    """ Flush the buffer of a writer when the process exits, normally, on an
+    exception or on SIGTERM (converted to SystemExit, so that the exit handlers
+    are run when the job is killed). To be called once by the scripts (main.py,
+    batch.py, benchmark.py), from the main thread.
+    Arguments:
+        - writer: LogWriter (WRITER if None)
+    """
+    writer = writer if writer is not None else WRITER
+    atexit.register(writer.close)
+    if signal.getsignal(signal.SIGTERM)==signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+
+
 class Logger(object):
     """ Framework to log encoding analysis progression and results.
     """
-    
-    def __init__(self, path):
+
+    def __init__(self, path, writer=None):
+        """ Instanciation of Logger class.
+        Arguments:
+            - path: str
+            - writer: LogWriter
+        """
         self.log_path = path
-    
-    def report_logs(self, logs, level, end):
+        self.records_path = os.path.splitext(path)[0] + '.jsonl'
+        self.writer = writer if writer is not None else WRITER
+        self.start = time.time()
+        self.step = None # (start time, message) of the inline message waiting for validation
+        self.block = None # (start time, message) of the first multi-line message waiting for validation
+        self.tasks = {} # progression of the folds by task: [nb folds done, nb folds, start time]
+        self.last_summary = 0.
+
+    def record(self, level, message, task=None, fold=None, **kwargs):
+        """ Write a structured record.
+        Arguments:
+            - level: str
+            - message: str
+            - task: str
+            - fold: int
+        """
+        record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'elapsed': round(time.time() - self.start, 3),
+                    'level': level, 'task': task, 'fold': fold, 'message': message}
+        record.update(kwargs)
+        self.writer.write(self.records_path, json.dumps(record) + '\n')
+
+    def report_logs(self, logs, level, end, task=None, fold=None):
         """General reporting function.
         Arguments:
             - logs: str
             - level: str
+            - end: str
+            - task: str
+            - fold: int
         """
-        write(self.log_path, level, end=': ')
-        write(self.log_path, logs, end=end)
-    
+        self.writer.write(self.log_path, '{}: {}{}'.format(level, logs, end))
+        self.record(level, logs, task=task, fold=fold)
+
     def error(self, message):
         """Reports ERROR messages.
         Arguments:
             - message: str
         """
         self.report_logs(message, level='ERROR', end='\n')
+        self.flush()
         raise Exception(message)
-    
+
+    def exception(self, err):
+        """Reports an exception with its traceback, without raising it.
+        Arguments:
+            - err: Exception
+        """
+        trace = ''.join(traceback.format_exception(type(err), err, err.__traceback__))
+        self.writer.write(self.log_path, 'ERROR: {}\n{}'.format(err, trace))
+        self.record('ERROR', str(err), traceback=trace)
+        self.flush()
+
     def warning(self, message):
         """Reports WARNING messages.
         Arguments:
@@ -41,15 +196,64 @@ class Logger(object):
         Arguments:
             - message: str
         """
+        if end!='\n':
+            self.step = (time.time(), message)
+        elif self.block is None:
+            self.block = (time.time(), message) # nested messages are logged until its validation
         self.report_logs(message, level='INFO', end=end)
-    
+
     def validate(self):
         """Validate previous message."""
-        write(self.log_path, '--> Done', end='\n')
-    
+        step = self.step if self.step is not None else self.block
+        duration = time.time() - step[0] if step is not None else None
+        self.writer.write(self.log_path, '--> Done{}\n'.format(' ({:.1f}s)'.format(duration) if duration is not None else ''))
+        self.record('DONE', step[1] if step is not None else '', duration=duration)
+        if self.step is not None:
+            self.step = None
+        else:
+            self.block = None
+
     def report_state(self, message):
         """Report state of a computation."""
-        write(self.log_path, message, end=' ')
+        self.writer.write(self.log_path, message + ' ')
+        self.record('STATE', message)
+
+    def progress(self, task, fold, nb_folds=None, duration=None):
+        """Report the end of the computation of a fold of a task.
+        Arguments:
+            - task: str
+            - fold: int
+            - nb_folds: int (None if not known yet)
+            - duration: float (computation time of the fold, in seconds)
+        """
+        now = time.time()
+        state = self.tasks.setdefault(task, [0, None, now])
+        state[0] += 1
+        state[1] = nb_folds if nb_folds is not None else state[1]
+        self.record('PROGRESS', 'fold done', task=task, fold=fold, duration=duration)
+        if now - self.last_summary >= 1.:
+            self.last_summary = now
+            sys.stderr.write('\r' + self.get_summary())
+            sys.stderr.flush()
+
+    def get_summary(self):
+        """Compact summary of the progression of the tasks.
+        Returns:
+            - str
+        """
+        return ' | '.join(['{}: {}/{}'.format(task, done, nb_folds if nb_folds is not None else '?') for task, (done, nb_folds, _) in self.tasks.items()])
+
+    def report_progress(self):
+        """Report the summary of the progression of the tasks, and reset it."""
+        if self.tasks:
+            sys.stderr.write('\r' + self.get_summary() + '\n')
+            self.report_logs(' | '.join(['{}: {} folds ({:.1f}s)'.format(task, done, time.time() - start) for task, (done, _, start) in self.tasks.items()]), level='PROGRESS', end='\n')
+        self.tasks = {}
+        self.last_summary = 0.
+
+    def flush(self):
+        """Write the buffered messages."""
+        self.writer.flush()
 
     def figure(self, array):
         """Reports a figure.
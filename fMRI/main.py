@@ -1,12 +1,17 @@
 import os
 import yaml
 import argparse
-import numpy as np
 
-from utils import check_folder, read_yaml, save_yaml, write, get_subject_name, get_output_name, aggregate_cv, create_maps, fetch_masker, fetch_data, get_nscans
+from utils import check_folder, read_yaml, save_yaml, write, get_subject_name, get_output_name, aggregate_cv, aggregate_folds, fetch_masker, fetch_data, get_nscans
 from utils import get_splitter_information, get_compression_information, get_data_transformation_information, get_encoding_model_information
+from utils import get_code_version, get_task_config
+from checkpoint import Checkpointer
+from profiler import Profiler
+from rendering import Renderer
+from results_store import ResultsStore
 from task import Task
-from logger import Logger
+from executors import get_executor
+from logger import Logger, install_exit_handlers
 from regression_pipeline import Pipeline
 from encoding_models import EncodingModel
 from splitter import Splitter
@@ -15,40 +20,18 @@ from data_compression import Compressor
 
 
 
-if __name__=='__main__':
-    
-    parser = argparse.ArgumentParser(description="""Main script that compute the R2 maps for a given subject and model.""")
-    parser.add_argument("--yaml_file", type=str, default="/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/LePetitPrince/code/fMRI/template.yml", 
-                            help="Path to the yaml containing the parameters of the script execution.")
-
-    args = parser.parse_args()
-    parameters = read_yaml(args.yaml_file)
-    input_path = parameters['input']
-    output_path_ = parameters['output']
-    subject = get_subject_name(parameters['subject'])
-    output_path = get_output_name(output_path_, parameters['language'], subject, parameters['model_name'])
-    logs = Logger(get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'logs.txt'))
-    save_yaml(parameters, output_path + 'config.yml')
-
-    logs.info("Fetching maskers...", end='\n')
-    masker = fetch_masker(parameters['masker_path'], parameters['language'], parameters['path_to_fmridata'], input_path, logger=logs)
-    logs.validate()
-
-    logs.info("Retrieve arguments for each model...")
-    kwargs_splitter = get_splitter_information(parameters)
-    kwargs_compression = get_compression_information(parameters)
-    kwargs_transformation = get_data_transformation_information(parameters)
-    kwargs_encoding_model = get_encoding_model_information(parameters)
-    logs.validate()
-
-    logs.info("Instanciations of the classes...")
-    splitter = Splitter(**kwargs_splitter)
-    compressor = Compressor(**kwargs_compression)
-    transformer = Transformer(**kwargs_transformation)
-    encoding_model = EncodingModel(**kwargs_encoding_model)
-    logs.validate()
-
-    logs.info("Defining Pipeline flow...")
+def define_tasks(splitter, compressor, transformer, encoding_model, executor, kwargs_splitter, kwargs_compression, kwargs_transformation, kwargs_encoding_model):
+    """ Define the tasks of the nested cross-validation and their dependencies.
+    Arguments:
+        - splitter: Splitter
+        - compressor: Compressor
+        - transformer: Transformer
+        - encoding_model: EncodingModel
+        - executor: executor
+        - kwargs_*: dict (arguments of the class instanciations)
+    Returns:
+        - dict (of Task)
+    """
     splitter_cv_external = Task([splitter.split], 
                                 name='splitter_cv_external')
     ## Internal Pipeline
@@ -94,6 +77,89 @@ if __name__=='__main__':
     encoding_model_internal.set_children_tasks([compressor_external])
     compressor_external.set_children_tasks([transform_data_external])
     transform_data_external.set_children_tasks([encoding_model_external])
+    for task in [splitter_cv_internal, compressor_internal, transform_data_internal, encoding_model_internal, 
+                    compressor_external, transform_data_external, encoding_model_external]:
+        task.set_executor(executor) # folds are independent
+    for task, kwargs in [(splitter_cv_external, kwargs_splitter), (splitter_cv_internal, kwargs_splitter), 
+                            (compressor_internal, kwargs_compression), (transform_data_internal, kwargs_transformation), 
+                            (encoding_model_internal, kwargs_encoding_model), (compressor_external, kwargs_compression), 
+                            (transform_data_external, kwargs_transformation), (encoding_model_external, kwargs_encoding_model)]:
+        task.config = get_task_config(kwargs) # identify the outputs of the task for checkpointing
+    return {task.name: task for task in [splitter_cv_external, splitter_cv_internal, compressor_internal, transform_data_internal, 
+                                            encoding_model_internal, compressor_external, transform_data_external, encoding_model_external]}
+
+def save_maps(maps, masker, output_path_, language, subject, model_name, logs, renderer=None, mask_path=None):
+    """ Aggregate the maps over the cross-validation folds, save them
+    and plot them (see rendering.py).
+    Arguments:
+        - maps: list (of dict), maps of the folds, or dict, maps already averaged 
+        over the folds (see ResultsStore.get_means)
+        - masker: NiftiMasker object
+        - output_path_: str
+        - language: str
+        - subject: str
+        - model_name: str
+        - logs: Logger
+        - renderer: Renderer (rendered right away if None)
+        - mask_path: str
+    """
+    renderer = renderer if renderer is not None else Renderer()
+    logs.info("Aggregating over cross-validation results...")
+    maps = aggregate_folds(maps) if isinstance(maps, list) else maps
+    logs.validate()
+    
+    logs.info("Plotting...", end='\n')
+    ## R2
+    output_path = get_output_name(output_path_, language, subject, model_name, 'R2')
+    renderer.render(masker, maps['R2'], output_path, logs, mask_path=mask_path, vmax=None, distribution_min=-10, distribution_max=1)
+    ## Pearson
+    output_path = get_output_name(output_path_, language, subject, model_name, 'Pearson_coeff')
+    renderer.render(masker, maps['Pearson_coeff'], output_path, logs, mask_path=mask_path, vmax=None, distribution_min=-10, distribution_max=1)
+    ## Alpha (not exactly what should be done: averaging alphas)
+    output_path = get_output_name(output_path_, language, subject, model_name, 'alpha')
+    renderer.render(masker, maps['alpha'], output_path, logs, mask_path=mask_path, vmax=None)
+    logs.validate()
+
+
+
+if __name__=='__main__':
+    
+    parser = argparse.ArgumentParser(description="""Main script that compute the R2 maps for a given subject and model.""")
+    parser.add_argument("--yaml_file", type=str, default="/neurospin/unicog/protocols/IRMf/LePetitPrince_Pallier_2018/LePetitPrince/code/fMRI/template.yml", 
+                            help="Path to the yaml containing the parameters of the script execution.")
+
+    args = parser.parse_args()
+    install_exit_handlers() # flush the logs when the job ends or is killed
+    parameters = read_yaml(args.yaml_file)
+    input_path = parameters['input']
+    output_path_ = parameters['output']
+    subject = get_subject_name(parameters['subject'])
+    output_path = get_output_name(output_path_, parameters['language'], subject, parameters['model_name'])
+    logs = Logger(get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'logs.txt'))
+    save_yaml(parameters, output_path + 'config.yml')
+
+    logs.info("Fetching maskers...", end='\n')
+    masker = fetch_masker(parameters['masker_path'], parameters['language'], parameters['path_to_fmridata'], input_path, logger=logs)
+    logs.validate()
+
+    logs.info("Retrieve arguments for each model...")
+    kwargs_splitter = get_splitter_information(parameters)
+    kwargs_compression = get_compression_information(parameters)
+    kwargs_transformation = get_data_transformation_information(parameters)
+    kwargs_encoding_model = get_encoding_model_information(parameters)
+    logs.validate()
+
+    logs.info("Instanciations of the classes...")
+    splitter = Splitter(**kwargs_splitter)
+    compressor = Compressor(**kwargs_compression)
+    transformer = Transformer(**kwargs_transformation)
+    encoding_model = EncodingModel(**kwargs_encoding_model)
+    executor = get_executor(parameters['parallel'], parameters.get('n_jobs'))
+    logs.validate()
+
+    logs.info("Defining Pipeline flow...")
+    tasks = define_tasks(splitter, compressor, transformer, encoding_model, executor, 
+                            kwargs_splitter, kwargs_compression, kwargs_transformation, kwargs_encoding_model)
     logs.validate()
 
     try:
@@ -105,26 +171,23 @@ if __name__=='__main__':
         logs.validate()
         
         logs.info("Executing pipeline...", end='\n')
-        pipeline = Pipeline()
-        pipeline.fit(splitter_cv_external, logs) # retrieve the flow from children and input_dependencies
+        checkpointer = Checkpointer(os.path.join(os.path.dirname(output_path), 'checkpoints'), code_version=get_code_version()) if parameters.get('checkpoint', False) else None
+        profiler = Profiler(get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'trace.jsonl'), 
+                                profile_task=parameters.get('profile_task')) if parameters.get('profile', False) else None
+        results_stores = [ResultsStore(get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'results.hdf5'), subject, parameters['model_name'],
+                                        compression=parameters.get('results_compression', 'gzip'), chunk_size=parameters.get('results_chunk_size', 4096))] if parameters.get('results_store', False) else None
+        pipeline = Pipeline(scheduler=parameters.get('scheduler', 'dataflow'), checkpointer=checkpointer, profiler=profiler, results_stores=results_stores)
+        pipeline.fit(tasks['splitter_cv_external'], logs) # retrieve the flow from children and input_dependencies
         maps = pipeline.compute(stimuli_representations, fMRI_data, output_path, logger=logs)
+        if results_stores is not None:
+            maps = results_stores[0].get_means() # averaged while the folds were written
+            pipeline.clear_outputs()
         
-        logs.info("Aggregating over cross-validation results...")
-        maps = {key: np.mean(np.stack(np.array([dic[key] for dic in maps]), axis=0), axis=0) for key in maps[0]}
-        logs.validate()
-        
-        logs.info("Plotting...", end='\n')
-        ## R2
-        output_path = get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'R2')
-        create_maps(masker, maps['R2'], output_path, vmax=None, logger=logs, distribution_min=-10, distribution_max=1)
-        ## Pearson
-        output_path = get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'Pearson_coeff')
-        create_maps(masker, maps['Pearson_coeff'], output_path, vmax=None, logger=logs, distribution_min=-10, distribution_max=1)
-        ## Alpha (not exactly what should be done: averaging alphas)
-        output_path = get_output_name(output_path_, parameters['language'], subject, parameters['model_name'], 'alpha')
-        create_maps(masker, maps['alpha'], output_path, vmax=None, logger=logs)
-        logs.validate()
+        renderer = Renderer(parameters.get('rendering', 'sync'), n_jobs=parameters.get('rendering_jobs', 1), compress=parameters.get('maps_compression', True))
+        save_maps(maps, masker, output_path_, parameters['language'], subject, parameters['model_name'], logs, renderer=renderer, mask_path=parameters['masker_path'] + '.nii.gz')
+        renderer.close()
     except Exception as err:
-        logs.error(str(err))
+        logs.exception(err)
+        raise
     
     print("Model: {} for subject: {} --> Done".format(parameters['model_name'], subject))
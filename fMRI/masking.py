@@ -0,0 +1,104 @@
+"""
+Streaming masking of 4D fMRI images with bounded memory.
+===================================================
+A SlabMasker instanciation requires:
+    - masker: a fitted (Multi)NiftiMasker, whose mask and parameters (smoothing, detrending,
+    standardization, dtype) are used,
+    - slab_size: int, number of volumes read at once,
+    - dtype: floating point dtype of the output (masker.dtype, or float64, if None).
+
+The image is read by slabs of volumes (memory-mapped for uncompressed images), and
+each slab is (smoothed and) masked directly into a preallocated (time x voxels) array.
+For compressed (.nii.gz) images, the file is kept open between slabs: the slabs being
+read in order, the image is decompressed in a single pass (instead of decompressing
+again from the start of the file for each slab).
+Detrending and standardization are then applied in place, by blocks of voxels, so that
+the peak memory stays near the size of the masked matrix.
+Maskers relying on options that cannot be computed slab by slab (temporal filtering,
+resampling to another grid) are applied as usual with masker.transform.
+"""
+
+
+
+import numpy as np
+import nibabel as nib
+
+from nilearn.image import smooth_img
+
+
+
+class SlabMasker(object):
+    """ Mask 4D images slab by slab into a preallocated array.
+    """
+
+    def __init__(self, masker, slab_size=50, block_size=10000, dtype=None):
+        """ Instanciation of SlabMasker class.
+        Arguments:
+            - masker: NiftiMasker object (fitted)
+            - slab_size: int
+            - block_size: int
+            - dtype: str / np.dtype
+        """
+        self.masker = masker
+        self.slab_size = slab_size
+        self.block_size = block_size
+        self.mask = np.asarray(masker.mask_img_.dataobj).astype(bool)
+        self.affine = masker.mask_img_.affine
+        dtype = dtype if dtype is not None else getattr(masker, 'dtype', None)
+        self.dtype = np.dtype(dtype) if dtype is not None else np.dtype(np.float64)
+        if self.dtype.kind != 'f':
+            self.dtype = np.dtype(np.float64)
+
+    def is_streamable(self, img):
+        """ Check if the masker can be applied slab by slab on an image.
+        Arguments:
+            - img: nib.Nifti1Image
+        Returns:
+            - bool
+        """
+        unsupported = [getattr(self.masker, key, None) for key in ['low_pass', 'high_pass', 'target_affine', 'target_shape']]
+        return all(value is None for value in unsupported) and self.masker.standardize in [True, False, None, 'zscore'] and len(img.shape)==4 and img.shape[:3]==self.mask.shape and np.allclose(img.affine, self.affine)
+
+    def transform(self, fmri_path):
+        """ Mask a 4D image.
+        Arguments:
+            - fmri_path: str
+        Returns:
+            - data: np.array (time x voxels)
+        """
+        img = nib.load(fmri_path, keep_file_open=True) # the data is memory-mapped when the file is not compressed
+        if not self.is_streamable(img):
+            return self.masker.transform(fmri_path).astype(self.dtype, copy=False)
+        nb_volumes = img.shape[3]
+        data = np.empty((nb_volumes, int(self.mask.sum())), dtype=self.dtype)
+        for start in range(0, nb_volumes, self.slab_size):
+            stop = min(start + self.slab_size, nb_volumes)
+            slab = np.asarray(img.dataobj[..., start:stop])
+            if self.masker.smoothing_fwhm is not None:
+                slab = smooth_img(nib.Nifti1Image(slab, img.affine), self.masker.smoothing_fwhm).get_fdata()
+            data[start:stop] = slab[self.mask].T
+            del slab
+        self.clean(data)
+        return data
+
+    def clean(self, data):
+        """ Detrend and standardize in place the columns of a matrix,
+        as nilearn.signal.clean.
+        Arguments:
+            - data: np.array (time x voxels)
+        """
+        regressor = np.arange(data.shape[0], dtype=np.float64)
+        regressor -= regressor.mean()
+        norm = np.sqrt(np.sum(regressor ** 2))
+        regressor /= norm if norm >= np.finfo(np.float64).eps else 1.
+        for start in range(0, data.shape[1], self.block_size):
+            block = data[:, start:start + self.block_size]
+            if self.masker.detrend:
+                block -= np.mean(block, axis=0)
+                block -= np.outer(regressor, np.dot(regressor, block)).astype(data.dtype, copy=False)
+            if self.masker.standardize:
+                if not self.masker.detrend:
+                    block -= np.mean(block, axis=0)
+                std = np.std(block, axis=0)
+                std[std < np.finfo(np.float64).eps] = 1.
+                block /= std
@@ -0,0 +1,191 @@
+"""
+Instrumentation of the pipeline: time and memory of each task, fold and function.
+===================================================
+A Profiler instanciation requires:
+    - path: string, path of the trace (JSON lines, one record per line), written next to
+    the logs.txt file,
+    - profile_task: string (or None), name of a task whose folds are also profiled with
+    cProfile (one '<trace>_<task>_<fold>.prof' file per fold, readable with pstats/snakeviz).
+
+The functions of each fold (item) of each task are run through profile_functions, in
+the worker of the executor, which returns the output and the records of the fold:
+    - 'function' records: one per function of Task.functions,
+    - 'item' records: one per fold (all the functions of the task).
+Each record holds the wall time, the CPU time of the thread, the peak RSS of the worker
+process after the run (and its increase during the run, which is only attributable to
+the run with a serial executor), and the size (in MB) of the arrays of the input and
+output. The Pipeline then adds 'task' records (aggregated over the folds, and the time
+span from the first fold start to the last fold end) and a 'pipeline' record.
+"""
+
+
+
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+import numpy as np
+
+from contextlib import contextmanager
+
+from utils import filter_args
+
+
+
+def get_peak_rss():
+    """ Peak resident memory (in MB) of the current process.
+    Returns:
+        - float
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+
+def get_size(data):
+    """ Total size (in MB) of the arrays held by an object (dict,
+    list, tuple, Runs views).
+    Arguments:
+        - data: object
+    Returns:
+        - float
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes / 1024 ** 2
+    if isinstance(data, dict):
+        return sum(get_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)) or hasattr(data, 'materialize'):
+        return sum(get_size(value) for value in data)
+    return 0.
+
+def measure(function, *args, **kwargs):
+    """ Run a function and record its resources usage.
+    Arguments:
+        - function: function
+    Returns:
+        - result: output of the function
+        - record: dict
+    """
+    start, wall, cpu, rss = time.time(), time.perf_counter(), time.thread_time(), get_peak_rss()
+    result = function(*args, **kwargs)
+    record = {'start': start, 'wall_time': time.perf_counter() - wall, 'cpu_time': time.thread_time() - cpu,
+                'peak_rss': get_peak_rss(), 'pid': os.getpid(), 'thread': threading.get_ident()}
+    record['rss_increase'] = record['peak_rss'] - rss
+    return result, record
+
+def profile_functions(functions, name, item):
+    """ Apply sequentially a list of functions on an input item (as
+    task.apply_functions), recording the resources used by each function.
+    Arguments:
+        - functions: list (of functions)
+        - name: str (name of the task)
+        - item: tuple (index: int, input_: dict, profile_path: str (cProfile 
+        output, None to skip))
+    Returns:
+        - output: dict
+        - records: list (of dict)
+    """
+    index, input_, profile_path = item
+    records = []
+    def run():
+        input_tmp = input_.copy()
+        for func in functions:
+            input_size = get_size(input_tmp)
+            input_tmp, record = measure(func, **filter_args(func, input_tmp))
+            record.update({'event': 'function', 'task': name, 'item': index, 'function': func.__name__,
+                            'input_size': input_size, 'output_size': get_size(input_tmp)})
+            records.append(record)
+        return input_tmp
+    profile = cProfile.Profile() if profile_path else None
+    if profile is not None:
+        profile.enable()
+    try:
+        output, record = measure(run)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(profile_path)
+    record.update({'event': 'item', 'task': name, 'item': index, 'input_size': get_size(input_), 'output_size': get_size(output)})
+    records.append(record)
+    return output, records
+
+
+
+class Profiler(object):
+    """ Collect the records of the tasks and write them to a trace file.
+    """
+
+    def __init__(self, path, profile_task=None):
+        """ Instanciation of Profiler class.
+        Arguments:
+            - path: str
+            - profile_task: str
+        """
+        self.path = path
+        self.profile_task = profile_task
+        self.items = {} # records of the folds by task name
+        self.lock = threading.Lock()
+
+    def get_profile_path(self, task, index):
+        """ Get the path of the cProfile output of a fold (None if the
+        task is not profiled).
+        Arguments:
+            - task: Task
+            - index: int
+        Returns:
+            - str
+        """
+        if task.name!=self.profile_task:
+            return None
+        return '{}_{}_{}.prof'.format(os.path.splitext(self.path)[0], task.name, index)
+
+    def write(self, records):
+        """ Append records to the trace.
+        Arguments:
+            - records: list (of dict)
+        """
+        with self.lock:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+    def add(self, records):
+        """ Add the records of a fold.
+        Arguments:
+            - records: list (of dict)
+        """
+        for record in records:
+            if record['event']=='item':
+                self.items.setdefault(record['task'], []).append(record)
+        self.write(records)
+
+    def summarize(self, tasks):
+        """ Write the records of the tasks, aggregated over their folds.
+        Arguments:
+            - tasks: list (of Task)
+        """
+        records = []
+        for task in tasks:
+            items = self.items.pop(task.name, [])
+            if not items:
+                continue
+            start = min(item['start'] for item in items)
+            records.append({'event': 'task', 'task': task.name, 'nb_items': len(items), 'start': start,
+                            'span': max(item['start'] + item['wall_time'] for item in items) - start,
+                            'wall_time': sum(item['wall_time'] for item in items),
+                            'cpu_time': sum(item['cpu_time'] for item in items),
+                            'peak_rss': max(item['peak_rss'] for item in items),
+                            'input_size': max(item['input_size'] for item in items),
+                            'output_size': sum(item['output_size'] for item in items)})
+        self.write(records)
+
+    @contextmanager
+    def span(self, name, event='pipeline'):
+        """ Record the resources used by a block of code.
+        Arguments:
+            - name: str
+            - event: str
+        """
+        start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        yield
+        self.write([{'event': event, 'name': name, 'start': start, 'wall_time': time.perf_counter() - wall,
+                        'cpu_time': time.process_time() - cpu, 'peak_rss': get_peak_rss(), 'pid': os.getpid()}])
@@ -3,16 +3,40 @@ General class to pipe the different steps of the encoding analysis.
 Allows flexible result aggregation between the functions of the defined flow.
 ===================================================
 This module allows malleable task flow.
-It doesn't require any argument for instanciation.
+It doesn't require any argument for instanciation, but accepts:
+    - scheduler: 'dataflow' (default) or 'sequential',
+    - free_memory: bool specifying if the intermediate outputs are released as soon as
+    no task needs them anymore (dataflow scheduler only),
+    - checkpointer: Checkpointer (or None) saving the output of each item of each task, 
+    so that a new run with the same configuration, data and code only computes what is 
+    missing (completed tasks that are not needed by incomplete ones are skipped),
+    - shared_outputs: SharedOutputs (or None) keeping in memory the outputs of the tasks that 
+    only depend on X_train (the stimuli), reused by the following calls to self.compute as long 
+    as X_train does not change (e.g. for several subjects),
+    - profiler: Profiler (or None) recording the time and memory used by each task, fold and
+    function (see profiler.py),
+    - results_stores: list of ResultsStore (or None) to which the outputs of the encoding 
+    tasks are written as soon as each fold is computed (see results_store.py).
 The two main functions of the class are:
-    - self.fit(root_task): which retrieves the order in which to execute the tasks
-    descending from the root_task, based on parents/child dependencies.
-    - self.compute(self, X_train, Y_train, output_path, logger): which sequentially 
-    computes the various steps of the pipeline starting from an initial input (X_train, 
-    Y_train), saving the last task output to output_path, and returning it.
+    - self.fit(root_task): which builds the graph of the tasks descending from the
+    root_task (based on parents/child dependencies), checks that it has no cycle, and 
+    retrieves the order in which to execute the tasks.
+    - self.compute(self, X_train, Y_train, output_path, logger): which computes the 
+    various steps of the pipeline starting from an initial input (X_train, Y_train), 
+    saving the last task output to output_path, and returning it.
+With the sequential scheduler, each task is executed on all its inputs before the next
+one starts. With the dataflow scheduler, each item (fold) of a task is executed as soon 
+as the items it depends on are computed, so that the different stages of different folds 
+overlap; downstream items are scheduled first to keep few folds in memory at once.
 """
 
-from task import Task
+from contextlib import nullcontext
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from task import Task, READY, WAIT, MISSING, timed_functions
+from cache import hash_key
+from splitter import RunStore
+from profiler import profile_functions
 
 
 
@@ -22,13 +46,35 @@ class Pipeline(object):
     flow.
     """
     
-    def __init__(self):
-        pass
+    def __init__(self, scheduler='dataflow', free_memory=True, checkpointer=None, shared_outputs=None, profiler=None, results_stores=None):
+        """ Instanciation of Pipeline class.
+        Arguments:
+            - scheduler: str ('dataflow' / 'sequential')
+            - free_memory: bool
+            - checkpointer: Checkpointer
+            - shared_outputs: SharedOutputs
+            - profiler: Profiler
+            - results_stores: list (of ResultsStore)
+        """
+        if scheduler not in ['dataflow', 'sequential']:
+            raise Exception('Scheduler {} not known.'.format(scheduler))
+        self.scheduler = scheduler
+        self.free_memory = free_memory
+        self.shared_outputs = shared_outputs
+        self.profiler = profiler
+        self.results_stores = results_stores if results_stores is not None else []
+        if shared_outputs is not None:
+            shared_outputs.set_checkpointer(checkpointer)
+            checkpointer = shared_outputs # the shared tasks are retrieved from memory first
+        self.checkpointer = checkpointer
+        self.tasks = []
+        self.input_task = None
     
     def reset_tasks(self):
         """ Reset all tasks in the pipeline."""
         for task in self.tasks:
             task.set_terminated(False)
+            task.set_output([])
     
     def in_memory(self, task, memory):
         """Check if a task has already been added to the tasks to be executed.
@@ -40,7 +86,7 @@ class Pipeline(object):
         """
         result = False
         index = len(memory) - 1
-        while (not result) or (index >= 0):
+        while (not result) and (index >= 0):
             result = task.name==memory[index].name
             index -= 1
         return result
@@ -51,22 +97,39 @@ class Pipeline(object):
             - task: Task
             - logger: Logger object
         """
-        self.tasks = []
+        # retrieve all the tasks connected to the root task
+        self.root = task
+        tasks = []
         queue = [task]
-        count = 1
         while queue:
-            task = queue.pop()                
-            if (not task.is_terminated()) and task.is_waiting():
-                if count==0:
-                    logger.error("Loop detected... Please check tasks dependencies.")
-                else:
-                    queue = [task] + queue
-                    count -= 1
-            elif (not task.is_terminated()):
-                self.tasks.append(task)
-                task.set_terminated(True)
-                queue = task.children + queue
-                count += len(task.children)
+            task = queue.pop()
+            if task not in tasks and not task.is_static(): # the input of a previous computation is not part of the graph
+                tasks.append(task)
+                queue += task.get_children() + task.get_input_dependencies()
+        # edges of the graph: parents -> children
+        self.dependents = {task: [] for task in tasks}
+        parents = {task: set() for task in tasks}
+        for task in tasks:
+            for parent in task.get_input_dependencies():
+                if parent in parents:
+                    parents[task].add(parent)
+                    self.dependents[parent].append(task)
+            for child in task.get_children():
+                parents[child].add(task)
+        # topological sort (Kahn's algorithm)
+        self.tasks = []
+        ready = [task for task in tasks if not parents[task]]
+        while ready:
+            task = ready.pop(0)
+            self.tasks.append(task)
+            for child in tasks:
+                if task in parents[child]:
+                    parents[child].remove(task)
+                    if not parents[child]:
+                        ready.append(child)
+        if len(self.tasks) < len(tasks):
+            self.tasks = []
+            logger.error("Loop detected... Please check tasks dependencies.")
         self.reset_tasks()
         logger.info("The pipeline was fitted without error.", end='\n')
             
@@ -78,20 +141,225 @@ class Pipeline(object):
             - output_path: str
             - logger: Logger object
         """
-        inputs = [{'X_train':X_train, 'Y_train':Y_train, 'run_train': None, 'run_test': None}]
         if not self.tasks:
             logger.warning("Pipeline not fitted... Nothing to compute.")
-        else:
-            empty_task = Task()
-            empty_task.set_output(inputs)
-            empty_task.set_terminated(True)
-            self.tasks[0].add_input_dependencies(empty_task)
-            for index, task in enumerate(self.tasks):
-                logger.info("{}. Executing task: {}".format(index, task.name))
-                task.execute()
+            return None
+        if self.shared_outputs is not None:
+            self.shared_outputs.set_shared_input(hash_key(X_train))
+        if self.checkpointer is not None:
+            self.checkpointer.set_input(hash_key(X_train, Y_train))
+            # the fold views are checkpointed as indexes over the (named) input stores
+            X_train, Y_train = [RunStore(runs, key=key).view(range(len(runs))) for key, runs in [('X_train', X_train), ('Y_train', Y_train)]]
+            self.checkpointer.set_stores([X_train.store, Y_train.store])
+        inputs = [{'X_train':X_train, 'Y_train':Y_train, 'run_train': None, 'run_test': None}]
+        self.root.input_dependencies = [task for task in self.root.input_dependencies if not task.is_static()]
+        self.input_task = Task()
+        self.input_task.set_output(inputs)
+        self.input_task.set_terminated(True)
+        self.root.add_input_dependencies(self.input_task)
+        self.reset_tasks()
+        with self.span('compute'):
+            if self.scheduler=='sequential':
+                for index, task in enumerate(self.tasks):
+                    logger.info("{}. Executing task: {}".format(index, task.name))
+                    task.execute(checkpointer=self.checkpointer, profiler=self.profiler, logger=logger, callback=self.store_item)
+                    logger.validate()
+            else:
+                logger.info("Executing tasks: {}".format(', '.join([task.name for task in self.tasks])))
+                self.compute_dataflow(logger)
                 logger.validate()
-            #logger.info("Saving output...")
-            #task.save_output(output_path)
-            #logger.validate()
+        logger.report_progress()
+        for results_store in self.results_stores:
+            results_store.close()
+        if self.profiler is not None:
+            self.profiler.summarize(self.tasks)
+        task = self.tasks[-1]
+        #logger.info("Saving output...")
+        #task.save_output(output_path)
+        #logger.validate()
         logger.info("The pipeline was executed without error.", end='\n')
         return task.output
+    
+    def span(self, name):
+        """ Record the resources used by a block of code with the profiler
+        (nothing is done without profiler).
+        Arguments:
+            - name: str
+        """
+        return self.profiler.span(name) if self.profiler is not None else nullcontext()
+    
+    def compute_dataflow(self, logger):
+        """ Execute the items of all tasks as soon as their inputs are ready.
+        Arguments:
+            - logger: Logger object
+        """
+        for task in self.tasks:
+            task.reset_items()
+            task.set_output([])
+        running = {} # future -> (task, item index)
+        executors = [task.executor for task in self.tasks]
+        self.completed = set()
+        if self.checkpointer is not None:
+            self.load_checkpoints(logger)
+        try:
+            while True:
+                future = self.submit_ready_item(running)
+                while (future is not None) and (not future.done()):
+                    future = self.submit_ready_item(running) # fill the workers of parallel executors
+                if not running:
+                    if all(task.is_terminated() for task in self.tasks):
+                        break
+                    elif future is None:
+                        logger.error("Dataflow stalled: tasks {} cannot be computed.".format(', '.join([task.name for task in self.tasks if not task.is_terminated()])))
+                    continue
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, index = running.pop(future)
+                    output, info = future.result()
+                    if self.profiler is not None:
+                        self.profiler.add(info)
+                        info = info[-1]['wall_time'] # record of the whole item
+                    self.add_item(task, index, output)
+                    logger.progress(task.name, index, task.get_nb_items(), duration=info)
+                self.release_outputs()
+        finally:
+            for executor in executors:
+                executor.shutdown()
+        for task in self.tasks:
+            if not self.dependents[task] or not self.free_memory:
+                task.collect_output()
+    
+    def submit_ready_item(self, running):
+        """ Submit an input item whose dependencies are computed, starting 
+        with the most downstream tasks, without exceeding the number of workers 
+        of their executors.
+        Arguments:
+            - running: dict (future -> (Task, int))
+        Returns:
+            - future: Future (None if no item could be submitted)
+        """
+        for task in reversed(self.tasks):
+            if task.is_terminated() or task.nb_items is not None and task.first_unsubmitted >= task.nb_items:
+                continue
+            index = task.first_unsubmitted
+            while (task.nb_items is None) or (index < task.nb_items):
+                if index in task.submitted:
+                    index += 1
+                    continue
+                if (self.checkpointer is not None) and self.checkpointer.has_item(task, index):
+                    task.set_item_submitted(index)
+                    self.add_item(task, index, self.checkpointer.load_item(task, index), save=False)
+                    continue
+                if len([item for item in running.values() if item[0].executor is task.executor]) >= task.executor.n_jobs:
+                    break
+                status, input_ = task.get_input_item(index)
+                if status==MISSING:
+                    task.set_nb_items(index)
+                    self.save_complete(task)
+                    return self.submit_ready_item(running) # children may now know their number of items
+                elif status==WAIT:
+                    break
+                elif status==READY:
+                    task.set_item_submitted(index)
+                    if self.profiler is None:
+                        future = task.executor.submit(timed_functions, task.functions, input_)
+                    else:
+                        future = task.executor.submit(profile_functions, task.functions, task.name, (index, input_, self.profiler.get_profile_path(task, index)))
+                    running[future] = (task, index)
+                    return future
+                index += 1
+        return None
+    
+    def add_item(self, task, index, output, save=True):
+        """ Add the output of an item to a task, and save it.
+        Arguments:
+            - task: Task
+            - index: int
+            - output: dict / list
+            - save: bool
+        """
+        task.add_item(index, output)
+        if (self.checkpointer is not None) and save:
+            self.checkpointer.save_item(task, index, output)
+        self.store_item(task, index, output)
+        self.save_complete(task)
+    
+    def store_item(self, task, index, output):
+        """ Write the output of an item to the results stores.
+        Arguments:
+            - task: Task
+            - index: int
+            - output: dict / list
+        """
+        for results_store in self.results_stores:
+            results_store.add(task, index, output)
+    
+    def save_complete(self, task):
+        """ Mark a task as complete in the checkpoints once all its items are computed.
+        Arguments:
+            - task: Task
+        """
+        if (self.checkpointer is not None) and task.is_terminated() and (task not in self.completed):
+            self.checkpointer.mark_complete(task, task.nb_items, task.unflatten_factor)
+            self.completed.add(task)
+    
+    def load_checkpoints(self, logger):
+        """ Load the complete tasks that are needed, and skip the tasks
+        that are not needed by any incomplete task.
+        Arguments:
+            - logger: Logger object
+        """
+        complete = {task: self.checkpointer.is_complete(task) for task in self.tasks}
+        self.completed = set(task for task in self.tasks if complete[task])
+        needed = {}
+        for task in reversed(self.tasks):
+            needed[task] = (not self.dependents[task]) or any(needed[child] and not complete[child] for child in self.dependents[task])
+        for task in self.tasks:
+            if complete[task] and needed[task]:
+                logger.report_state("(loading checkpoint of {})".format(task.name))
+                task.load_checkpoint(self.checkpointer, self.checkpointer.load_complete(task))
+                for index in range(task.nb_items):
+                    self.store_item(task, index, task.items[index])
+            elif not needed[task]:
+                logger.report_state("(skipping {})".format(task.name))
+                task.set_terminated(True)
+                if complete[task] and any(results_store.accepts(task) for results_store in self.results_stores):
+                    self.store_checkpoint(task) # the stores are rewritten from scratch
+    
+    def store_checkpoint(self, task):
+        """ Write the checkpointed items of a skipped task to the results
+        stores, one item at a time.
+        Arguments:
+            - task: Task
+        """
+        info = self.checkpointer.load_complete(task)
+        if task.unflatten:
+            task.unflatten_factor = info['unflatten_factor']
+        for index in range(info['nb_items']):
+            self.store_item(task, index, self.checkpointer.load_item(task, index))
+    
+    def clear_outputs(self):
+        """ Release the outputs of all the tasks (e.g. once the maps
+        are read from the results stores).
+        """
+        for task in self.tasks:
+            task.release_items(float('inf'))
+            task.set_output(None)
+    
+    def release_outputs(self):
+        """ Release the outputs that are not needed by any task anymore."""
+        if not self.free_memory:
+            return
+        for task in self.tasks:
+            if not self.dependents[task]:
+                continue
+            bounds = []
+            for child in self.dependents[task]:
+                if child.is_terminated():
+                    continue
+                index = child.input_dependencies.index(task)
+                bounds.append(task.get_lowest_required_item(child.first_unsubmitted, child.flatten[index]))
+            if bounds:
+                task.release_items(min(bounds))
+            elif task.is_terminated():
+                task.release_items(float('inf'))
@@ -0,0 +1,143 @@
+"""
+Rendering of the maps (NIfTI images and figures), possibly deferred.
+===================================================
+A Renderer instanciation requires:
+    - mode: string, when the maps are rendered:
+        - 'sync': right away (as before),
+        - 'async': in a background pool of worker processes, while the job goes on,
+        - 'deferred': later, with the command below,
+        - 'none': never (only the raw maps are saved),
+    - n_jobs: int, number of worker processes of the 'async' mode,
+    - compress: bool, specifying if the NIfTI images are gzipped ('.nii.gz') or not ('.nii').
+
+Each map is first saved as a raw array ('<output_path>.npy'). For the 'async' and 'deferred'
+modes, the rendering parameters (mask image, thresholds, compression) are saved next to it
+('<output_path>_render.yml'), so that the map can be rendered from the files only.
+
+Usage (render the deferred maps of an output folder):
+    python rendering.py --folder <path_to_output_folder> --n_jobs <number_of_workers>
+"""
+
+
+
+import os
+import glob
+import argparse
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ProcessPoolExecutor
+from nilearn.input_data import NiftiMasker
+
+from utils import read_yaml, save_yaml, create_maps
+from logger import Logger
+
+
+RENDERING_MODES = ['sync', 'async', 'deferred', 'none']
+
+
+
+def get_image_path(output_path, compress=True):
+    """ Path of the NIfTI image of a map.
+    Arguments:
+        - output_path: str
+        - compress: bool
+    Returns:
+        - str
+    """
+    return output_path + ('.nii.gz' if compress else '.nii')
+
+def render_map(output_path, log_path=None):
+    """ Render a map from its raw array and rendering parameters.
+    Arguments:
+        - output_path: str
+        - log_path: str (logs of the rendering, '<output_path>_render_logs.txt' if None)
+    """
+    spec = read_yaml(output_path + '_render.yml')
+    logger = Logger(log_path if log_path is not None else output_path + '_render_logs.txt')
+    masker = NiftiMasker(mask_img=nib.load(spec['mask_path'])).fit()
+    create_maps(masker, np.load(output_path + '.npy'), output_path, vmax=spec['vmax'], not_glass_brain=spec['not_glass_brain'], logger=logger,
+                    distribution_max=spec['distribution_max'], distribution_min=spec['distribution_min'], compress=spec['compress'])
+    logger.flush() # exit handlers are not run in the workers
+
+
+
+class Renderer(object):
+    """ Save the maps, and render them right away, in background
+    or later.
+    """
+
+    def __init__(self, mode='sync', n_jobs=1, compress=True):
+        """ Instanciation of Renderer class.
+        Arguments:
+            - mode: str
+            - n_jobs: int
+            - compress: bool
+        """
+        if mode not in RENDERING_MODES:
+            raise Exception('Rendering mode {} not known.'.format(mode))
+        self.mode = mode
+        self.n_jobs = n_jobs
+        self.compress = compress
+        self.pool = None
+        self.futures = []
+
+    def render(self, masker, distribution, output_path, logger, mask_path=None, vmax=None, not_glass_brain=False, distribution_max=None, distribution_min=None):
+        """ Save a map and render it according to self.mode.
+        Arguments:
+            - masker: NiftiMasker
+            - distribution: np.array (1D)
+            - output_path: str
+            - logger: Logger
+            - mask_path: str (mask image, needed by the 'async' and 'deferred' modes)
+            - vmax: float
+            - not_glass_brain: bool
+            - distribution_max: float
+            - distribution_min: float
+        """
+        np.save(output_path + '.npy', distribution)
+        if self.mode=='sync':
+            create_maps(masker, distribution, output_path, vmax=vmax, not_glass_brain=not_glass_brain, logger=logger,
+                            distribution_max=distribution_max, distribution_min=distribution_min, compress=self.compress)
+        elif self.mode in ['async', 'deferred']:
+            if mask_path is None:
+                raise Exception('The mask image is needed to render the maps in {} mode.'.format(self.mode))
+            save_yaml({'mask_path': os.path.abspath(mask_path), 'vmax': vmax, 'not_glass_brain': not_glass_brain, 'compress': self.compress,
+                        'distribution_max': distribution_max, 'distribution_min': distribution_min}, output_path + '_render.yml')
+            if self.mode=='async':
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+                logger.flush() # the workers append to the same log file
+                self.futures.append((self.pool.submit(render_map, output_path, logger.log_path), logger))
+
+    def close(self):
+        """ Wait for the maps rendered in background, and release the workers."""
+        for future, logger in self.futures:
+            try:
+                future.result()
+            except Exception as err:
+                logger.exception(err)
+        self.futures = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description="""Render the maps saved by jobs with a deferred rendering.""")
+    parser.add_argument("--folder", type=str, required=True,
+                            help="Output folder of the maps (searched recursively).")
+    parser.add_argument("--n_jobs", type=int, default=1,
+                            help="Number of worker processes.")
+    parser.add_argument("--overwrite", action='store_true',
+                            help="Render the maps whose NIfTI image already exists.")
+
+    args = parser.parse_args()
+    output_paths = [path[:-len('_render.yml')] for path in sorted(glob.glob(os.path.join(args.folder, '**', '*_render.yml'), recursive=True))]
+    output_paths = [path for path in output_paths if args.overwrite or not os.path.exists(get_image_path(path, read_yaml(path + '_render.yml')['compress']))]
+    print('Rendering {} maps...'.format(len(output_paths)))
+    with ProcessPoolExecutor(max_workers=args.n_jobs) as pool:
+        for output_path, _ in zip(output_paths, pool.map(render_map, output_paths)):
+            print('{} --> Done'.format(output_path))
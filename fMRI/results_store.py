@@ -0,0 +1,163 @@
+"""
+Chunked and compressed store of the results of the encoding models, fold by fold.
+===================================================
+A ResultsStore instanciation requires:
+    - path: string, path of the HDF5 file ('<output_path>results.hdf5'),
+    - subject: string,
+    - model_name: string,
+    - voxels: slice (or None), voxels of the maps kept by the store (when several subjects
+    are fitted jointly, see utils.stack_subjects),
+    - compression: string (or None), HDF5 compression filter ('gzip', 'lzf'),
+    - chunk_size: int, number of voxels per chunk.
+
+The outputs of the encoding tasks are written as soon as each fold is computed
+(Pipeline.store_item), under '/<subject>/<model_name>/':
+    - 'internal/<metric>': (outer fold x inner fold x alpha x voxel) scores of the grid search,
+    - 'internal/alpha': (outer fold x inner fold x alpha) regularization parameters (outer fold x
+    inner fold x 1 x voxel for the adaptive alpha search, see encoding_models),
+    - 'external/<metric>': (outer fold x voxel) scores (and selected alphas) of the evaluation,
+    - 'mean/<metric>': average over the outer folds, updated as a running aggregate.
+The group of the model is rewritten from scratch at each run: when a run resumes from
+checkpoints, the items of the encoding tasks that are skipped are read from the checkpoints
+and written again (see Pipeline.store_checkpoint).
+Each chunk holds the voxels of a single fold and alpha, so that readers (see read_results)
+can retrieve some voxels or alphas without loading the whole file.
+"""
+
+
+
+import h5py
+import numpy as np
+
+from utils import RunningMean
+
+
+STAGES = {'encoding_model_internal': 'internal', 'encoding_model_external': 'external'}
+
+
+
+def read_results(path, subject, model_name, name, folds=slice(None), alphas=slice(None), voxels=slice(None)):
+    """ Read a slice of a dataset of a results store (only the
+    chunks containing the slice are read).
+    Arguments:
+        - path: str
+        - subject: str
+        - model_name: str
+        - name: str (e.g. 'internal/R2', 'external/Pearson_coeff', 'mean/R2')
+        - folds: slice / int / tuple (outer fold, inner fold) for internal datasets
+        - alphas: slice / int (internal datasets only)
+        - voxels: slice / int
+    Returns:
+        - np.array
+    """
+    with h5py.File(path, 'r') as f:
+        dataset = f['/'.join([subject, model_name, name])]
+        folds = folds if isinstance(folds, tuple) else (folds,)
+        if name.startswith('internal'):
+            folds = folds + (slice(None),) * (2 - len(folds))
+            index = folds + ((alphas,) if name.endswith('alpha') and dataset.ndim==3 else (alphas, voxels))
+        elif name.startswith('external'):
+            index = folds + (voxels,)
+        else:
+            index = (voxels,)
+        return dataset[index]
+
+
+
+class ResultsStore(object):
+    """ Write the fold outputs of the encoding tasks to a HDF5 file.
+    """
+
+    def __init__(self, path, subject, model_name, voxels=None, compression='gzip', chunk_size=4096):
+        """ Instanciation of ResultsStore class.
+        Arguments:
+            - path: str
+            - subject: str
+            - model_name: str
+            - voxels: slice
+            - compression: str
+            - chunk_size: int
+        """
+        self.path = path
+        self.group = '/'.join([subject, model_name])
+        self.voxels = voxels if voxels is not None else slice(None)
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.means = RunningMean()
+        self.file = None
+
+    def open(self):
+        """ Open the file, discarding the results of a previous run."""
+        self.file = h5py.File(self.path, 'a')
+        if self.group in self.file:
+            del self.file[self.group]
+        self.means = RunningMean()
+
+    def close(self):
+        """ Close the file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, name, position, value):
+        """ Write an array at a given (fold) position of a dataset, creating
+        or extending the dataset when needed.
+        Arguments:
+            - name: str
+            - position: tuple (of int)
+            - value: np.array
+        """
+        value = np.asarray(value)
+        path = '/'.join([self.group, name])
+        if path not in self.file:
+            shape = tuple(index + 1 for index in position) + value.shape
+            chunks = (1,) * (len(shape) - 1) + (max(1, min(self.chunk_size, shape[-1])),) if value.ndim > 0 else None
+            self.file.create_dataset(path, shape=shape, maxshape=(None,) * len(position) + value.shape, dtype=value.dtype,
+                                        chunks=chunks, compression=self.compression if value.ndim > 0 else None)
+        dataset = self.file[path]
+        for axis, index in enumerate(position):
+            if index >= dataset.shape[axis]:
+                dataset.resize(index + 1, axis=axis)
+        dataset[position] = value
+
+    def accepts(self, task):
+        """ Check if the outputs of a task are written to the store.
+        Arguments:
+            - task: Task
+        Returns:
+            - bool
+        """
+        return task.name in STAGES
+    
+    def add(self, task, index, output):
+        """ Write the output of a fold of an encoding task.
+        Arguments:
+            - task: Task
+            - index: int
+            - output: dict
+        """
+        if not self.accepts(task):
+            return
+        stage = STAGES[task.name]
+        if self.file is None:
+            self.open()
+        if stage=='internal':
+            position = divmod(index, task.get_unflatten_factor()) # (outer fold, inner fold)
+            for key, value in output.items():
+                self.write('internal/' + key, position, value if key=='alpha' and np.ndim(value) < 2 else np.asarray(value)[..., self.voxels])
+        else:
+            maps = {key: np.asarray(value)[..., self.voxels] for key, value in output.items()}
+            for key, value in maps.items():
+                self.write('external/' + key, (index,), value)
+            self.means.add(maps)
+            for key, value in self.means.get().items():
+                self.write('mean/' + key, (), value)
+            self.file[self.group].attrs['nb_folds'] = self.means.count
+        self.file.flush()
+
+    def get_means(self):
+        """ Get the averages of the external maps over the folds.
+        Returns:
+            - dict (of np.array)
+        """
+        return self.means.get()
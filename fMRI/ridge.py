@@ -0,0 +1,122 @@
+"""
+Closed-form Ridge regression computed from a single decomposition of the design-matrix.
+===================================================
+A RidgeFactorization instanciation requires:
+    - X_train: np.array, the (stacked) design-matrix of the training runs,
+    - fit_intercept: bool specifying if we center the data before fitting (as sklearn Ridge does),
+    - dtype: dtype of the products with the fMRI data (the decomposition itself is
+    always computed in float64).
+
+The design-matrix is decomposed once (thin SVD of the centered matrix) and the Ridge
+solutions for any number of regularization hyperparameters are then obtained by
+rescaling the singular values:
+    coef(alpha) = V diag(s / (s**2 + alpha)) U.T (Y - Y_mean)
+This allows to compute predictions for a whole grid of alphas (or for a different
+alpha per voxel) at the cost of a matrix product instead of a full fit.
+"""
+
+
+
+import numpy as np
+
+
+
+class RidgeFactorization(object):
+    """ Thin SVD of a design-matrix, from which Ridge solutions
+    are derived for any regularization hyperparameter.
+    """
+
+    def __init__(self, X_train, fit_intercept=True, dtype=None):
+        """ Instanciation of RidgeFactorization class.
+        Arguments:
+            - X_train: np.array (2D)
+            - fit_intercept: bool
+            - dtype: str / np.dtype (X_train dtype if None)
+        """
+        self.fit_intercept = fit_intercept
+        self.dtype = np.dtype(dtype) if dtype is not None else X_train.dtype
+        X_train = np.asarray(X_train, dtype=np.float64)
+        self.X_mean = np.mean(X_train, axis=0) if fit_intercept else np.zeros(X_train.shape[1])
+        U, self.s, self.Vt = np.linalg.svd(X_train - self.X_mean, full_matrices=False)
+        self.U = U.astype(self.dtype, copy=False)
+        self.U_sum = np.sum(U, axis=0)
+
+    def project(self, Y_train):
+        """ Project the (centered) fMRI data on the left singular vectors.
+        Arguments:
+            - Y_train: np.array (2D)
+        Returns:
+            - UtY: np.array (2D)
+            - Y_mean: np.array (1D)
+        """
+        UtY = np.dot(self.U.T, Y_train)
+        if self.fit_intercept:
+            Y_mean = np.mean(Y_train, axis=0, dtype=np.float64)
+            UtY -= np.outer(self.U_sum, Y_mean)
+        else:
+            Y_mean = np.zeros(Y_train.shape[1])
+        return UtY, Y_mean
+
+    def transform(self, X_test):
+        """ Express a design-matrix in the basis of the right singular vectors.
+        Arguments:
+            - X_test: np.array (2D)
+        Returns:
+            - np.array (2D)
+        """
+        return np.dot(X_test - self.X_mean, self.Vt.T).astype(self.dtype, copy=False)
+
+    def shrinkage(self, alpha):
+        """ Compute the shrinkage factors s / (s**2 + alpha).
+        Arguments:
+            - alpha: float / np.array (1D)
+        Returns:
+            - np.array (1D if alpha is a float, 2D (components x voxels) otherwise)
+        """
+        if np.ndim(alpha)==0:
+            return self.s / (self.s ** 2 + alpha)
+        return self.s[:, None] / (self.s[:, None] ** 2 + np.asarray(alpha)[None, :])
+
+    def coefficients(self, UtY, alpha):
+        """ Compute Ridge coefficients for a single alpha or for
+        an alpha per voxel.
+        Arguments:
+            - UtY: np.array (2D)
+            - alpha: float / np.array (1D)
+        Returns:
+            - np.array (2D)
+        """
+        shrinkage = self.shrinkage(alpha)
+        if shrinkage.ndim==1:
+            shrinkage = shrinkage[:, None]
+        return np.dot(self.Vt.T, shrinkage * UtY)
+
+    def predict(self, X_test_projected, UtY, Y_mean, alpha):
+        """ Compute predictions for a single alpha or for
+        an alpha per voxel.
+        Arguments:
+            - X_test_projected: np.array (2D), output of self.transform
+            - UtY: np.array (2D)
+            - Y_mean: np.array (1D)
+            - alpha: float / np.array (1D)
+        Returns:
+            - predictions: np.array (2D)
+        """
+        shrinkage = self.shrinkage(alpha)
+        if shrinkage.ndim==1:
+            shrinkage = shrinkage[:, None]
+        predictions = np.dot(X_test_projected, (shrinkage * UtY).astype(X_test_projected.dtype, copy=False))
+        predictions += Y_mean
+        return predictions
+
+    def predict_path(self, X_test_projected, UtY, Y_mean, alpha_list):
+        """ Compute predictions for each alpha of a list.
+        Arguments:
+            - X_test_projected: np.array (2D), output of self.transform
+            - UtY: np.array (2D)
+            - Y_mean: np.array (1D)
+            - alpha_list: list (of float)
+        Returns:
+            - np.array (3D: alphas x time x voxels)
+        """
+        return np.stack([self.predict(X_test_projected, UtY, Y_mean, alpha) for alpha in alpha_list], axis=0)
@@ -0,0 +1,122 @@
+"""
+Vectorized computation of the scores (R2, Pearson coefficient, ...) of encoding models.
+===================================================
+A Scorer instanciation requires:
+    - metrics: list of the names of the metrics to compute (keys of METRICS),
+    - chunk_size: int (or None), number of voxels processed at once to keep the
+    memory usage bounded.
+
+The metrics are computed for whole blocks of predictions with batched numpy
+reductions over the time axis. A block can be 2D (time x voxels) or have leading
+dimensions, e.g. 3D (alphas x time x voxels), in which case a score is computed
+for each leading index.
+Blocks can be float32: the reductions are accumulated in float64.
+Constant voxels do not generate NaN values: their Pearson coefficient is set to 0
+and their R2 follows sklearn conventions (1 if perfectly predicted, 0 otherwise).
+New metrics only need to be added to the METRICS dictionary.
+"""
+
+
+
+import numpy as np
+
+
+
+def r2_score(predictions, Y_test):
+    """ Compute the R2 score for each voxel.
+    Arguments:
+        - predictions: np.array (..., time, voxels)
+        - Y_test: np.array (time, voxels)
+    Returns:
+        - np.array (..., voxels)
+    """
+    Y_test = np.asarray(Y_test, dtype=np.float64)
+    numerator = np.sum((Y_test - predictions) ** 2, axis=-2, dtype=np.float64)
+    denominator = np.sum((Y_test - np.mean(Y_test, axis=0)) ** 2, axis=0)
+    denominator = np.broadcast_to(denominator, numerator.shape)
+    valid = denominator != 0
+    result = np.where(numerator != 0, 0., 1.)
+    result[valid] = 1 - numerator[valid] / denominator[valid]
+    return result
+
+def pearson_coeff(predictions, Y_test):
+    """ Compute the Pearson correlation coefficient for each voxel.
+    Arguments:
+        - predictions: np.array (..., time, voxels)
+        - Y_test: np.array (time, voxels)
+    Returns:
+        - np.array (..., voxels)
+    """
+    Y_centered = Y_test - np.mean(Y_test, axis=0, dtype=np.float64)
+    predictions_centered = predictions - np.mean(predictions, axis=-2, keepdims=True, dtype=np.float64)
+    covariance = np.sum(predictions_centered * Y_centered, axis=-2)
+    norm = np.sqrt(np.sum(predictions_centered ** 2, axis=-2) * np.sum(Y_centered ** 2, axis=0))
+    result = np.zeros(covariance.shape)
+    np.divide(covariance, norm, out=result, where=norm!=0)
+    return np.clip(result, -1., 1.)
+
+
+METRICS = {'R2': r2_score,
+            'Pearson_coeff': pearson_coeff
+            }
+
+
+
+class Scorer(object):
+    """ Compute several metrics over blocks of predictions,
+    voxel chunk by voxel chunk.
+    """
+
+    def __init__(self, metrics=['R2', 'Pearson_coeff'], chunk_size=None):
+        """ Instanciation of Scorer class.
+        Arguments:
+            - metrics: list (of str)
+            - chunk_size: int
+        """
+        for metric in metrics:
+            if metric not in METRICS:
+                raise Exception('Metric {} not known.'.format(metric))
+        self.metrics = metrics
+        self.chunk_size = chunk_size
+
+    def get_chunks(self, nb_voxels):
+        """ Split the voxel axis into chunks.
+        Arguments:
+            - nb_voxels: int
+        Returns:
+            - list (of slice)
+        """
+        chunk_size = self.chunk_size if self.chunk_size else nb_voxels
+        return [slice(start, min(start + chunk_size, nb_voxels)) for start in range(0, nb_voxels, max(chunk_size, 1))]
+
+    def score(self, predictions, Y_test):
+        """ Compute all metrics for a block of predictions.
+        Arguments:
+            - predictions: np.array (..., time, voxels)
+            - Y_test: np.array (time, voxels)
+        Returns:
+            - result: dict (of np.array (..., voxels))
+        """
+        return self.score_by_chunk(lambda chunk: predictions[..., chunk], Y_test)
+
+    def score_by_chunk(self, predict, Y_test):
+        """ Compute all metrics from predictions that are generated
+        chunk by chunk, so that the whole prediction block never
+        has to be held in memory.
+        Arguments:
+            - predict: function taking a slice of voxels and returning
+            the predictions (..., time, voxels) for those voxels
+            - Y_test: np.array (time, voxels)
+        Returns:
+            - result: dict (of np.array (..., voxels))
+        """
+        result = {}
+        for chunk in self.get_chunks(Y_test.shape[1]):
+            predictions = predict(chunk)
+            y_test = Y_test[:, chunk]
+            for metric in self.metrics:
+                scores = METRICS[metric](predictions, y_test)
+                if metric not in result:
+                    result[metric] = np.zeros(scores.shape[:-1] + (Y_test.shape[1],))
+                result[metric][..., chunk] = scores
+        return result
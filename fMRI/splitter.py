@@ -5,13 +5,182 @@ regression analysis pipeline.
 A Splitter instanciation requires:
     - out_per_fold: the number of run to left out for the test set.
 It makes use of the sklearn LeavePOut, and allows to keep track of the indexes of the runs.
+
+The folds do not copy the run matrices: the runs are kept once in a RunStore, and
+the X_train, Y_train, X_test and Y_test entries of a fold are Runs views only holding
+the indexes of their runs in the store (nested splits compose the indexes).
+A Runs view behaves as a list of matrices (len, indexing, iteration), and the stacked
+function concatenates it into a buffer of the store, reused from one fold to the
+next, so that at most one concatenated copy of the data exists per running fold.
+Once released, a single free buffer (the largest) is kept by trailing shape and dtype
+(e.g. the design-matrices, and the fMRI data of each width of voxel blocks), the other
+ones being freed.
 """
 
 
+
+import threading
+import numpy as np
+
+from contextlib import contextmanager
 from sklearn.model_selection import LeavePOut
 
 
 
+class RunStore(object):
+    """ Shared storage of the run matrices, with a pool of buffers
+    for their concatenation.
+    """
+
+    def __init__(self, runs, key=None):
+        """ Instanciation of RunStore class.
+        Arguments:
+            - runs: list (of np.array)
+            - key: str (or None), name of the store when it holds the input 
+            of the pipeline (the checkpoints only refer to it by this name)
+        """
+        self.runs = list(runs)
+        self.key = key
+        self.buffers = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Locks cannot be pickled (process executors, checkpoints):
+        the buffers are not sent either.
+        """
+        state = self.__dict__.copy()
+        del state['lock']
+        state['buffers'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def view(self, indexes):
+        """ Get a view over some runs of the store.
+        Arguments:
+            - indexes: list (of int)
+        Returns:
+            - Runs
+        """
+        return Runs(self, indexes)
+
+    def acquire(self, shape, dtype):
+        """ Get the smallest free buffer of at least shape[0] rows, allocating
+        a new one only if no free buffer is large enough.
+        Arguments:
+            - shape: tuple (of int)
+            - dtype: np.dtype
+        Returns:
+            - np.array
+        """
+        with self.lock:
+            fitting = [index for index, buffer in enumerate(self.buffers) if buffer.shape[0] >= shape[0] and buffer.shape[1:]==shape[1:] and buffer.dtype==dtype]
+            if fitting:
+                return self.buffers.pop(min(fitting, key=lambda index: self.buffers[index].shape[0]))
+            smaller = [index for index, buffer in enumerate(self.buffers) if buffer.shape[1:]==shape[1:] and buffer.dtype==dtype]
+            if smaller:
+                self.buffers.pop(smaller[0]) # too small: replaced by the new one when released
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        """ Give a buffer back to the pool, keeping a single free buffer
+        (the largest) per trailing shape and dtype.
+        Arguments:
+            - buffer: np.array
+        """
+        with self.lock:
+            same = [index for index, free in enumerate(self.buffers) if free.shape[1:]==buffer.shape[1:] and free.dtype==buffer.dtype]
+            if same:
+                if self.buffers[same[0]].shape[0] >= buffer.shape[0]:
+                    return # freed
+                self.buffers.pop(same[0])
+            self.buffers.append(buffer)
+
+
+
+class Runs(object):
+    """ List-like view over some runs of a RunStore.
+    """
+
+    def __init__(self, store, indexes):
+        """ Instanciation of Runs class.
+        Arguments:
+            - store: RunStore
+            - indexes: list (of int)
+        """
+        self.store = store
+        self.indexes = np.asarray(indexes, dtype=int)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Runs(self.store, self.indexes[index])
+        return self.store.runs[self.indexes[index]]
+
+    def __iter__(self):
+        for index in self.indexes:
+            yield self.store.runs[index]
+
+    def take(self, positions):
+        """ Get a view over a subset of the runs of the view.
+        Arguments:
+            - positions: list (of int)
+        Returns:
+            - Runs
+        """
+        return Runs(self.store, self.indexes[np.asarray(positions, dtype=int)])
+
+    def materialize(self):
+        """ Get the run matrices.
+        Returns:
+            - list (of np.array)
+        """
+        return list(self)
+
+    @contextmanager
+    def stacked(self, columns=None):
+        """ Concatenate the runs (or some of their columns) vertically 
+        into a buffer of the store.
+        The array is only valid inside the with block.
+        Arguments:
+            - columns: slice (all columns if None)
+        Yields:
+            - np.array
+        """
+        runs = self.materialize() if columns is None else [run[:, columns] for run in self]
+        nb_rows = sum(run.shape[0] for run in runs)
+        buffer = self.store.acquire((nb_rows,) + runs[0].shape[1:], np.result_type(*runs))
+        try:
+            array = buffer[:nb_rows]
+            np.concatenate(runs, axis=0, out=array)
+            yield array
+        finally:
+            self.store.release(buffer)
+
+
+@contextmanager
+def stacked(matrices, columns=None):
+    """ Concatenate vertically a list of matrices (or some of their 
+    columns), using the buffers of the store for Runs views.
+    The array is only valid inside the with block.
+    Arguments:
+        - matrices: Runs / list (of np.array)
+        - columns: slice (all columns if None)
+    Yields:
+        - np.array
+    """
+    if isinstance(matrices, Runs):
+        with matrices.stacked(columns) as array:
+            yield array
+    else:
+        yield np.vstack(matrices if columns is None else [matrix[:, columns] for matrix in matrices])
+
+
+
 class Splitter(object):
     """ Tools to split lists or groups into several folds.
     """
@@ -27,25 +196,25 @@ class Splitter(object):
     
     def split(self, X_train, Y_train, run_train=None, run_test=None):
         """ Split lists in differents folds for cross validation.
+        The folds are views over the runs of X_train and Y_train: no
+        matrix is copied.
         Arguments:
-            - X_train: list
-            - Y_train: list
+            - X_train: list / Runs
+            - Y_train: list / Runs
             - run_train: list
             - run_test: list
         Returns:
             - list (of dict)
         """
+        X_train = X_train if isinstance(X_train, Runs) else RunStore(X_train).view(range(len(X_train)))
+        Y_train = Y_train if isinstance(Y_train, Runs) else RunStore(Y_train).view(range(len(Y_train)))
         result = []
         logo = LeavePOut(self.out_per_fold)
-        for train, test in logo.split(X_train):
-            y_train = [Y_train[i] for i in train]
-            x_train = [X_train[i] for i in train]
-            y_test = [Y_train[i] for i in test]
-            x_test = [X_train[i] for i in test]
-            result.append({'X_train': x_train,
-                        'Y_train': y_train,
-                        'X_test': x_test,
-                        'Y_test': y_test,
+        for train, test in logo.split(np.arange(len(X_train))):
+            result.append({'X_train': X_train.take(train),
+                        'Y_train': Y_train.take(train),
+                        'X_test': X_train.take(test),
+                        'Y_test': Y_train.take(test),
                         'run_train': [run_train[index] for index in train] if run_train is not None else train,
                         'run_test': [run_train[index] for index in test] if run_train is not None else test
                         })
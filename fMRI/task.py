@@ -12,15 +12,65 @@ A Task instanciation requires:
     - unflatten_output: ('automatic' / int / None), specifying if we unflatten the output of this
     particular task, 
     - special_output_transform: function that should be applied on the final output
-    of the task.
+    of the task,
+    - executor: executor (see executors.py) used to run the functions over the items 
+    of the input (serial by default),
+    - config: dict regrouping the parameters the functions depend on (used to identify 
+    the outputs of the task when checkpointing).
 The task is executed through the method self.execute() which aggregates the output of 
 parent tasks to give it as input to the current task.
 It then apply sequentially the functions in self.functions on each item of its input.
+The items are independent (folds), so they can be processed in parallel by the executor;
+the order of the outputs always matches the order of the inputs.
+The get_* methods give an item-level view of the same flow (used by the dataflow
+scheduler of the Pipeline): each item of the input can be built, and processed, as soon 
+as the items of the parent tasks it depends on are computed. In this view, 
+special_output_transform is applied to each element of the output separately.
 """
 
+import time
+
+from functools import partial
+
 from utils import merge_dict, filter_args, save
-from tqdm import tqdm
+from executors import SerialExecutor
+from profiler import profile_functions
+
+
+# status of an item in the item-level view of a task
+READY = 'ready' # item available
+PENDING = 'pending' # item not computed yet, but following items might be
+WAIT = 'wait' # item (and following items) not computed yet
+MISSING = 'missing' # item out of range
+
+
+def apply_functions(functions, input_):
+    """ Apply sequentially a list of functions on a given input.
+    Arguments:
+        - functions: list (of functions)
+        - input_: dict
+    Returns:
+        - dict
+    """
+    input_tmp = input_.copy()
+    for func in functions:
+        input_tmp = filter_args(func, input_tmp)
+        input_tmp = func(**input_tmp)
+    return input_tmp
 
+def timed_functions(functions, input_):
+    """ Apply sequentially a list of functions on a given input (as
+    apply_functions), measuring the duration of the run.
+    Arguments:
+        - functions: list (of functions)
+        - input_: dict
+    Returns:
+        - output: dict
+        - duration: float (seconds)
+    """
+    start = time.perf_counter()
+    output = apply_functions(functions, input_)
+    return output, time.perf_counter() - start
 
 
 class Task(object):
@@ -28,7 +78,7 @@ class Task(object):
     possible to integrate in the pipeline.
     """
     
-    def __init__(self, functions=None, input_dependencies=[], name='', flatten_inputs=None, unflatten_output=None, special_output_transform=None):
+    def __init__(self, functions=None, input_dependencies=None, name='', flatten_inputs=None, unflatten_output=None, special_output_transform=None, executor=None, config=None):
         """ Instanciation of a task.
         Arguments:
             - functions: list (of functions)
@@ -37,25 +87,34 @@ class Task(object):
             - flatten_inputs: list (of bool)
             - unflatten_output: 'automatic' / int / None
             - special_output_transform: function
+            - executor: executor
+            - config: dict
         """
-        self.input_dependencies = input_dependencies
+        self.input_dependencies = input_dependencies if input_dependencies is not None else [] # no shared default list
         self.children = []
         self.terminated = False
         self.functions = functions
         self.name = name
         self.output = []
-        if flatten_inputs and (len(flatten_inputs)==len(input_dependencies)):
-            self.flatten = flatten_inputs if flatten_inputs else [False for item in input_dependencies]
+        if flatten_inputs and (len(flatten_inputs)==len(self.input_dependencies)):
+            self.flatten = flatten_inputs if flatten_inputs else [False for item in self.input_dependencies]
         else:
-            self.flatten = [False for item in input_dependencies]
+            self.flatten = [False for item in self.input_dependencies]
         self.unflatten = unflatten_output
         self.unflatten_factor = unflatten_output if isinstance(unflatten_output, int) else None
         self.special_output_transform= special_output_transform
+        self.reset_items()
+        self.executor = executor if executor is not None else SerialExecutor()
+        self.config = config
     
     def set_children_tasks(self, children):
         """ Set self.children value."""
         self.children = children
     
+    def set_executor(self, executor):
+        """ Set self.executor value."""
+        self.executor = executor
+    
     def set_terminated(self, bool_value):
         """ Set self.terminated value."""
         self.terminated = bool_value
@@ -128,22 +187,267 @@ class Task(object):
         if self.unflatten:
             self.output = [self.output[x : x + self.unflatten_factor] for x in range(0, len(self.output), self.unflatten_factor)]
     
-    def execute(self):
-        """ Execute all task functions on the serie of parents outputs."""
+    def execute(self, checkpointer=None, profiler=None, logger=None, callback=None):
+        """ Execute all task functions on the serie of parents outputs.
+        Arguments:
+            - checkpointer: Checkpointer (items already saved are loaded instead of computed)
+            - profiler: Profiler (records the resources used by each item and function)
+            - logger: Logger (reports the progression of the items)
+            - callback: function called with (task, index, output) for each item
+        """
         if not (self.is_waiting() or self.is_terminated()):
             inputs_ =  list(zip(*[self.flatten_(parent.output, index) for index, parent in enumerate(self.input_dependencies)])) # regroup dictionaries outputs from parent tasks
             inputs_ = [list(item) for item in inputs_] # transform tuple to list -> problematic when 1 single parent
             inputs = [merge_dict(items) for items in inputs_]
-            for input_ in tqdm(inputs):
-                input_tmp = input_.copy()
-                for func in self.functions:
-                    input_tmp = filter_args(func, input_tmp)
-                    input_tmp = func(**input_tmp)
-                self.add_output(input_tmp)
+            to_compute = [index for index in range(len(inputs)) if (checkpointer is None) or (not checkpointer.has_item(self, index))]
+            outputs = {}
+            if profiler is None:
+                results = self.executor.map(partial(timed_functions, self.functions), [inputs[index] for index in to_compute])
+            else:
+                results = self.executor.map(partial(profile_functions, self.functions, self.name), [(index, inputs[index], profiler.get_profile_path(self, index)) for index in to_compute])
+            for index, (output, info) in zip(to_compute, results):
+                if profiler is not None:
+                    profiler.add(info)
+                    info = info[-1]['wall_time'] # record of the whole item
+                if logger is not None:
+                    logger.progress(self.name, index, len(inputs), duration=info)
+                outputs[index] = output
+                if checkpointer is not None:
+                    checkpointer.save_item(self, index, output)
+            for index in range(len(inputs)):
+                self.add_output(outputs[index] if index in outputs else checkpointer.load_item(self, index))
+                if callback is not None:
+                    callback(self, index, self.output[-1])
+            if checkpointer is not None:
+                checkpointer.mark_complete(self, len(inputs), self.unflatten_factor)
             self.set_terminated(True)
             self.unflatten_()
             if self.special_output_transform:
                 self.output = self.special_output_transform(self.output)
         else:
             print('Dependencies not fullfilled...')
-    
\ No newline at end of file
+        
+    def reset_items(self):
+        """ Reset the item-level state of the task."""
+        self.items = {} # raw outputs (before unflatten and special_output_transform) indexed by input item
+        self.submitted = set()
+        self.first_unsubmitted = 0
+        self.last_done = None
+        self.nb_items = None
+        self.nb_released = 0
+        self.elements = {}
+        self.element_lengths = {}
+        if self.unflatten=='automatic':
+            self.unflatten_factor = None
+    
+    def load_checkpoint(self, checkpointer, info):
+        """ Set the item-level state of a task from a complete checkpoint.
+        Arguments:
+            - checkpointer: Checkpointer
+            - info: dict
+        """
+        if self.unflatten:
+            self.unflatten_factor = info['unflatten_factor']
+        for index in range(info['nb_items']):
+            self.set_item_submitted(index)
+            self.items[index] = checkpointer.load_item(self, index)
+            self.last_done = index
+        self.set_nb_items(info['nb_items'])
+    
+    def is_static(self):
+        """ Check if the task only holds a given output (e.g. the pipeline input)."""
+        return self.functions is None
+    
+    def get_unflatten_factor(self):
+        """ Get the size of the groups of the unflattened output, as soon
+        as it can be determined from the parent tasks.
+        Returns:
+            - int (or None)
+        """
+        if self.unflatten_factor is None and self.unflatten=='automatic':
+            for index in reversed(range(len(self.input_dependencies))):
+                if self.flatten[index]:
+                    status, element = self.input_dependencies[index].get_element(0)
+                    if status==READY:
+                        self.unflatten_factor = len(element)
+                    break
+        return self.unflatten_factor
+    
+    def get_element(self, index):
+        """ Get an element of the output of the task.
+        Arguments:
+            - index: int
+        Returns:
+            - status: str
+            - element: dict / list
+        """
+        if self.is_static():
+            return (READY, self.output[index]) if index < len(self.output) else (MISSING, None)
+        if index in self.elements:
+            return READY, self.elements[index]
+        factor = self.get_unflatten_factor() if self.unflatten else 1
+        if factor is None:
+            return (MISSING, None) if self.nb_items==0 else (WAIT, None)
+        start, stop = index * factor, (index + 1) * factor
+        if self.nb_items is not None:
+            if start >= self.nb_items:
+                return MISSING, None
+            stop = min(stop, self.nb_items)
+        if not all(item in self.items for item in range(start, stop)):
+            if self.last_done is None or start > self.last_done:
+                return WAIT, None
+            return PENDING, None
+        element = [self.items[item] for item in range(start, stop)] if self.unflatten else self.items[start]
+        if self.special_output_transform:
+            element = self.special_output_transform([element])[0]
+        self.elements[index] = element
+        self.element_lengths[index] = len(element)
+        return READY, element
+    
+    def get_flat_element(self, index):
+        """ Get an element of the flattened output of the task.
+        Arguments:
+            - index: int
+        Returns:
+            - status: str
+            - element: dict
+        """
+        offset = 0
+        group = 0
+        while True:
+            length = self.element_lengths.get(group)
+            if (length is None) or (index < offset + length):
+                status, element = self.get_element(group)
+                if status!=READY:
+                    return (MISSING, None) if status==MISSING else (WAIT, None)
+                length = len(element)
+                if index < offset + length:
+                    return READY, element[index - offset]
+            offset += length
+            group += 1
+    
+    def get_input_item(self, index):
+        """ Build an item of the input of the task from the outputs of
+        the parent tasks.
+        Arguments:
+            - index: int
+        Returns:
+            - status: str
+            - input_: dict
+        """
+        results = [parent.get_flat_element(index) if self.flatten[i] else parent.get_element(index) for i, parent in enumerate(self.input_dependencies)]
+        statuses = [status for status, _ in results]
+        for status in [MISSING, WAIT, PENDING]:
+            if status in statuses or (status==MISSING and not results):
+                return status, None
+        self.get_unflatten_factor() # determined while the first elements of the parents are available
+        return READY, merge_dict([item for _, item in results])
+    
+    def get_lowest_required_item(self, index, flatten):
+        """ Get the lowest raw output index needed to build the element
+        (or flattened element) of a given index.
+        Arguments:
+            - index: int
+            - flatten: bool
+        Returns:
+            - int
+        """
+        if self.is_static():
+            return 0
+        factor = self.get_unflatten_factor() if self.unflatten else 1
+        if factor is None:
+            return 0
+        group = index
+        if flatten:
+            offset, group = 0, 0
+            while (group in self.element_lengths) and (index >= offset + self.element_lengths[group]):
+                offset += self.element_lengths[group]
+                group += 1
+        return group * factor
+    
+    def set_item_submitted(self, index):
+        """ Mark an input item as submitted.
+        Arguments:
+            - index: int
+        """
+        self.submitted.add(index)
+        while self.first_unsubmitted in self.submitted:
+            self.first_unsubmitted += 1
+    
+    def add_item(self, index, output):
+        """ Add the output of an input item, and check if the task
+        is terminated.
+        Arguments:
+            - index: int
+            - output: dict / list
+        """
+        self.items[index] = output
+        self.last_done = index if self.last_done is None else max(self.last_done, index)
+        self.update_terminated()
+    
+    def get_nb_items(self):
+        """ Get the number of items of the input, as soon as it can be
+        determined from the parent tasks (before the end of the input is 
+        reached by the dataflow scheduler).
+        Returns:
+            - int (or None)
+        """
+        if self.is_static():
+            return len(self.output)
+        if self.nb_items is not None:
+            return self.nb_items
+        counts = []
+        for flatten, parent in zip(self.flatten, self.input_dependencies):
+            nb_items = parent.get_nb_items()
+            factor = parent.get_unflatten_factor() if parent.unflatten else 1
+            if (nb_items is None) or (not factor):
+                return None
+            if not flatten:
+                counts.append(-(-nb_items // factor)) # number of elements
+            elif parent.unflatten:
+                counts.append(nb_items) # elements are groups of items
+            elif parent.is_static():
+                counts.append(sum(len(element) for element in parent.output))
+            elif all(group in parent.element_lengths for group in range(nb_items)):
+                counts.append(sum(parent.element_lengths[group] for group in range(nb_items)))
+            else:
+                return None
+        return min(counts) if counts else None
+    
+    def set_nb_items(self, nb_items):
+        """ Set the number of items of the input, once known.
+        Arguments:
+            - nb_items: int
+        """
+        self.nb_items = nb_items
+        self.update_terminated()
+    
+    def update_terminated(self):
+        """ Check if all the input items have been computed."""
+        if (self.nb_items is not None) and all(index in self.submitted for index in range(self.nb_items)) and len(self.items)+self.nb_released >= self.nb_items:
+            self.set_terminated(True)
+    
+    def release_items(self, bound):
+        """ Release the raw outputs (and the elements built from them)
+        of index lower than bound, once no child task needs them.
+        Arguments:
+            - bound: int
+        """
+        factor = self.get_unflatten_factor() if self.unflatten else 1
+        for index in [index for index in self.items if index < bound]:
+            del self.items[index]
+            self.nb_released += 1
+        if factor:
+            for index in [index for index in self.elements if (index + 1) * factor <= bound]:
+                del self.elements[index]
+    
+    def collect_output(self):
+        """ Set self.output from the elements of the item-level view."""
+        self.output = []
+        index = 0
+        while True:
+            status, element = self.get_element(index)
+            if status!=READY:
+                break
+            self.output.append(element)
+            index += 1
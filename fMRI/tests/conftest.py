@@ -0,0 +1,98 @@
+"""
+Synthetic data and pipeline helpers shared by the tests.
+===================================================
+The tests are run from the fMRI folder (python -m pytest tests), the modules of the
+pipeline being imported as top-level modules (as in main.py).
+"""
+
+
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_splitter_information, get_compression_information, get_data_transformation_information, get_encoding_model_information
+from utils import get_subject_name, fetch_data
+from benchmark import generate_data
+from executors import get_executor
+from logger import Logger
+from regression_pipeline import Pipeline
+from encoding_models import EncodingModel
+from splitter import Splitter
+from data_transformation import Transformer
+from data_compression import Compressor
+from main import define_tasks
+
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    """ Small synthetic dataset (see benchmark.generate_data).
+    Returns:
+        - parameters: dict
+        - X: list (of pd.DataFrame)
+        - Y: list (of np.array)
+    """
+    folder = str(tmp_path_factory.mktemp('data'))
+    parameters = generate_data(folder, [6], nb_voxels=30)
+    parameters.update({'alpha_min_log_scale': 0, 'alpha_max_log_scale': 3, 'nb_alphas': 4})
+    representations_paths, fMRI_paths = fetch_data(parameters['path_to_fmridata'], parameters['input'], get_subject_name(1),
+                                                    parameters['language'], parameters['models'])
+    transformer = Transformer(**get_data_transformation_information(parameters))
+    X = transformer.process_representations(representations_paths, parameters['models'])
+    Y = [np.load(path) for path in fMRI_paths]
+    return parameters, X, Y
+
+def build_pipeline(parameters, logger, encoding_model=None, **kwargs):
+    """ Instanciate the classes and the tasks of main.py, and fit a pipeline.
+    Arguments:
+        - parameters: dict
+        - logger: Logger
+        - encoding_model: EncodingModel (instanciated from the parameters if None)
+        - kwargs: arguments of Pipeline
+    Returns:
+        - Pipeline
+    """
+    kwargs_splitter = get_splitter_information(parameters)
+    kwargs_compression = get_compression_information(parameters)
+    kwargs_transformation = get_data_transformation_information(parameters)
+    kwargs_encoding_model = get_encoding_model_information(parameters)
+    encoding_model = encoding_model if encoding_model is not None else EncodingModel(**kwargs_encoding_model)
+    tasks = define_tasks(Splitter(**kwargs_splitter), Compressor(**kwargs_compression), Transformer(**kwargs_transformation), encoding_model,
+                            get_executor(parameters.get('parallel'), parameters.get('n_jobs')),
+                            kwargs_splitter, kwargs_compression, kwargs_transformation, kwargs_encoding_model)
+    pipeline = Pipeline(**kwargs)
+    pipeline.fit(tasks['splitter_cv_external'], logger)
+    return pipeline
+
+def run_pipeline(parameters, X, Y, folder, encoding_model=None, **kwargs):
+    """ Compute the maps of each outer fold.
+    Arguments:
+        - parameters: dict
+        - X: list (of pd.DataFrame)
+        - Y: list (of np.array)
+        - folder: str (logs)
+        - encoding_model: EncodingModel
+        - kwargs: arguments of Pipeline
+    Returns:
+        - list (of dict)
+    """
+    logger = Logger(os.path.join(str(folder), 'logs.txt'))
+    pipeline = build_pipeline(parameters, logger, encoding_model=encoding_model, **kwargs)
+    return pipeline.compute(X, Y, str(folder), logger)
+
+def assert_maps_equal(maps, reference, tolerance=1e-10):
+    """ Check that the maps of the outer folds are equal.
+    Arguments:
+        - maps: list (of dict)
+        - reference: list (of dict)
+        - tolerance: float
+    """
+    assert len(maps)==len(reference)
+    for fold, fold_reference in zip(maps, reference):
+        assert set(fold.keys())==set(fold_reference.keys())
+        for key in fold_reference:
+            np.testing.assert_allclose(fold[key], fold_reference[key], rtol=tolerance, atol=tolerance)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import pytest
+
+from nilearn.input_data import NiftiMasker
+
+from cache import ArrayCache, hash_key
+from data_transformation import Transformer
+from utils import get_data_transformation_information
+
+
+
+def nb_entries(path):
+    return len([name for name in os.listdir(str(path)) if name.endswith('.npy')])
+
+def test_array_cache_hits(tmp_path):
+    calls = []
+    def compute(value):
+        calls.append(value)
+        return np.full(10, value)
+    cache = ArrayCache(1, str(tmp_path))
+    for _ in range(2):
+        np.testing.assert_array_equal(cache.get_or_compute(hash_key('a', 1.), compute, 1.), np.ones(10))
+    assert (len(calls), cache.hits, cache.misses)==(1, 1, 1)
+    cache = ArrayCache(1, str(tmp_path)) # another job reuses the on-disk entry
+    np.testing.assert_array_equal(cache.get_or_compute(hash_key('a', 1.), compute, 1.), np.ones(10))
+    assert len(calls)==1
+    cache.get_or_compute(hash_key('a', 2.), compute, 2.)
+    assert len(calls)==2
+
+def test_array_cache_memory_cap():
+    cache = ArrayCache(2.5 * 80000 / 1024 ** 2) # room for two arrays
+    for key in ['a', 'b', 'c']:
+        cache.set(key, np.zeros(10000))
+    assert list(cache.memory.keys())==['b', 'c'] and cache.memory_size==160000
+
+def test_array_cache_disk_cap(tmp_path):
+    cache = ArrayCache(0, str(tmp_path), max_disk=2.5 * 80000 / 1024 ** 2) # room for two files
+    cache.set('a', np.zeros(10000))
+    cache.set('b', np.ones(10000))
+    os.utime(cache.get_path('a'), (0, 0)), os.utime(cache.get_path('b'), (1, 1))
+    assert cache.get('a') is not None # 'a' is now the most recently used entry
+    cache.set('c', np.ones(10000))
+    assert sorted(os.listdir(str(tmp_path)))==['a.npy', 'c.npy']
+
+@pytest.fixture
+def transformer_parameters(dataset, tmp_path):
+    parameters, X, Y = dataset
+    offset_path = str(tmp_path / 'onsets-offsets')
+    shutil.copytree(parameters['offset_path'], offset_path) # the timing files are modified by the tests
+    return dict(get_data_transformation_information(parameters), offset_path=offset_path, cache_path=str(tmp_path / 'regressors')), X
+
+def test_regressor_cache_invalidation(transformer_parameters, tmp_path):
+    kwargs, X = transformer_parameters
+    matrix = X[0][:, kwargs['indexes'][0]]
+    reference = Transformer(**kwargs).compute_regressor(matrix, 'word', 'word', 'run1')
+    transformer = Transformer(**kwargs)
+    np.testing.assert_array_equal(transformer.compute_regressor(matrix, 'word', 'word', 'run1'), reference)
+    assert (transformer.cache.hits, nb_entries(kwargs['cache_path']))==(1, 1)
+    Transformer(**dict(kwargs, hrf='glover')).compute_regressor(matrix, 'word', 'word', 'run1')
+    assert nb_entries(kwargs['cache_path'])==2
+    path = os.path.join(kwargs['offset_path'], 'word_run1.csv')
+    timing = pd.read_csv(path)
+    timing['offsets'] += 0.5
+    timing.to_csv(path, index=False)
+    transformer = Transformer(**kwargs)
+    result = transformer.compute_regressor(matrix, 'word', 'word', 'run1')
+    assert (transformer.cache.hits, nb_entries(kwargs['cache_path']))==(0, 3)
+    assert not np.allclose(result, reference)
+
+def write_image(path, seed, shape=(8, 8, 6, 20)):
+    rng = np.random.RandomState(seed)
+    nib.save(nib.Nifti1Image(rng.randn(*shape) + 10, np.diag([3., 3., 3., 1.])), path)
+
+def fit_masker(size):
+    mask = np.zeros((8, 8, 6), dtype=np.int8)
+    mask[2:2 + size, 2:6, 1:5] = 1
+    return NiftiMasker(nib.Nifti1Image(mask, np.diag([3., 3., 3., 1.])), detrend=True, standardize=True).fit()
+
+def test_fmri_cache_invalidation(transformer_parameters, tmp_path):
+    kwargs, _ = transformer_parameters
+    kwargs = dict(kwargs, fmri_cache_path=str(tmp_path / 'fmri'))
+    paths = [str(tmp_path / 'run1.nii'), str(tmp_path / 'run2.nii')]
+    for seed, path in enumerate(paths):
+        write_image(path, seed)
+    masker = fit_masker(4)
+    reference = Transformer(**kwargs).process_fmri_data(paths, masker)
+    data = Transformer(**kwargs).process_fmri_data(paths, masker)
+    assert nb_entries(kwargs['fmri_cache_path'])==2
+    assert all(isinstance(run, np.memmap) for run in data) # memory-mapped from the cache
+    for run, run_reference in zip(data, reference):
+        np.testing.assert_array_equal(run, run_reference)
+    data = Transformer(**kwargs).process_fmri_data(paths, fit_masker(3)) # other mask
+    assert nb_entries(kwargs['fmri_cache_path'])==4 and data[0].shape[1]==48
+    write_image(paths[0], 10, shape=(8, 8, 6, 25)) # other source image
+    data = Transformer(**kwargs).process_fmri_data(paths, masker)
+    assert nb_entries(kwargs['fmri_cache_path'])==5
+    np.testing.assert_allclose(data[0], masker.transform(paths[0]))
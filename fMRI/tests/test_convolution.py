@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from nistats.hemodynamic_models import compute_regressor
+
+from convolution import ConvolutionEngine
+
+
+
+@pytest.mark.parametrize('hrf', ['spm', 'glover', 'spm + derivative', 'glover + derivative + dispersion'])
+def test_convolution_matches_nistats(hrf):
+    rng = np.random.RandomState(0)
+    tr, nscans, nevents = 2., 60, 150
+    onsets = np.sort(rng.uniform(0, nscans * tr - 20, nevents))
+    onsets[10] = onsets[11] # events falling on the same time sample
+    durations = rng.uniform(0.1, 0.5, nevents)
+    values = rng.randn(nevents, 4)
+    frame_times = np.arange(0.0, nscans * tr, tr)
+    engine = ConvolutionEngine(tr, hrf=hrf, oversampling=10)
+    regressors = engine.convolve(values, onsets, durations, nscans)
+    expected = np.hstack([compute_regressor(np.vstack((onsets, durations, values[:, column])), hrf, frame_times, oversampling=10)[0] for column in range(values.shape[1])])
+    np.testing.assert_allclose(regressors, expected, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(engine.convolve(values[:, :2], onsets, durations, nscans), regressors[:, :regressors.shape[1] // 2])
+    assert len(engine.operators.memory)==1 # the operator of the timing is built once
+
+def test_operators_are_bounded():
+    rng = np.random.RandomState(0)
+    tr, nscans, nevents = 2., 60, 150
+    engine = ConvolutionEngine(tr, operators_memory=0.1) # room for a single operator (60 x 150 float64)
+    unbounded = ConvolutionEngine(tr)
+    values = rng.randn(nevents, 3)
+    for _ in range(3):
+        onsets = np.sort(rng.uniform(0, nscans * tr - 20, nevents))
+        durations = rng.uniform(0.1, 0.5, nevents)
+        np.testing.assert_array_equal(engine.convolve(values, onsets, durations, nscans), unbounded.convolve(values, onsets, durations, nscans))
+    assert len(engine.operators.memory)==1 and len(unbounded.operators.memory)==3
+    assert engine.operators.memory_size <= 0.1 * 1024 ** 2
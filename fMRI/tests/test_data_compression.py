@@ -0,0 +1,48 @@
+import functools
+import numpy as np
+import pytest
+
+from data_compression import Compressor
+
+
+
+@pytest.fixture
+def runs():
+    # representations of rank 4 (with a decreasing spectrum) and some noise
+    rng = np.random.RandomState(0)
+    basis = rng.randn(4, 30) * np.array([10, 7, 4, 2])[:, None]
+    X = [rng.randn(n, 4).dot(basis) + 0.01 * rng.randn(n, 30) + 5 for n in [50, 40, 45]]
+    return X[:2], X[2:]
+
+def count_fits(compressor, method):
+    calls = []
+    fit = getattr(compressor, method)
+    @functools.wraps(fit) # the name of the method is part of the cache key
+    def counted_fit(X_train, n_components):
+        calls.append(len(X_train))
+        return fit(X_train, n_components)
+    setattr(compressor, method, counted_fit)
+    return calls
+
+def test_projection_is_cached(runs):
+    X_train, X_test = runs
+    compressor = Compressor([[4]], [list(range(30))], ['pca'], cache_size=10)
+    calls = count_fits(compressor, 'fit_pca')
+    reference = compressor.pca(X_train, X_test, 4)
+    result = compressor.pca([matrix.copy() for matrix in X_train], X_test[::-1], 4) # identical training runs
+    assert len(calls)==1
+    np.testing.assert_array_equal(result['X_train'][0], reference['X_train'][0])
+    compressor.pca(X_train[::-1], X_test, 4) # other training runs
+    compressor.pca(X_train, X_test, 3) # other number of components
+    assert len(calls)==3
+
+@pytest.mark.parametrize('method', ['randomized_pca', 'incremental_pca'])
+def test_pca_backends_match_pca(runs, method):
+    X_train, X_test = runs
+    compressor = Compressor([[4]], [list(range(30))], ['pca'], random_state=0)
+    reference = compressor.pca(X_train, X_test, 4)
+    result = getattr(compressor, method)(X_train, X_test, 4)
+    for key in ['X_train', 'X_test']:
+        for matrix, matrix_reference in zip(result[key], reference[key]):
+            signs = np.sign(np.sum(matrix * matrix_reference, axis=0)) # components are defined up to their sign
+            np.testing.assert_allclose(matrix * signs, matrix_reference, rtol=1e-4, atol=1e-3)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from sklearn.linear_model import Ridge
+
+from encoding_models import EncodingModel
+from ridge import RidgeFactorization
+
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = [rng.randn(40, 8) for _ in range(3)]
+    weights = rng.randn(8, 25) * np.logspace(-2, 0, 25)
+    Y = [x.dot(weights) + 3 + rng.randn(40, 25) for x in X]
+    return X[:2], Y[:2], X[2:], Y[2:]
+
+def grid_search(data, fit_intercept=True, **kwargs):
+    X_train, Y_train, X_test, Y_test = data
+    encoding_model = EncodingModel(Ridge(fit_intercept=fit_intercept), alpha_min_log_scale=-1, alpha_max_log_scale=3, nb_alphas=6, **kwargs)
+    return encoding_model, encoding_model.grid_search(X_train, Y_train, X_test, Y_test)
+
+def assert_scores_equal(result, reference, tolerance=1e-9):
+    for key in ['R2', 'Pearson_coeff', 'alpha']:
+        np.testing.assert_allclose(np.asarray(result[key], dtype=float), np.asarray(reference[key], dtype=float), rtol=tolerance, atol=tolerance)
+
+@pytest.mark.parametrize('fit_intercept', [True, False])
+def test_svd_grid_search_matches_sklearn(data, fit_intercept):
+    _, reference = grid_search(data, fit_intercept=fit_intercept, solver='sklearn')
+    _, result = grid_search(data, fit_intercept=fit_intercept, solver='svd')
+    assert_scores_equal(result, reference)
+
+def evaluate(data, encoding_model, grid):
+    X_train, Y_train, X_test, Y_test = data
+    folds = lambda value: np.stack([np.asarray(value)] * 2, axis=0) # two inner folds
+    return encoding_model.evaluate(X_train, X_test, Y_train, Y_test, folds(grid['R2']), folds(grid['Pearson_coeff']), folds(grid['alpha']))
+
+def test_svd_evaluate_matches_sklearn(data):
+    encoding_model, grid = grid_search(data, solver='sklearn')
+    reference = evaluate(data, encoding_model, grid)
+    assert len(np.unique(reference['alpha'])) > 1 # several alphas are selected
+    encoding_model, grid = grid_search(data, solver='svd')
+    assert_scores_equal(evaluate(data, encoding_model, grid), reference)
+
+@pytest.mark.parametrize('solver', ['sklearn', 'svd'])
+def test_float32_matches_float64(data, solver):
+    encoding_model, reference = grid_search(data, solver=solver)
+    reference_maps = evaluate(data, encoding_model, reference)
+    data32 = [[array.astype(np.float32) for array in arrays] for arrays in data]
+    encoding_model, result = grid_search(data32, solver=solver, dtype='float32')
+    assert_scores_equal(result, reference, tolerance=1e-4)
+    maps = evaluate(data32, encoding_model, result)
+    assert_scores_equal(maps, reference_maps, tolerance=1e-4)
+    assert maps['R2'].dtype==np.float64 # scores are accumulated in float64
+
+@pytest.mark.parametrize('solver', ['sklearn', 'svd'])
+@pytest.mark.parametrize('blocks', [{'voxel_block_size': 7}, {'voxel_block_size': 1}, {'voxel_block_memory': 0.01}])
+def test_voxel_blocks_match_whole_brain(data, solver, blocks):
+    encoding_model, reference = grid_search(data, solver=solver)
+    reference_maps = evaluate(data, encoding_model, reference)
+    encoding_model, result = grid_search(data, solver=solver, **blocks)
+    assert len(encoding_model.get_voxel_blocks(data[1], data[3])) > 1
+    assert_scores_equal(result, reference)
+    assert_scores_equal(evaluate(data, encoding_model, result), reference_maps)
+
+def adaptive_search(data, **kwargs):
+    X_train, Y_train, X_test, Y_test = data
+    parameters = dict({'alpha_min_log_scale': -1, 'alpha_max_log_scale': 3, 'nb_alphas': 5}, **kwargs)
+    encoding_model = EncodingModel(Ridge(), solver='svd', alpha_search='adaptive', **parameters)
+    return encoding_model, encoding_model.grid_search(X_train, Y_train, X_test, Y_test)
+
+def test_adaptive_search_improves_the_grid(data):
+    _, grid = grid_search(data, solver='svd')
+    _, result = adaptive_search(data, alpha_min_log_scale=-1, alpha_max_log_scale=3, nb_alphas=6)
+    assert np.all(result['R2'][0] >= np.max(grid['R2'], axis=0)) # on the same folds, voxel by voxel
+    assert np.any(result['R2'][0] > np.max(grid['R2'], axis=0))
+
+def test_adaptive_search_extends_the_range():
+    # the weights are much smaller than the noise: the best alphas are around 1e4
+    rng = np.random.RandomState(0)
+    X = [rng.randn(100, 8) for _ in range(3)]
+    weights = rng.randn(8, 20) * 0.01
+    Y = [x.dot(weights) + rng.randn(100, 20) for x in X]
+    data = X[:2], Y[:2], X[2:], Y[2:]
+    _, grid = grid_search(data, solver='svd')
+    _, result = adaptive_search(data, alpha_min_log_scale=-1, alpha_max_log_scale=1, nb_alphas=3, nb_alpha_extensions=4)
+    extended = result['alpha'][0] > 10
+    assert np.mean(extended) > 0.5
+    assert np.all(result['R2'][0, extended] > np.max(grid['R2'][:, extended], axis=0))
+
+def test_adaptive_search_needs_fewer_evaluations(data, monkeypatch):
+    # number of (alpha, voxel) predictions, compared to a dense grid of the resolution of the refinement
+    evaluations = []
+    predict = RidgeFactorization.predict # also called by predict_path for each alpha
+    def count_predict(self, X_test_projected, UtY, Y_mean, alpha):
+        evaluations.append(UtY.shape[1])
+        return predict(self, X_test_projected, UtY, Y_mean, alpha)
+    monkeypatch.setattr(RidgeFactorization, 'predict', count_predict)
+    _, result = adaptive_search(data, nb_alpha_refinements=5)
+    nb_voxels = data[1][0].shape[1]
+    resolution = 1 * 0.618034 ** 5 # grid step (in log scale) shrunk by each golden-section iteration
+    nb_dense_alphas = int(np.ceil(4 / resolution)) + 1
+    assert sum(evaluations) <= (5 + 3 + 5) * nb_voxels # grid, extensions and refinements
+    assert sum(evaluations) < nb_dense_alphas * nb_voxels / 3
+    monkeypatch.undo()
+    dense = EncodingModel(Ridge(), solver='svd', alpha_min_log_scale=-1, alpha_max_log_scale=3, nb_alphas=nb_dense_alphas).grid_search(*data)
+    assert np.all(result['R2'][0] > np.max(dense['R2'], axis=0) - 1e-3) # about as good as the dense grid
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import convert_csv, read_columns
+
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    rng = np.random.RandomState(0)
+    dataframe = pd.DataFrame({'word': ['the', 'cat', 'sat', 'on', 'mat'], 'onset': [0, 1, 2, 3, 4]})
+    for index in range(3):
+        dataframe['feature-{}'.format(index)] = rng.randn(5)
+    dataframe.loc[2, 'feature-1'] = np.nan
+    path = str(tmp_path / 'activations_run1.csv')
+    dataframe.to_csv(path, index=False)
+    return path
+
+def test_convert_csv_round_trip(csv_path):
+    data_path = convert_csv(csv_path)
+    reference = pd.read_csv(csv_path)
+    numeric = ['onset', 'feature-0', 'feature-1', 'feature-2'] # the words are not stored
+    np.testing.assert_array_equal(read_columns(data_path), reference[numeric].values.astype(np.float64))
+    columns = ['feature-2', 'feature-0']
+    np.testing.assert_array_equal(read_columns(data_path, columns), reference[columns].values)
+    with pytest.raises(Exception, match='Column word not found'):
+        read_columns(data_path, ['word'])
+
+def test_convert_csv_columns(csv_path):
+    columns = ['feature-0', 'feature-1']
+    data_path = convert_csv(csv_path, columns=columns)
+    np.testing.assert_array_equal(read_columns(data_path), pd.read_csv(csv_path)[columns].values)
+    with pytest.raises(Exception, match='activations_run1.csv'):
+        convert_csv(csv_path, columns=['word', 'feature-0']) # non numeric column
+    with pytest.raises(Exception, match='activations_run1.csv'):
+        convert_csv(csv_path, columns=['feature-5'])
@@ -0,0 +1,34 @@
+import numpy as np
+import nibabel as nib
+import pytest
+
+from nilearn.input_data import NiftiMasker
+
+from masking import SlabMasker
+
+
+
+@pytest.fixture(scope='module')
+def images(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('images')
+    rng = np.random.RandomState(0)
+    affine = np.diag([3., 3., 3., 1.])
+    data = rng.randn(10, 9, 8, 31) + np.linspace(0, 5, 31) + 100 # linear trend and offset
+    mask = np.zeros((10, 9, 8), dtype=np.int8)
+    mask[2:8, 2:7, 1:7] = 1
+    paths = [str(folder / 'fmri.nii'), str(folder / 'fmri.nii.gz')]
+    for path in paths:
+        nib.save(nib.Nifti1Image(data, affine), path)
+    return nib.Nifti1Image(mask, affine), paths
+
+@pytest.mark.parametrize('detrend', [True, False])
+@pytest.mark.parametrize('standardize', [True, False])
+@pytest.mark.parametrize('smoothing_fwhm', [None, 6])
+def test_slab_masker_matches_nifti_masker(images, detrend, standardize, smoothing_fwhm):
+    mask, paths = images
+    masker = NiftiMasker(mask, detrend=detrend, standardize=standardize, smoothing_fwhm=smoothing_fwhm).fit()
+    reference = masker.transform(paths[0])
+    for path in paths: # memory-mapped and compressed images
+        slab_masker = SlabMasker(masker, slab_size=7, block_size=50) # slabs and blocks not dividing the image
+        assert slab_masker.is_streamable(nib.load(path))
+        np.testing.assert_allclose(slab_masker.transform(path), reference, rtol=1e-6, atol=1e-6)
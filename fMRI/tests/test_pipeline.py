@@ -0,0 +1,106 @@
+import ast
+import glob
+import os
+import numpy as np
+import pytest
+
+from checkpoint import Checkpointer, StoreUnpickler
+from conftest import run_pipeline, assert_maps_equal
+from utils import PIPELINE_MODULES, get_code_version, stack_subjects, split_subjects
+
+
+
+@pytest.fixture(scope='module')
+def reference(dataset, tmp_path_factory):
+    parameters, X, Y = dataset
+    return run_pipeline(parameters, X, Y, tmp_path_factory.mktemp('reference'), scheduler='sequential')
+
+@pytest.mark.parametrize('parallel', [False, 'thread', 'process'])
+def test_dataflow_matches_sequential(dataset, reference, tmp_path, parallel):
+    parameters, X, Y = dataset
+    parameters = dict(parameters, parallel=parallel, n_jobs=2)
+    maps = run_pipeline(parameters, X, Y, tmp_path, scheduler='dataflow')
+    assert_maps_equal(maps, reference)
+
+def test_dataflow_keeps_outputs(dataset, reference, tmp_path):
+    parameters, X, Y = dataset
+    maps = run_pipeline(parameters, X, Y, tmp_path, scheduler='dataflow', free_memory=False)
+    assert_maps_equal(maps, reference)
+
+@pytest.mark.parametrize('scheduler', ['dataflow', 'sequential'])
+def test_checkpoint_resume(dataset, reference, tmp_path, scheduler):
+    parameters, X, Y = dataset
+    path = str(tmp_path / 'checkpoints')
+    maps = run_pipeline(parameters, X, Y, tmp_path, scheduler=scheduler, checkpointer=Checkpointer(path))
+    assert_maps_equal(maps, reference)
+    # full resume: nothing is computed
+    maps = run_pipeline(parameters, X, Y, tmp_path, scheduler=scheduler, checkpointer=Checkpointer(path))
+    assert_maps_equal(maps, reference)
+
+def test_checkpoint_partial_resume(dataset, reference, tmp_path):
+    parameters, X, Y = dataset
+    path = str(tmp_path / 'checkpoints')
+    run_pipeline(parameters, X, Y, tmp_path, checkpointer=Checkpointer(path))
+    for folder in glob.glob(os.path.join(path, 'encoding_model_external_*')):
+        for item in os.listdir(folder):
+            os.remove(os.path.join(folder, item))
+    folder = glob.glob(os.path.join(path, 'transform_data_external_*'))[0]
+    for item in ['item_1.pkl', 'complete.pkl']: # an interrupted task
+        os.remove(os.path.join(folder, item))
+    from encoding_models import EncodingModel
+    from utils import get_encoding_model_information
+    encoding_model = EncodingModel(**get_encoding_model_information(parameters))
+    def grid_search(*args, **kwargs):
+        raise AssertionError('The grid search should be loaded from the checkpoints.')
+    encoding_model.grid_search = grid_search
+    maps = run_pipeline(parameters, X, Y, tmp_path, encoding_model=encoding_model, checkpointer=Checkpointer(path))
+    assert_maps_equal(maps, reference)
+
+def test_splitter_checkpoints_refer_to_input_stores(dataset, reference, tmp_path):
+    parameters, X, Y = dataset
+    path = str(tmp_path / 'checkpoints')
+    run_pipeline(parameters, X, Y, tmp_path, checkpointer=Checkpointer(path))
+    data_size = sum(run.nbytes for run in Y) + sum(np.asarray(run).nbytes for run in X)
+    for name in ['splitter_cv_external', 'splitter_cv_internal']:
+        folder = glob.glob(os.path.join(path, name + '_*'))[0]
+        size = sum(os.path.getsize(os.path.join(folder, item)) for item in os.listdir(folder))
+        assert size < data_size / 10 # indexes only
+    # resumed folds are views over the live input stores
+    checkpointer = Checkpointer(path)
+    maps = run_pipeline(parameters, X, Y, tmp_path, checkpointer=checkpointer)
+    assert_maps_equal(maps, reference)
+    for item in glob.glob(os.path.join(path, 'splitter_cv_internal_*', 'item_*.pkl')):
+        with open(item, 'rb') as f:
+            folds = StoreUnpickler(f, checkpointer.stores).load()
+        for fold in folds:
+            assert fold['X_train'].store is checkpointer.stores['X_train']
+            assert fold['Y_train'].store is checkpointer.stores['Y_train']
+            assert fold['Y_test'].store is checkpointer.stores['Y_train']
+
+
+def test_code_version_covers_the_pipeline_modules():
+    # the modules imported by the pipeline code must be part of the code version
+    # (except the ones that only schedule or profile the tasks)
+    folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    local_modules = {os.path.basename(path) for path in glob.glob(os.path.join(folder, '*.py'))}
+    for name in PIPELINE_MODULES:
+        with open(os.path.join(folder, name)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module is not None:
+                imported = node.module + '.py'
+                if imported in local_modules and imported not in ['executors.py', 'profiler.py']:
+                    assert imported in PIPELINE_MODULES, '{} imports {}'.format(name, imported)
+    assert 'benchmark.py' not in PIPELINE_MODULES
+    assert len(get_code_version()) == 40
+
+@pytest.mark.parametrize('solver', ['sklearn', 'svd'])
+def test_stacked_subjects_match_single_subjects(dataset, tmp_path, solver):
+    parameters, X, Y = dataset
+    parameters = dict(parameters, solver=solver)
+    rng = np.random.RandomState(0)
+    subjects = [Y, [rng.randn(y.shape[0], 17) for y in Y]] # subjects with different numbers of voxels
+    data, sizes = stack_subjects(subjects)
+    maps = run_pipeline(parameters, X, data, tmp_path)
+    for subject_data, subject_maps in zip(subjects, split_subjects(maps, sizes)):
+        assert_maps_equal(subject_maps, run_pipeline(parameters, X, subject_data, tmp_path))
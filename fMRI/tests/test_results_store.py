@@ -0,0 +1,46 @@
+import h5py
+import numpy as np
+import pytest
+
+from checkpoint import Checkpointer
+from results_store import ResultsStore, read_results
+from utils import aggregate_folds
+from conftest import run_pipeline
+
+
+
+def read_group(path):
+    with h5py.File(path, 'r') as f:
+        data = {}
+        f['s1/m'].visititems(lambda name, item: data.update({name: item[()]}) if isinstance(item, h5py.Dataset) else None)
+    return data
+
+@pytest.mark.parametrize('scheduler', ['dataflow', 'sequential'])
+def test_results_store(dataset, tmp_path, scheduler):
+    parameters, X, Y = dataset
+    path = str(tmp_path / 'results.hdf5')
+    results_store = ResultsStore(path, 's1', 'm', chunk_size=8)
+    maps = run_pipeline(parameters, X, Y, tmp_path, scheduler=scheduler, results_stores=[results_store])
+    mean = aggregate_folds(maps)
+    np.testing.assert_allclose(read_results(path, 's1', 'm', 'mean/R2'), mean['R2'])
+    means = results_store.get_means() # used instead of the maps of the folds by main.py
+    assert set(means.keys())==set(mean.keys())
+    for key in mean:
+        np.testing.assert_allclose(means[key], mean[key])
+    assert read_results(path, 's1', 'm', 'internal/R2').shape==(9, 8, 4, Y[0].shape[1])
+    np.testing.assert_allclose(read_results(path, 's1', 'm', 'external/alpha', folds=3), maps[3]['alpha'])
+
+@pytest.mark.parametrize('scheduler', ['dataflow', 'sequential'])
+def test_results_store_resume(dataset, tmp_path, scheduler):
+    parameters, X, Y = dataset
+    path, checkpoints = str(tmp_path / 'results.hdf5'), str(tmp_path / 'checkpoints')
+    run_pipeline(parameters, X, Y, tmp_path, scheduler=scheduler, checkpointer=Checkpointer(checkpoints), results_stores=[ResultsStore(path, 's1', 'm')])
+    reference = read_group(path)
+    assert 'internal/R2' in reference
+    results_store = ResultsStore(path, 's1', 'm')
+    run_pipeline(parameters, X, Y, tmp_path, scheduler=scheduler, checkpointer=Checkpointer(checkpoints), results_stores=[results_store])
+    np.testing.assert_allclose(results_store.get_means()['R2'], reference['mean/R2']) # also averaged from the checkpoints
+    data = read_group(path)
+    assert set(data.keys())==set(reference.keys())
+    for name, value in reference.items():
+        np.testing.assert_allclose(data[name], value)
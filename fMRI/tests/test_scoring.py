@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from sklearn.metrics import r2_score as sklearn_r2_score
+
+from scoring import Scorer, r2_score, pearson_coeff
+
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    Y_test = rng.randn(40, 30)
+    predictions = 0.5 * Y_test + rng.randn(40, 30)
+    Y_test[:, 0] = 3. # constant voxel, badly predicted
+    Y_test[:, 1] = 2.
+    predictions[:, 1] = 2. # constant voxel, perfectly predicted
+    predictions[:, 2] = -1. # constant predictions
+    return predictions, Y_test
+
+def test_r2_score_matches_sklearn(data):
+    predictions, Y_test = data
+    expected = sklearn_r2_score(Y_test, predictions, multioutput='raw_values')
+    np.testing.assert_allclose(r2_score(predictions, Y_test), expected, rtol=1e-10, atol=1e-12)
+    assert r2_score(predictions, Y_test)[0]==0. and r2_score(predictions, Y_test)[1]==1.
+
+def test_pearson_coeff_matches_corrcoef(data):
+    predictions, Y_test = data
+    result = pearson_coeff(predictions, Y_test)
+    expected = np.array([np.corrcoef(predictions[:, voxel], Y_test[:, voxel])[0, 1] for voxel in range(3, Y_test.shape[1])])
+    np.testing.assert_allclose(result[3:], expected, rtol=1e-10, atol=1e-12)
+    np.testing.assert_array_equal(result[:3], 0.) # zero variance (NaN for np.corrcoef)
+
+@pytest.mark.parametrize('chunk_size', [7, 1, 100])
+def test_scorer_chunks(data, chunk_size):
+    predictions, Y_test = data
+    path = np.stack([predictions, 2 * predictions, predictions + 1.], axis=0) # (alphas x time x voxels)
+    result = Scorer(chunk_size=chunk_size).score(path, Y_test) # chunks that do not divide the voxels
+    for index in range(path.shape[0]):
+        np.testing.assert_allclose(result['R2'][index], sklearn_r2_score(Y_test, path[index], multioutput='raw_values'), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(result['Pearson_coeff'][index], pearson_coeff(path[index], Y_test), rtol=1e-12)
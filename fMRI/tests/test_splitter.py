@@ -0,0 +1,30 @@
+import numpy as np
+
+from splitter import Splitter, RunStore, stacked
+
+
+
+def test_split_views():
+    rng = np.random.RandomState(0)
+    X = [rng.randn(10 + index, 3) for index in range(4)]
+    Y = [rng.randn(10 + index, 5) for index in range(4)]
+    folds = Splitter(1).split(X, Y)
+    assert len(folds)==4
+    for fold in folds:
+        train = [index for index in range(4) if index not in fold['run_test']]
+        with stacked(fold['Y_train']) as y_train:
+            np.testing.assert_array_equal(y_train, np.vstack([Y[index] for index in train]))
+        with stacked(fold['Y_train'], slice(1, 3)) as y_train:
+            np.testing.assert_array_equal(y_train, np.vstack([Y[index][:, 1:3] for index in train]))
+        assert fold['X_test'][0] is X[fold['run_test'][0]] # no copy
+
+def test_buffer_pool_is_capped():
+    store = RunStore([np.ones((10, 4)), np.ones((12, 4)), np.ones((11, 4))])
+    views = [store.view([0, 1]), store.view([1, 2]), store.view([0, 2])]
+    with views[0].stacked(), views[1].stacked(), views[2].stacked():
+        assert len(store.buffers)==0 # concurrent folds
+    assert len(store.buffers)==1
+    assert store.buffers[0].shape==(23, 4) # the largest one is kept
+    with views[0].stacked(slice(0, 3)), views[1].stacked(slice(0, 1)):
+        pass
+    assert sorted(buffer.shape for buffer in store.buffers)==[(22, 3), (23, 1), (23, 4)]
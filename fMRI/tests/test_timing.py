@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from timing import TimingStore
+
+
+
+def write_run(folder, name, **columns):
+    pd.DataFrame(columns).to_csv(str(folder / name), index=False)
+
+def test_timing_store(tmp_path):
+    offsets, durations = tmp_path / 'offsets', tmp_path / 'durations'
+    offsets.mkdir(), durations.mkdir()
+    write_run(offsets, 'word_run1.csv', onsets=[0., 1.], offsets=[0.5, 1.5])
+    write_run(durations, 'word_run1.csv', durations=[0.5, 0.5])
+    timing = TimingStore(str(offsets), str(tmp_path), 2., {'run1': 3, 'run2': 2}, offset_types=['word'], duration_types=['word'])
+    np.testing.assert_array_equal(timing.get_offsets('word', 'run1'), [0.5, 1.5])
+    np.testing.assert_array_equal(timing.get_duration('word', 'run1'), [0.5, 0.5])
+    np.testing.assert_array_equal(timing.get_duration('word', 'run2', default_size=4), np.ones(4))
+    np.testing.assert_array_equal(timing.get_frame_times('run1'), [0., 2., 4.])
+    with pytest.raises(Exception, match='offset file'):
+        timing.get_offsets('word', 'run2')
+
+def test_timing_store_missing_column(tmp_path):
+    write_run(tmp_path, 'word_run1.csv', onsets=[0., 1.], ends=[0.5, 1.5])
+    with pytest.raises(Exception, match='word_run1.csv'):
+        TimingStore(str(tmp_path), str(tmp_path), 2., {'run1': 3}, offset_types=['word'])
@@ -0,0 +1,30 @@
+import gc
+import numpy as np
+
+import utils
+from utils import clean_nan_rows, get_valid_rows
+
+
+
+def test_clean_nan_rows():
+    array = np.arange(20, dtype=float).reshape((5, 4))
+    array[1, 0] = np.nan # outside the selected columns
+    array[3, 2] = np.nan
+    np.testing.assert_array_equal(clean_nan_rows(array, [2, 3]), array[[0, 1, 2, 4]][:, [2, 3]])
+    np.testing.assert_array_equal(clean_nan_rows(array, np.array([3, 1])), array[:, [3, 1]]) # no NaN in these columns
+    np.testing.assert_array_equal(clean_nan_rows(array), array[[0, 2, 4]])
+    np.testing.assert_array_equal(get_valid_rows(array, [2]), [True, True, True, False, True])
+    assert clean_nan_rows(array[[0, 2]]) is not array
+    valid = array[[0, 2, 4]]
+    assert clean_nan_rows(valid) is valid # no copy without NaN rows and column selection
+    assert not np.shares_memory(clean_nan_rows(valid, [0, 1]), valid)
+
+def test_valid_rows_are_forgotten():
+    array = np.ones((4, 3))
+    array[0, 0] = np.nan
+    get_valid_rows(array), get_valid_rows(array, [1, 2])
+    keys = [(id(array), None), (id(array), (1, 2))]
+    assert all(key in utils.VALID_ROWS for key in keys)
+    del array
+    gc.collect()
+    assert not any(key in utils.VALID_ROWS for key in keys)
@@ -0,0 +1,117 @@
+"""
+In-memory index of the stimuli timing (onsets/offsets and durations) of each run.
+===================================================
+A TimingStore instanciation requires:
+    - offset_path: string, folder containing the '<offset_type>_run<index>.csv' files,
+    - duration_path: string, folder whose 'durations' subfolder contains the
+    '<duration_type>_run<index>.csv' files,
+    - tr: float, repetition time of the fMRI image acquisition,
+    - nscans: dict regrouping the number of scans for each run,
+    - offset_types: list of the offset types to load (None to load all files),
+    - duration_types: list of the duration types to load (None to load all files).
+
+All the files are read once at instanciation and stored as compact arrays
+indexed by (type, run), together with the frame times of each run, so that
+the computation of the regressors never touches the filesystem.
+"""
+
+
+
+import os
+import re
+import glob
+import numpy as np
+import pandas as pd
+
+
+
+class TimingStore(object):
+    """ Preloaded onsets/offsets, durations and frame times
+    of every run.
+    """
+
+    def __init__(self, offset_path, duration_path, tr, nscans, offset_types=None, duration_types=None):
+        """ Instanciation of TimingStore class.
+        Arguments:
+            - offset_path: str
+            - duration_path: str
+            - tr: float
+            - nscans: dict (of int)
+            - offset_types: list (of str)
+            - duration_types: list (of str)
+        """
+        self.offset_path = offset_path
+        self.duration_path = duration_path
+        self.offsets = self.load(offset_path, offset_types, lambda path: pd.read_csv(path)['offsets'].values)
+        self.durations = self.load(os.path.join(duration_path, 'durations'), duration_types, lambda path: np.ravel(pd.read_csv(path).values))
+        self.frame_times = {run_index: np.arange(0.0, nscans[run_index] * tr, tr) for run_index in nscans}
+
+    def load(self, folder, types, reader):
+        """ Load all the '<type>_run<index>.csv' files of a folder.
+        Arguments:
+            - folder: str
+            - types: list (of str)
+            - reader: function (path -> np.array)
+        Returns:
+            - result: dict (of np.array)
+        """
+        result = {}
+        if folder is None:
+            return result
+        for path in sorted(glob.glob(os.path.join(folder, '*_run*.csv'))):
+            match = re.match(r'(.*)_run(\d+)\.csv$', os.path.basename(path))
+            if match is None or (types is not None and match.group(1) not in types):
+                continue
+            try:
+                array = reader(path)
+            except KeyError as err:
+                raise Exception('Column {} not found in timing file: {}'.format(err, path))
+            array.setflags(write=False)
+            result[(match.group(1), int(match.group(2)))] = array
+        return result
+
+    def get_run_number(self, run_index):
+        """ Get the run number from a run identifier.
+        Arguments:
+            - run_index: str (e.g. 'run1')
+        Returns:
+            - int
+        """
+        return int(run_index.replace('run', ''))
+
+    def get_offsets(self, offset_type, run_index):
+        """ Retrieve the offset vector.
+        Arguments:
+            - offset_type: str
+            - run_index: str
+        Returns:
+            - np.array
+        """
+        key = (offset_type, self.get_run_number(run_index))
+        if key not in self.offsets:
+            path = os.path.join(self.offset_path, '{}_run{}.csv'.format(offset_type, key[1]))
+            raise Exception("Please specify an offset file at: {}".format(path))
+        return self.offsets[key]
+
+    def get_duration(self, duration_type, run_index, default_size=None):
+        """ Retrieve the duration vector.
+        Arguments:
+            - duration_type: str
+            - run_index: str
+            - default_size: int
+        Returns:
+            - np.array
+        """
+        key = (duration_type, self.get_run_number(run_index))
+        if key not in self.durations:
+            return np.ones(default_size)
+        return self.durations[key]
+
+    def get_frame_times(self, run_index):
+        """ Retrieve the acquisition times of a run.
+        Arguments:
+            - run_index: str
+        Returns:
+            - np.array
+        """
+        return self.frame_times[run_index]
@@ -3,7 +3,10 @@ import yaml
 import glob
 import h5py
 import json
+import hashlib
 import inspect
+import weakref
+import threading
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -16,6 +19,17 @@ from nilearn.image import math_img, mean_img
 from nilearn.input_data import MultiNiftiMasker
 from nilearn.plotting import plot_glass_brain, plot_img
 
+from feature_store import get_store_paths, has_store
+
+
+VALID_ROWS = {} # (id of array, columns) -> (weak reference to the array, mask of valid rows)
+VALID_ROWS_LOCK = threading.RLock() # reentrant: the weakref callbacks may run while the lock is held
+# modules whose code is run by the tasks of the pipeline (the others, e.g. benchmark.py,
+# batch.py or profiler.py, do not change the results and thus do not invalidate checkpoints)
+PIPELINE_MODULES = ['task.py', 'checkpoint.py', 'splitter.py', 'data_compression.py', 'data_transformation.py',
+                    'encoding_models.py', 'ridge.py', 'scoring.py', 'convolution.py', 'timing.py',
+                    'feature_store.py', 'cache.py', 'masking.py', 'utils.py']
+
 
 #########################################
 ############ Basic functions ############
@@ -55,6 +69,18 @@ def write(path, text, end='\n'):
         f.write(text)
         f.write(end)
 
+def get_hdf5_options(array):
+    """ Chunking and compression of a HDF5 dataset (scalars and empty 
+    arrays cannot be chunked).
+    Arguments:
+        - array: np.array
+    Returns:
+        - dict
+    """
+    if array.ndim==0 or array.size==0:
+        return {}
+    return {'chunks': True, 'compression': 'gzip'}
+
 def save(object_to_save, path):
     """ Save an object to a given path.
     Arguments:
@@ -72,13 +98,13 @@ def save(object_to_save, path):
         with h5py.File(path+extension, "w", libver='latest') as fout:
             for key in object_to_save.keys():
                 if isinstance(object_to_save[key], np.ndarray):
-                    fout.create_dataset(str(key), object_to_save[key].shape, data=object_to_save[key])
+                    fout.create_dataset(str(key), object_to_save[key].shape, data=object_to_save[key], **get_hdf5_options(object_to_save[key]))
                 elif isinstance(object_to_save[key], dict):
                     fout.create_dataset(str(key), data=json.dumps(object_to_save[key]))
                 elif isinstance(object_to_save[key], list):
                     for index, arr in enumerate(object_to_save[key]):
                         if isinstance(arr, np.ndarray):
-                            fout.create_dataset(str(key) + '_' + str(index), arr.shape, data=arr)
+                            fout.create_dataset(str(key) + '_' + str(index), arr.shape, data=arr, **get_hdf5_options(arr))
                         elif isinstance(arr, dict):
                             fout.create_dataset(str(key) + '_' + str(index), data=json.dumps(arr))
     elif isinstance(object_to_save, list):
@@ -109,17 +135,100 @@ def merge_dict(list_of_dict):
     result = {key: value for d in list_of_dict for key, value in d.items()}
     return result
 
-def clean_nan_rows(array):
-    """ Remove rows filled with NaN values.
-    Iterate row by row to keep the array structure (no flattening).
+def get_valid_rows(array, columns=None):
+    """ Compute the mask of the rows without NaN values (considering only
+    some columns). The mask of an array is computed once and cached as long
+    as the array exists (the run matrices are shared by all the folds).
     Arguments:
         - array: np.array
+        - columns: np.array / list (of int)
+    Returns:
+        - mask: np.array (of bool)
+    """
+    key = (id(array), None if columns is None else tuple(np.ravel(columns).tolist()))
+    with VALID_ROWS_LOCK:
+        entry = VALID_ROWS.get(key)
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+    mask = ~np.isnan(array if columns is None else array[:, columns]).any(axis=1)
+    try:
+        reference = weakref.ref(array, lambda reference, key=key: forget_valid_rows(key, reference))
+    except TypeError:
+        return mask
+    with VALID_ROWS_LOCK:
+        VALID_ROWS[key] = (reference, mask)
+    return mask
+
+def forget_valid_rows(key, reference):
+    """ Remove the cached mask of an array that was garbage collected
+    (callback of the weak reference, see get_valid_rows).
+    Arguments:
+        - key: tuple
+        - reference: weakref.ref
+    """
+    with VALID_ROWS_LOCK:
+        entry = VALID_ROWS.get(key)
+        if entry is not None and entry[0] is reference: # the key may already refer to a new array
+            del VALID_ROWS[key]
+
+def clean_nan_rows(array, columns=None):
+    """ Remove rows containing NaN values (in the selected columns), 
+    and select columns.
+    Without column selection and when no row contains NaN values, the 
+    input array itself is returned (not a copy): it must not be modified 
+    in place.
+    Arguments:
+        - array: np.array
+        - columns: np.array / list (of int)
     Returns:
         - new_array: np.array
     """
-    filter_ = ~np.isnan(array)
-    new_array = np.vstack([row for row in [row_[filter_[index]] for index, row_ in enumerate(array)] if len(row)>0])
-    return new_array
+    mask = get_valid_rows(array, columns)
+    if columns is None:
+        return array if mask.all() else array[mask]
+    return array[np.ix_(mask, np.ravel(columns))]
+
+def hstack_padded(matrices):
+    """ Concatenate horizontally matrices that may have different numbers
+    of rows, padding the shorter ones with NaN rows (as pd.concat does).
+    Arguments:
+        - matrices: list (of np.array)
+    Returns:
+        - result: np.array
+    """
+    nb_rows = max(matrix.shape[0] for matrix in matrices)
+    if all(matrix.shape[0]==nb_rows for matrix in matrices):
+        return np.hstack(matrices)
+    result = np.full((nb_rows, sum(matrix.shape[1] for matrix in matrices)), np.nan)
+    column = 0
+    for matrix in matrices:
+        result[:matrix.shape[0], column:column + matrix.shape[1]] = matrix
+        column += matrix.shape[1]
+    return result
+
+def get_code_version():
+    """ Compute a hash of the source code executed by the pipeline tasks
+    (see PIPELINE_MODULES), used to invalidate checkpoints when the code changes.
+    Returns:
+        - str
+    """
+    sha = hashlib.sha1()
+    for name in sorted(PIPELINE_MODULES):
+        sha.update(name.encode())
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def get_task_config(kwargs):
+    """ Retrieve the arguments of a class instanciation that
+    have an impact on the results (used to identify checkpoints).
+    Arguments:
+        - kwargs: dict
+    Returns:
+        - dict
+    """
+    execution_keys = ['cache_size', 'cache_path', 'cache_disk_size', 'fmri_cache_path', 'fmri_slab_size', 'scoring_chunk_size', 'voxel_block_size', 'voxel_block_memory']
+    return {key: value for key, value in kwargs.items() if key not in execution_keys}
 
 def aggregate_cv(data):
     """ Transform a list of lists of dicts to
@@ -133,6 +242,75 @@ def aggregate_cv(data):
     result = [{key: np.stack(np.array([dic[key] for dic in data[index]]), axis=0) for key in data[0][0]} for index in range(len(data))]
     return result
 
+class RunningMean(object):
+    """ Running average of dictionaries of arrays (e.g. the maps
+    of the cross-validation folds), without stacking them.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.count = 0
+
+    def add(self, data):
+        """ Add a dictionary to the average.
+        Arguments:
+            - data: dict (of np.array)
+        """
+        for key, value in data.items():
+            if key in self.sums:
+                self.sums[key] += value
+            else:
+                self.sums[key] = np.array(value, dtype=np.float64)
+        self.count += 1
+
+    def get(self):
+        """ Get the average.
+        Returns:
+            - dict (of np.array)
+        """
+        return {key: value / self.count for key, value in self.sums.items()}
+
+def aggregate_folds(maps):
+    """ Average the maps of the cross-validation folds.
+    Arguments:
+        - maps: list (of dict of np.array)
+    Returns:
+        - dict (of np.array)
+    """
+    mean = RunningMean()
+    for dic in maps:
+        mean.add(dic)
+    return mean.get()
+
+def stack_subjects(fmri_data_list):
+    """ Concatenate the fMRI data of several subjects along the voxel 
+    axis, run by run, so that the encoding models fit them jointly 
+    with a single factorization of the design-matrix of each fold (the 
+    voxels being fitted and scored independently, the maps of each 
+    subject are unchanged).
+    Arguments:
+        - fmri_data_list: list (of list of np.array), fMRI runs of each subject
+    Returns:
+        - data: list (of np.array)
+        - sizes: list (of int), number of voxels of each subject
+    """
+    sizes = [subject_data[0].shape[1] for subject_data in fmri_data_list]
+    data = [np.hstack(runs) for runs in zip(*fmri_data_list)] if len(fmri_data_list) > 1 else fmri_data_list[0]
+    return data, sizes
+
+def split_subjects(maps, sizes):
+    """ Split the maps computed from stacked subjects into the maps
+    of each subject.
+    Arguments:
+        - maps: list (of dict of np.array)
+        - sizes: list (of int)
+    Returns:
+        - list (of list of dict)
+    """
+    bounds = np.cumsum([0] + sizes)
+    return [[{key: value[..., bounds[index]:bounds[index + 1]] for key, value in dic.items()} for dic in maps] for index in range(len(sizes))]
+
+
 
 #########################################
 ########### Specific functions ##########
@@ -236,6 +414,7 @@ def fetch_data(path_to_fmridata, path_to_input, subject, language, models=[]):
     fmri_path = os.path.join(path_to_fmridata, language, subject, "func")
     fMRI_paths = sorted(glob.glob(os.path.join(fmri_path, 'fMRI_*run*')))
     deep_representations_paths = [sorted(glob.glob(os.path.join(path_to_input, language, model['model_name'], model['input_template'] + '*run*.csv'))) for model in models]
+    deep_representations_paths = [[get_store_paths(path)[0] if has_store(path) else path for path in paths] for paths in deep_representations_paths] # binary store if converted
     return deep_representations_paths, fMRI_paths
 
 def fetch_offsets(offset_type, run_index, offset_path):
@@ -292,7 +471,11 @@ def get_compression_information(parameters):
     Returns:
         - dict (indexes: list (of np.array),
         compression_types: list (of str),
-        n_components_list: list (of int)
+        n_components_list: list (of int),
+        cache_size: float,
+        cache_path: str,
+        random_state: int,
+        dtype: str
         )
     """
     indexes = []
@@ -304,7 +487,10 @@ def get_compression_information(parameters):
         n_components_list.append(model['ncomponents'])
         indexes.append(np.arange(i, len(eval(model['columns_to_retrieve'])) + i))
         i += len(eval(model['columns_to_retrieve']))
-    return {'indexes': indexes, 'compression_types': compression_types, 'n_components_list': n_components_list}
+    return {'indexes': indexes, 'compression_types': compression_types, 'n_components_list': n_components_list,
+            'cache_size': parameters.get('compression_cache_size', 0), 
+            'cache_path': parameters.get('compression_cache_path', None), 
+            'random_state': parameters.get('seed', None), 'dtype': parameters.get('dtype', 'float64')}
 
 def get_data_transformation_information(parameters):
     """ Retrieve the inputs for data transformation (make_regressor + standardization).
@@ -334,7 +520,13 @@ def get_data_transformation_information(parameters):
     result =  {'indexes': new_indexes, 'offset_type_dict': offset_type_dict, 'duration_type_dict': duration_type_dict,
                 'tr': parameters['tr'], 'nscans': get_nscans(parameters['language']), 
                 'offset_path': parameters['offset_path'], 'duration_path': parameters['duration_path'], 
-                'language': parameters['language'], 'hrf': parameters['hrf']}
+                'language': parameters['language'], 'hrf': parameters['hrf'],
+                'cache_size': parameters.get('regressor_cache_size', 0), 
+                'cache_path': parameters.get('regressor_cache_path', None), 
+                'cache_disk_size': parameters.get('regressor_cache_disk_size', None),
+                'fmri_cache_path': parameters.get('fmri_cache_path', None),
+                'fmri_slab_size': parameters.get('fmri_slab_size', 50),
+                'dtype': parameters.get('dtype', 'float64')}
     return result
             
 def get_encoding_model_information(parameters):
@@ -347,7 +539,11 @@ def get_encoding_model_information(parameters):
     result = {'model': eval(parameters['encoding_model']), 'alpha': parameters['alpha'], 
                 'alpha_min_log_scale': parameters['alpha_min_log_scale'], 
                 'alpha_max_log_scale': parameters['alpha_max_log_scale'], 
-                'nb_alphas': parameters['nb_alphas'], 'optimizing_criteria': parameters['optimizing_criteria']}
+                'nb_alphas': parameters['nb_alphas'], 'optimizing_criteria': parameters['optimizing_criteria'],
+                'solver': parameters.get('solver', 'sklearn'), 'scoring_chunk_size': parameters.get('scoring_chunk_size', None),
+                'voxel_block_size': parameters.get('voxel_block_size', None), 'voxel_block_memory': parameters.get('voxel_block_memory', None),
+                'dtype': parameters.get('dtype', 'float64'), 'alpha_search': parameters.get('alpha_search', 'grid'),
+                'nb_alpha_extensions': parameters.get('nb_alpha_extensions', 3), 'nb_alpha_refinements': parameters.get('nb_alpha_refinements', 5)}
     return result
 
 #########################################
@@ -401,7 +597,7 @@ def fetch_masker(masker_path, language, path_to_fmridata, path_to_input, smoothi
         save_yaml(params, masker_path + '.yml')
     return masker
 
-def create_maps(masker, distribution, output_path, vmax=None, not_glass_brain=False, logger=None, distribution_max=None, distribution_min=None):
+def create_maps(masker, distribution, output_path, vmax=None, not_glass_brain=False, logger=None, distribution_max=None, distribution_min=None, compress=True):
     """ Create the maps from the distribution.
     Arguments:
         - masker: NifitMasker
@@ -409,6 +605,7 @@ def create_maps(masker, distribution, output_path, vmax=None, not_glass_brain=Fa
         - output_path: str
         - vmax: float
         - not_glass_brain: bool
+        - compress: bool (gzip the image)
     """
     logger.info("Transforming array to .nii image...")
     if distribution_min is not None:
@@ -418,7 +615,7 @@ def create_maps(masker, distribution, output_path, vmax=None, not_glass_brain=Fa
     img = masker.inverse_transform(distribution)
     logger.validate()
     logger.info("Saving image...")
-    nib.save(img, output_path + '.nii.gz')
+    nib.save(img, output_path + ('.nii.gz' if compress else '.nii'))
     logger.validate()
 
     plt.hist(distribution[~np.isnan(distribution)], bins=50)